@@ -277,6 +277,10 @@ set_option("API_CACHE_ENABLED", True)
 set_option("API_CACHE_ROOT", os.path.join(BASE_DIR, "api-cache"))
 set_option("API_CACHE_LOG", os.path.join(BASE_DIR, "var/log/api-cache.log"))
 
+# answer simple filters (exact, in, range and substring lookups on
+# non-relation fields) from an in-memory snapshot of the api-cache files
+set_option("API_CACHE_FILTERS_ENABLED", False)
+
 # Keys
 
 set_from_env("MELISSA_KEY")
@@ -359,6 +363,25 @@ set_option("API_THROTTLE_REPEATED_REQUEST_ENABLED_ORG", False)
 # Expected repeated requests are cached for n seconds (default = 31 days)
 set_option("API_THROTTLE_REPEATED_REQUEST_CACHE_EXPIRY", 86400 * 31)
 
+# storage backend for api throttle state, one of "cache" (django cache),
+# "local" (in-process memory) or "redis" (API_THROTTLE_REDIS_URL)
+# redis falls back to cache, with a warning, if the redis module is not
+# installed or no url is set
+set_option("API_THROTTLE_STORAGE", "cache")
+set_option("API_THROTTLE_REDIS_URL", "")
+
+# algorithm used to track api request rates
+# "sliding_log" keeps a timestamp for each request in the window (exact)
+# "sliding_window" keeps two counters per client (approximate, fixed memory)
+set_option("API_THROTTLE_ALGORITHM", "sliding_log")
+
+# Environment setting overrides, the ip prefix index and compiled permission
+# sets are kept in memory for each process and checked for changes made by
+# other processes every n seconds (see peeringdb_server.process_cache)
+set_option("ENV_SETTINGS_CACHE_TIMEOUT", 5)
+set_option("IXPFX_INDEX_CACHE_TIMEOUT", 5)
+set_option("PERMISSION_SETS_CACHE_TIMEOUT", 5)
+
 
 # spatial queries require user auth
 set_option("API_DISTANCE_FILTER_REQUIRE_AUTH", True)
@@ -912,6 +935,14 @@ set_option("SPONSORSHIPS_EMAIL", SERVER_EMAIL)
 set_option("API_URL", "https://peeringdb.com/api")
 set_option("API_DEPTH_ROW_LIMIT", 250)
 
+# default number of objects per page for incremental sync (`cursor`) requests
+set_option("API_SYNC_PAGE_SIZE", 1000)
+
+# json serialization backend for api responses ("json" or "orjson")
+# orjson is not a dependency, it needs to be installed separately,
+# falls back to json if it is selected but not installed
+set_option("API_JSON_BACKEND", "json")
+
 # limit results for the standard search
 # (hitting enter on the main search bar)
 set_option("SEARCH_RESULTS_LIMIT", 1000)
@@ -1161,6 +1192,20 @@ set_option("IXF_RESEND_FAILED_EMAILS", False)
 # Set value for IX-F fetch timeout
 set_option("IXF_FETCH_TIMEOUT", 30)
 
+# Max number of concurrent IX-F member list fetches during import
+set_option("IXF_FETCH_WORKERS", 16)
+
+# Max number of concurrent IX-F member list fetches to the same host
+set_option("IXF_FETCH_MAX_PER_HOST", 2)
+
+# Skip the import of an ixlan if neither its IX-F member list nor the
+# relevant database state changed since its last successful import
+set_option("IXF_SKIP_UNCHANGED_IMPORTS", True)
+
+# Cache IX-F member list exports for N seconds, exports are regenerated
+# when the underlying data changes. Set to 0 to disable
+set_option("IXF_EXPORT_CACHE_TIMEOUT", 86400)
+
 # Setting for number of days before deleting childless Organizations
 set_option("ORG_CHILDLESS_DELETE_DURATION", 90)
 
@@ -1,11 +1,416 @@
 """
 Handle loading of api-cache data.
+
+Cache files are written by the `pdb_api_cache` command with one serialized
+row per line, so rows can be read and skipped without parsing the whole
+document:
+
+```
+{"data": [
+{...},
+{...}
+], "meta": {}}
+```
+
+A row offset index (see `APICacheIndex`) is written next to each
+cache file.
 """
 
+import array
+import gzip
+import hashlib
+import io
 import json
 import os
+import struct
 
+import unidecode
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from rest_framework import serializers
+
+from peeringdb_server.permissions import get_permission_holder_from_request
+from peeringdb_server.renderers import dumps
+from peeringdb_server.rest_throttles import ResponseSizeThrottle
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# first line of a row-per-line cache file
+CACHE_FILE_HEADER = b'{"data": [\n'
+
+# pre-compressed variants of a cache file (content encoding, file extension)
+# in order of preference
+
+COMPRESSED_VARIANTS = [("br", ".br"), ("gzip", ".gz")]
+
+
+def dumps_bytes(data, indent=None):
+    """
+    Serialize to json bytes using the configured json backend
+    (see `renderers.dumps`), so responses served from the api-cache
+    match the ones rendered from the database.
+    """
+
+    data = dumps(data, indent=indent)
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    return data
+
+
+def write_cache_file(fh, rows, meta=None):
+    """
+    Writes the specified rows to an api-cache file in row-per-line format
+    and returns an `APICacheIndex` for the written file.
+
+    Arguments:
+
+    - fh: file object opened in binary mode
+    - rows (`list`): serialized rows
+    - meta (`dict`): meta data to write to the file
+    """
+
+    index = APICacheIndex()
+
+    fh.write(CACHE_FILE_HEADER)
+    for row in rows:
+        if index.offsets:
+            fh.write(b",\n")
+        index.offsets.append(fh.tell())
+        fh.write(dumps_bytes(row))
+    if index.offsets:
+        fh.write(b"\n")
+    fh.write(b'], "meta": %s}' % dumps_bytes(meta or {}))
+
+    index.size = fh.tell()
+    try:
+        index.inode = os.fstat(fh.fileno()).st_ino
+    except io.UnsupportedOperation:
+        pass
+    return index
+
+
+def render_rows(rows, applicator, meta, indent=None):
+    """
+    Yields the rendered api response for the specified rows in chunks
+    of bytes.
+
+    Permissions are applied to each row using the specified applicator,
+    denied rows are left out.
+
+    The separators around the rows are taken from the json backend
+    as well, so the response is rendered the same way `MetaJSONRenderer`
+    renders it.
+    """
+
+    item_separator = dumps_bytes([0, 0])[2:-2]
+    key_separator = dumps_bytes({"a": 0})[4:-2]
+
+    chunk = b'{"data"%s[' % key_separator
+    first = True
+    for row in rows:
+        row = applicator.apply(row)
+        if row == applicator.denied:
+            continue
+        if not first:
+            chunk += item_separator
+        first = False
+        yield chunk
+        chunk = dumps_bytes(row, indent=indent)
+
+    chunk += b']%s"meta"%s%s}' % (
+        item_separator,
+        key_separator,
+        dumps_bytes(meta, indent=indent),
+    )
+    yield chunk
+
+
+def write_compressed_variants(path, output_path, applicator, meta):
+    """
+    Renders the api response for the rows of the cache file at `path`
+    as seen by the specified applicator and writes it compressed
+    to `output_path` + extension, for each supported content encoding.
+
+    Brotli variants are only written if the `brotli` module is installed.
+
+    Returns a list of the written file paths.
+    """
+
+    compressors = []
+    written = []
+
+    def rows():
+        with open(path, "rb") as f:
+            f.readline()
+            for line in f:
+                if line.startswith(b"]") or not line.strip():
+                    break
+                yield json.loads(line.rstrip().rstrip(b","))
+
+    try:
+        for encoding, ext in COMPRESSED_VARIANTS:
+            if encoding == "br" and not brotli:
+                continue
+            fh = open(output_path + ext, "wb")
+            written.append(output_path + ext)
+            if encoding == "gzip":
+                compressor = gzip.GzipFile(fileobj=fh, mode="wb", mtime=0)
+            else:
+                compressor = brotli.Compressor()
+            compressors.append((fh, compressor))
+
+        for chunk in render_rows(rows(), applicator, meta):
+            for fh, compressor in compressors:
+                if isinstance(compressor, gzip.GzipFile):
+                    compressor.write(chunk)
+                else:
+                    fh.write(compressor.process(chunk))
+
+        for fh, compressor in compressors:
+            if isinstance(compressor, gzip.GzipFile):
+                compressor.close()
+            else:
+                fh.write(compressor.finish())
+            fh.close()
+    except Exception:
+        for fh, compressor in compressors:
+            fh.close()
+        for _path in written:
+            os.remove(_path)
+        raise
+
+    return written
+
+
+class APICacheIndex:
+    """
+    Row offset index sidecar for an api-cache file.
+
+    Stored next to the cache file as `<tag>-<depth>.idx` and maps
+    row numbers to byte offsets in the cache file so the loader can
+    seek straight to the requested page.
+
+    Layout: header (magic, cache file size, cache file inode, row count)
+    followed by the row offsets as unsigned 64 bit integers.
+    """
+
+    magic = b"PDBIDX01"
+    header = struct.Struct("<8sQQQ")
+    item = struct.Struct("<Q")
+
+    def __init__(self, size=0, inode=0, count=0, path=None):
+        self.size = size
+        self.inode = inode
+        self.count = count
+        self.path = path
+        self.offsets = array.array("Q")
+
+    @classmethod
+    def index_path(cls, path):
+        """
+        Return the index file path for the specified cache file path.
+        """
+        return os.path.splitext(path)[0] + ".idx"
+
+    @classmethod
+    def load(cls, path):
+        """
+        Return the index for the specified cache file.
+
+        Only the index header is read. Returns `None` if the index file
+        does not exist or does not match the cache file.
+        """
+
+        try:
+            with open(cls.index_path(path), "rb") as fh:
+                magic, size, inode, count = cls.header.unpack(
+                    fh.read(cls.header.size)
+                )
+            stat = os.stat(path)
+        except (OSError, struct.error):
+            return None
+
+        if magic != cls.magic or size != stat.st_size:
+            return None
+
+        # cache file has been replaced since the index was written
+
+        if inode and inode != stat.st_ino:
+            return None
+
+        return cls(size=size, inode=inode, count=count, path=cls.index_path(path))
+
+    def write(self, fh):
+        """
+        Write the index to the specified binary file object.
+        """
+        fh.write(
+            self.header.pack(self.magic, self.size, self.inode, len(self.offsets))
+        )
+        fh.write(self.offsets.tobytes())
+
+    def _read_item(self, position):
+        with open(self.path, "rb") as fh:
+            fh.seek(self.header.size + position * self.item.size)
+            return self.item.unpack(fh.read(self.item.size))[0]
+
+    def row_offset(self, row):
+        """
+        Return the byte offset of the specified row number in the
+        cache file, or `None` if the row is out of range.
+        """
+
+        if row >= self.count:
+            return None
+        return self._read_item(row)
+
+
+class APICacheSnapshot:
+    """
+    In-memory columnar snapshot of an api-cache file.
+
+    Holds the values of the specified fields for every row (one list per
+    field) and the byte offset of every row in the cache file. Used
+    to answer simple filters on cached rows without querying the database,
+    matching rows are then read from the cache file.
+
+    Hash indexes for exact and `__in` lookups are built the first time
+    a field is looked up and are kept for the lifetime of the snapshot.
+    """
+
+    def __init__(self, path, fields):
+        self.path = path
+        self.signature = self.file_signature(path)
+        self.offsets = array.array("Q")
+        self.columns = {field: [] for field in fields}
+        self.indexes = {}
+
+        with open(path, "rb") as fh:
+            if fh.readline() != CACHE_FILE_HEADER:
+                raise ValueError("Cache file is not in row-per-line format")
+            offset = fh.tell()
+            for line in fh:
+                if line.startswith(b"]") or not line.strip():
+                    break
+                row = json.loads(line.rstrip().rstrip(b","))
+                self.offsets.append(offset)
+                for field, column in self.columns.items():
+                    column.append(self.normalize(row.get(field)))
+                offset += len(line)
+
+    @staticmethod
+    def file_signature(path):
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    @staticmethod
+    def normalize(value):
+        """
+        Normalize a value for comparison.
+
+        Strings are compared case and accent insensitive, like the
+        database collation does.
+        """
+        if isinstance(value, str):
+            return unidecode.unidecode(value).lower()
+        return value
+
+    def index(self, field):
+        """
+        Return the hash index (value -> row numbers) for the specified field.
+        """
+        if field not in self.indexes:
+            index = {}
+            for row, value in enumerate(self.columns[field]):
+                index.setdefault(value, array.array("L")).append(row)
+            self.indexes[field] = index
+        return self.indexes[field]
+
+    def match(self, field, op, value):
+        """
+        Return the set of row numbers matching the specified lookup.
+        """
+
+        if op == "exact":
+            return set(self.index(field).get(value, ()))
+
+        if op == "in":
+            index = self.index(field)
+            rows = set()
+            for _value in value:
+                rows.update(index.get(_value, ()))
+            return rows
+
+        column = self.columns[field]
+
+        if op in ["lt", "lte", "gt", "gte"]:
+            compare = {
+                "lt": lambda a: a < value,
+                "lte": lambda a: a <= value,
+                "gt": lambda a: a > value,
+                "gte": lambda a: a >= value,
+            }[op]
+            return {
+                row
+                for row, _value in enumerate(column)
+                if _value is not None and compare(_value)
+            }
+
+        if op == "contains":
+            return {
+                row for row, _value in enumerate(column) if _value and value in _value
+            }
+
+        if op == "startswith":
+            return {
+                row
+                for row, _value in enumerate(column)
+                if _value and _value.startswith(value)
+            }
+
+        raise ValueError(f"Unsupported lookup: {op}")
+
+
+# loaded snapshots, by cache file path
+
+SNAPSHOTS = {}
+
+
+def get_snapshot(path, fields):
+    """
+    Return an up to date `APICacheSnapshot` for the specified cache
+    file that holds at least the specified fields.
+
+    Returns `None` if no snapshot can be built for the file.
+    """
+
+    snapshot = SNAPSHOTS.get(path)
+
+    try:
+        signature = APICacheSnapshot.file_signature(path)
+    except OSError:
+        return None
+
+    if (
+        not snapshot
+        or snapshot.signature != signature
+        or not set(fields).issubset(snapshot.columns)
+    ):
+        if snapshot and snapshot.signature == signature:
+            fields = set(fields) | set(snapshot.columns)
+        try:
+            snapshot = APICacheSnapshot(path, fields)
+        except (OSError, ValueError):
+            return None
+        SNAPSHOTS[path] = snapshot
+
+    return snapshot
 
 
 class CacheRedirect(Exception):
@@ -24,6 +429,37 @@ class CacheRedirect(Exception):
 ###############################################################################
 # API CACHE LOADER
 
+# orm lookups that can be answered from an api-cache snapshot
+
+FILTER_OPS = {
+    "exact": "exact",
+    "iexact": "exact",
+    "in": "in",
+    "lt": "lt",
+    "lte": "lte",
+    "gt": "gt",
+    "gte": "gte",
+    "icontains": "contains",
+    "istartswith": "startswith",
+}
+
+NUMERIC_FIELD_TYPES = [
+    "AutoField",
+    "BigAutoField",
+    "BigIntegerField",
+    "ForeignKey",
+    "IntegerField",
+    "PositiveIntegerField",
+    "PositiveSmallIntegerField",
+    "SmallIntegerField",
+]
+
+STRING_FIELD_TYPES = ["CharField", "TextField"]
+
+# filterable fields, by serializer class
+
+FILTERABLE_FIELDS = {}
+
 
 class APICacheLoader:
     """
@@ -31,11 +467,12 @@ class APICacheLoader:
     and if it does allows you to provide the cached result.
     """
 
-    def __init__(self, viewset, qset, filters):
+    def __init__(self, viewset, qset, filters, p_filters=None):
         request = viewset.request
         self.request = request
         self.qset = qset
         self.filters = filters
+        self.p_filters = p_filters or {}
         self.model = viewset.model
         self.viewset = viewset
         self.depth = min(int(request.query_params.get("depth", 0)), 3)
@@ -45,6 +482,8 @@ class APICacheLoader:
         self.fields = request.query_params.get("fields")
         if self.fields:
             self.fields = self.fields.split(",")
+        self.matches = None
+        self.snapshot = None
         self.path = os.path.join(
             settings.API_CACHE_ROOT,
             f"{viewset.model.handleref.tag}-{self.depth}.json",
@@ -67,8 +506,8 @@ class APICacheLoader:
             and getattr(settings, "API_CACHE_ALL_LIMITS", False) is False
         ):
             return False
-        # filters have been specified, no
-        if self.filters or self.since:
+        # since or a sync cursor has been specified, no
+        if self.since or "cursor" in self.request.query_params:
             return False
         # cache file non-existant, no
         if not os.path.exists(self.path):
@@ -79,39 +518,328 @@ class APICacheLoader:
         # primary key set in request, no
         if self.viewset.kwargs:
             return False
+        # filters have been specified that cannot be answered
+        # from the api-cache snapshot, no
+        if self.filters:
+            if not getattr(settings, "API_CACHE_FILTERS_ENABLED", False):
+                return False
+            if self.p_filters or getattr(self.qset, "spatial", False):
+                return False
+            self.matches = self.match_filters()
+            if self.matches is None:
+                return False
 
         return True
 
+    @property
+    def filterable_fields(self):
+        """
+        Return a dict mapping model field names to the names of the
+        serializer fields that hold their value in the cached rows.
+
+        Only fields with a plain string or integer value are included.
+        """
+
+        serializer_class = self.viewset.serializer_class
+
+        if serializer_class not in FILTERABLE_FIELDS:
+            fields = {}
+            for name, field in serializer_class().fields.items():
+                if isinstance(
+                    field,
+                    (serializers.SerializerMethodField, serializers.ListSerializer),
+                ):
+                    continue
+                if field.source in ["*", None] or "." in field.source:
+                    continue
+                try:
+                    model_field = self.model._meta.get_field(field.source)
+                except Exception:
+                    continue
+                if type(model_field).__module__.startswith("django_inet"):
+                    continue
+                internal_type = model_field.get_internal_type()
+                if internal_type in NUMERIC_FIELD_TYPES:
+                    fields[field.source] = (name, int)
+                elif internal_type in STRING_FIELD_TYPES:
+                    fields[field.source] = (name, str)
+            FILTERABLE_FIELDS[serializer_class] = fields
+
+        return FILTERABLE_FIELDS[serializer_class]
+
+    def match_filters(self):
+        """
+        Apply the request's filters to the api-cache snapshot.
+
+        Returns the sorted list of matching row numbers or `None` if the
+        filters cannot be answered from the snapshot (relation filters,
+        date or non-scalar fields etc.), in which case the request
+        needs to go to the database.
+        """
+
+        filterable = self.filterable_fields
+        lookups = []
+
+        for key, value in self.filters.items():
+            field, _, op = key.rpartition("__")
+            if not field:
+                # <fk>_id exact filter
+                field, op = key, "exact"
+                if field.endswith("_id") and field[:-3] in filterable:
+                    field = field[:-3]
+            if "__" in field or field not in filterable:
+                return None
+
+            op = FILTER_OPS.get(op)
+            if not op:
+                return None
+
+            name, typ = filterable[field]
+
+            try:
+                if op == "in":
+                    value = [APICacheSnapshot.normalize(typ(v)) for v in value]
+                else:
+                    value = APICacheSnapshot.normalize(typ(value))
+            except (TypeError, ValueError):
+                return None
+
+            if typ is str and op in ["lt", "lte", "gt", "gte"]:
+                return None
+            if typ is int and op in ["contains", "startswith"]:
+                return None
+
+            lookups.append((name, op, value))
+
+        snapshot = get_snapshot(self.path, [name for name, op, value in lookups])
+        if not snapshot:
+            return None
+
+        matches = None
+        for name, op, value in lookups:
+            rows = snapshot.match(name, op, value)
+            matches = rows if matches is None else matches & rows
+            if not matches:
+                break
+
+        self.snapshot = snapshot
+        return sorted(matches)
+
     def load(self):
         """
         Load the cached response according to tag and depth.
         """
 
-        # read cache file
-        with open(self.path) as f:
-            data = json.load(f)
+        return {
+            "results": list(self.rows()),
+            "__meta": {"generated": os.path.getmtime(self.path)},
+        }
+
+    def rows(self):
+        """
+        Yields the rows of the cached response according to tag and depth
+        with pagination and field filtering applied.
+
+        Only rows that fall into the requested window are parsed.
+        """
+
+        if self.matches is not None:
+            yield from self.matched_rows()
+            return
 
-        data = data.get("data")
+        with open(self.path, "rb") as f:
+            header = f.readline()
 
-        # apply pagination
-        if self.skip and self.limit:
-            data = data[self.skip : self.skip + self.limit]
-        elif self.skip:
-            data = data[self.skip :]
-        elif self.limit:
-            data = data[: self.limit]
+            # cache file was written in the legacy single document
+            # format, fall back to parsing the whole file
 
-        if self.fields:
-            for row in data:
-                self.filter_fields(row)
+            if header != CACHE_FILE_HEADER:
+                data = json.loads(header + f.read()).get("data")
+                stop = self.skip + self.limit if self.limit else None
+                for row in data[self.skip : stop]:
+                    yield self.filter_fields(row)
+                return
+
+            index = 0
 
-        return {"results": data, "__meta": {"generated": os.path.getmtime(self.path)}}
+            # seek straight to the first requested row if an
+            # up to date row offset index exists
+
+            if self.skip:
+                cache_index = APICacheIndex.load(self.path)
+                if cache_index:
+                    offset = cache_index.row_offset(self.skip)
+                    if offset is None:
+                        return
+                    f.seek(offset)
+                    index = self.skip
+
+            count = 0
+            for line in f:
+                if line.startswith(b"]") or not line.strip():
+                    break
+                if index < self.skip:
+                    index += 1
+                    continue
+                yield self.filter_fields(json.loads(line.rstrip().rstrip(b",")))
+                count += 1
+                if self.limit and count >= self.limit:
+                    break
+
+    def matched_rows(self):
+        """
+        Yields the rows matched by `match_filters` with pagination
+        and field filtering applied.
+        """
+
+        stop = self.skip + self.limit if self.limit else None
+
+        with open(self.path, "rb") as f:
+            for row in self.matches[self.skip : stop]:
+                f.seek(self.snapshot.offsets[row])
+                line = f.readline()
+                yield self.filter_fields(json.loads(line.rstrip().rstrip(b",")))
+
+    def stream(self, applicator, indent=None):
+        """
+        Yields the rendered cached response one row at a time.
+
+        Permissions are applied to each row using the specified
+        applicator, once all rows have been sent the response size
+        is cached for response size throttling.
+
+        Arguments:
+
+        - applicator (`APIPermissionsApplicator`)
+        - indent (`int`): indent for pretty output
+        """
+
+        size = 0
+        meta = getattr(self.request, "meta_response", {})
+        meta.update(generated=os.path.getmtime(self.path))
+
+        for chunk in render_rows(self.rows(), applicator, meta, indent=indent):
+            size += len(chunk)
+            yield chunk
+
+        ResponseSizeThrottle.cache_response_size(self.request, size)
+
+    def streaming_response(self, applicator):
+        """
+        Return a StreamingHttpResponse that renders the cached
+        response row by row.
+        """
+
+        compressed = self.compressed_variant()
+        if compressed:
+            return self.compressed_response(*compressed)
+
+        indent = 2 if "pretty" in self.request.GET else None
+
+        response = StreamingHttpResponse(
+            self.stream(applicator, indent=indent),
+            content_type="application/json",
+        )
+        response["ETag"] = self.etag
+        response["Last-Modified"] = http_date(os.path.getmtime(self.path))
+        patch_vary_headers(response, ["Accept-Encoding"])
+        return response
+
+    def compressed_variant(self):
+        """
+        Return (content encoding, path) of the pre-compressed variant of
+        the cache file to serve for this request or `None`.
+
+        Compressed variants are rendered for anonymous users, so they are
+        only served for anonymous requests that do not filter, page or
+        reformat the result set and accept the variant's encoding.
+        """
+
+        if set(self.request.GET.keys()) - {"depth"}:
+            return None
+
+        if self.matches is not None:
+            return None
+
+        holder = get_permission_holder_from_request(self.request)
+        if not isinstance(holder, AnonymousUser):
+            return None
+
+        accepted = set()
+        for value in self.request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+            encoding, _, params = value.partition(";")
+            if params.replace(" ", "") in ["q=0", "q=0.0", "q=0.00", "q=0.000"]:
+                continue
+            accepted.add(encoding.strip().lower())
+
+        mtime = os.path.getmtime(self.path)
+
+        for encoding, ext in COMPRESSED_VARIANTS:
+            if encoding not in accepted:
+                continue
+            path = self.path + ext
+            # variants are written after the cache file, an older
+            # variant belongs to a previous version of the cache file
+            try:
+                if os.path.getmtime(path) < mtime:
+                    continue
+            except OSError:
+                continue
+            return encoding, path
+
+        return None
+
+    def compressed_response(self, encoding, path):
+        """
+        Return a response that sends the specified pre-compressed
+        cache file variant as is.
+        """
+
+        response = FileResponse(open(path, "rb"), content_type="application/json")
+        if response.has_header("Content-Disposition"):
+            del response["Content-Disposition"]
+        response["Content-Encoding"] = encoding
+        response["ETag"] = 'W/"%s-%s"' % (self.etag[3:-1], encoding)
+        response["Last-Modified"] = http_date(os.path.getmtime(self.path))
+        patch_vary_headers(response, ["Accept-Encoding"])
+
+        ResponseSizeThrottle.cache_response_size(
+            self.request, os.path.getsize(path)
+        )
+
+        return response
+
+    @property
+    def etag(self):
+        """
+        Weak ETag for the cached response.
+
+        Derived from the cache file (regenerating it changes the ETag),
+        the request's query string and the permission holder, since
+        the rows are filtered by the requesting user's permissions.
+        """
+
+        stat = os.stat(self.path)
+        holder = get_permission_holder_from_request(self.request)
+        value = "|".join(
+            [
+                self.path,
+                str(stat.st_size),
+                str(stat.st_mtime_ns),
+                self.request.META.get("QUERY_STRING", ""),
+                f"{holder.__class__.__name__}:{holder.pk}",
+            ]
+        )
+        return 'W/"%s"' % hashlib.sha1(value.encode()).hexdigest()
 
     def filter_fields(self, row):
         """
         Remove any unwanted fields from the resultset
         according to the `fields` filter specified in the request.
         """
+        if not self.fields:
+            return row
         for field in list(row.keys()):
             if field not in self.fields and field != "_grainy":
                 del row[field]
+        return row
@@ -10,104 +10,246 @@ import urllib.error
 import urllib.parse
 import urllib.request
 
-from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.utils.translation import ugettext_lazy as _
 from django.views import View
 from rest_framework.test import APIRequestFactory
 
-from peeringdb_server.models import IXLan
+from peeringdb_server.models import IXLan, NetworkContact, NetworkIXLan
 from peeringdb_server.renderers import JSONEncoder
 from peeringdb_server.rest import REFTAG_MAP as RestViewSets
 
 
-def export_ixf_ix_members(ixlans, pretty=False):
-    member_list = []
-    ixp_list = []
+def iter_json_list(data, key, items, indent=None):
+    """
+    Yield the json encoding of `data` in chunks, with the list at
+    top level `key` encoded from the `items` iterable one item at
+    a time.
 
-    for ixlan in ixlans:
-        if ixlan.ix not in ixp_list:
-            ixp_list.append(ixlan.ix)
+    The output is the same as `json.dumps` of `data` with the list
+    in place.
+    """
+
+    placeholder = json.dumps(f"__{key}__")
+    head, tail = json.dumps({**data, key: placeholder[1:-1]}, indent=indent).split(
+        placeholder, 1
+    )
+
+    if indent is None:
+        separator, newline = ", ", ""
+    else:
+        separator, newline = ",", "\n" + " " * indent * 2
+
+    yield head + "["
+
+    empty = True
+    for item in items:
+        encoded = json.dumps(item, indent=indent)
+        if newline:
+            encoded = encoded.replace("\n", newline)
+        yield ("" if empty else separator) + newline + encoded
+        empty = False
+
+    if newline and not empty:
+        yield newline[:-indent]
+
+    yield "]" + tail
 
-    rv = {
-        "version": "0.6",
-        "timestamp": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
-        "member_list": member_list,
-        "ixp_list": [{"ixp_id": ixp.id, "shortname": ixp.name} for ixp in ixp_list],
-    }
+
+def ixf_ix_members(ixlans):
+    """
+    Yield the IX-F member list entries for the specified ixlans.
+
+    Netixlans, networks and public network contacts are retrieved
+    in bulk and grouped in memory.
+    """
+
+    netixlans = collections.defaultdict(lambda: collections.defaultdict(list))
+    for netixlan in NetworkIXLan.handleref.filter(
+        ixlan__in=ixlans, status="ok"
+    ).select_related("network"):
+        netixlans[netixlan.ixlan_id][netixlan.asn].append(netixlan)
+
+    pocs = collections.defaultdict(list)
+    for poc in NetworkContact.handleref.filter(
+        network_id__in={
+            netixlan.network_id
+            for members in netixlans.values()
+            for connections in members.values()
+            for netixlan in connections
+        },
+        status="ok",
+        visible="Public",
+    ):
+        pocs[poc.network_id].append(poc)
 
     for ixlan in ixlans:
-        asns = []
-        for netixlan in ixlan.netixlan_set_active.all():
-            if netixlan.asn in asns:
-                continue
+        for asn, connections in netixlans[ixlan.id].items():
+            network = connections[0].network
             connection_list = []
             member = {
-                "asnum": netixlan.asn,
+                "asnum": asn,
                 "member_type": "peering",
-                "name": netixlan.network.name,
-                "url": netixlan.network.website,
-                "contact_email": [
-                    poc.email
-                    for poc in netixlan.network.poc_set_active.filter(visible="Public")
-                ],
-                "contact_phone": [
-                    poc.phone
-                    for poc in netixlan.network.poc_set_active.filter(visible="Public")
-                ],
-                "peering_policy": netixlan.network.policy_general.lower(),
-                "peering_policy_url": netixlan.network.policy_url,
+                "name": network.name,
+                "url": network.website,
+                "contact_email": [poc.email for poc in pocs[network.id]],
+                "contact_phone": [poc.phone for poc in pocs[network.id]],
+                "peering_policy": network.policy_general.lower(),
+                "peering_policy_url": network.policy_url,
                 "connection_list": connection_list,
             }
-            member_list.append(member)
-            asns.append(netixlan.asn)
-            for _netixlan in ixlan.netixlan_set_active.filter(asn=netixlan.asn):
+            for netixlan in connections:
                 vlan_list = [{}]
                 connection = {
-                    "ixp_id": _netixlan.ixlan.ix_id,
+                    "ixp_id": ixlan.ix_id,
                     "state": "active",
-                    "if_list": [{"if_speed": _netixlan.speed}],
+                    "if_list": [{"if_speed": netixlan.speed}],
                     "vlan_list": vlan_list,
                 }
                 connection_list.append(connection)
 
-                if _netixlan.ipaddr4:
+                if netixlan.ipaddr4:
                     vlan_list[0]["ipv4"] = {
-                        "address": f"{_netixlan.ipaddr4}",
-                        "routeserver": _netixlan.is_rs_peer,
-                        "max_prefix": _netixlan.network.info_prefixes4,
-                        "as_macro": _netixlan.network.irr_as_set,
+                        "address": f"{netixlan.ipaddr4}",
+                        "routeserver": netixlan.is_rs_peer,
+                        "max_prefix": netixlan.network.info_prefixes4,
+                        "as_macro": netixlan.network.irr_as_set,
                     }
-                if _netixlan.ipaddr6:
+                if netixlan.ipaddr6:
                     vlan_list[0]["ipv6"] = {
-                        "address": f"{_netixlan.ipaddr6}",
-                        "routeserver": _netixlan.is_rs_peer,
-                        "max_prefix": _netixlan.network.info_prefixes6,
-                        "as_macro": _netixlan.network.irr_as_set,
+                        "address": f"{netixlan.ipaddr6}",
+                        "routeserver": netixlan.is_rs_peer,
+                        "max_prefix": netixlan.network.info_prefixes6,
+                        "as_macro": netixlan.network.irr_as_set,
                     }
 
-    if pretty:
-        return json.dumps(rv, indent=2)
-    else:
-        return json.dumps(rv)
+            yield member
+
+
+def ixf_export_timestamp():
+    """
+    Returns the `timestamp` of an IX-F member list export
+    generated now.
+    """
+    return datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def iter_export_ixf_ix_members(ixlans, pretty=False, timestamp=None):
+    """
+    Yield the IX-F member list export of the specified ixlans
+    in chunks.
+    """
+
+    ixlans = list(ixlans)
+    ixp_list = []
+
+    for ixlan in ixlans:
+        if ixlan.ix not in ixp_list:
+            ixp_list.append(ixlan.ix)
+
+    rv = {
+        "version": "0.6",
+        "timestamp": timestamp or ixf_export_timestamp(),
+        "member_list": [],
+        "ixp_list": [{"ixp_id": ixp.id, "shortname": ixp.name} for ixp in ixp_list],
+    }
+
+    return iter_json_list(
+        rv, "member_list", ixf_ix_members(ixlans), indent=2 if pretty else None
+    )
+
+
+def export_ixf_ix_members(ixlans, pretty=False):
+    return "".join(iter_export_ixf_ix_members(ixlans, pretty=pretty))
+
+
+def ixf_export_state(ixlans):
+    """
+    Return a string describing the state of all the data that goes
+    into the IX-F member list export of the specified ixlans.
+
+    Changes to netixlans, their networks and network contacts all
+    touch the `updated` timestamp, so the export only needs to be
+    regenerated when one of the latest timestamps changes.
+    """
+
+    state = NetworkIXLan.handleref.filter(ixlan__in=ixlans).aggregate(
+        netixlan_count=Count("id", distinct=True),
+        netixlan_updated=Max("updated"),
+        network_updated=Max("network__updated"),
+        poc_updated=Max("network__poc_set__updated"),
+    )
+
+    state["ix"] = [(ixlan.id, ixlan.ix_id, ixlan.ix.updated) for ixlan in ixlans]
+
+    return str(sorted(state.items()))
+
+
+def ixf_export_response(ixlans, pretty=False):
+    """
+    Return a response streaming the IX-F member list export of the
+    specified ixlans.
+
+    The export is cached for `IXF_EXPORT_CACHE_TIMEOUT` seconds and
+    served from the cache for as long as the underlying data does
+    not change. Its `timestamp` is set to the time it is served.
+    """
+
+    ixlans = list(ixlans.select_related("ix"))
+    timeout = settings.IXF_EXPORT_CACHE_TIMEOUT
+
+    if not timeout:
+        return StreamingHttpResponse(
+            iter_export_ixf_ix_members(ixlans, pretty=pretty),
+            content_type="application/json",
+        )
+
+    key = "IXF-EXPORT-{}-{}".format(
+        ",".join(str(ixlan.id) for ixlan in ixlans), int(pretty)
+    )
+    state = ixf_export_state(ixlans)
+    cached = cache.get(key)
+
+    if cached and cached["state"] == state and cached.get("timestamp"):
+        content = cached["content"].replace(
+            '"timestamp": "%s"' % cached["timestamp"],
+            '"timestamp": "%s"' % ixf_export_timestamp(),
+            1,
+        )
+        return HttpResponse(content, content_type="application/json")
+
+    timestamp = ixf_export_timestamp()
+
+    def stream():
+        chunks = []
+        for chunk in iter_export_ixf_ix_members(
+            ixlans, pretty=pretty, timestamp=timestamp
+        ):
+            chunks.append(chunk)
+            yield chunk
+        cache.set(
+            key,
+            {"state": state, "timestamp": timestamp, "content": "".join(chunks)},
+            timeout,
+        )
+
+    return StreamingHttpResponse(stream(), content_type="application/json")
 
 
 def view_export_ixf_ix_members(request, ix_id):
-    return HttpResponse(
-        export_ixf_ix_members(
-            IXLan.objects.filter(ix_id=ix_id, status="ok"),
-            pretty="pretty" in request.GET,
-        ),
-        content_type="application/json",
+    return ixf_export_response(
+        IXLan.objects.filter(ix_id=ix_id, status="ok"),
+        pretty="pretty" in request.GET,
     )
 
 
 def view_export_ixf_ixlan_members(request, ixlan_id):
-    return HttpResponse(
-        export_ixf_ix_members(
-            IXLan.objects.filter(id=ixlan_id, status="ok"),
-            pretty="pretty" in request.GET,
-        ),
-        content_type="application/json",
+    return ixf_export_response(
+        IXLan.objects.filter(id=ixlan_id, status="ok"),
+        pretty="pretty" in request.GET,
     )
 
 
@@ -257,6 +399,11 @@ class AdvancedSearchExportView(ExportView):
 
         response = viewset(api_request)
 
+        # response was streamed from the api-cache
+
+        if response.streaming:
+            return json.loads(response.getvalue()).get("data")
+
         if response.data and "results" in response.data:
             return response.data.get("results")
 
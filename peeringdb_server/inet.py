@@ -4,7 +4,10 @@ RDAP lookup and validation.
 Network validation.
 
 Prefix renumbering.
+
+Prefix interval index.
 """
+import bisect
 import ipaddress
 
 import rdap
@@ -328,6 +331,78 @@ def renumber_ipaddress(ipaddr, old_prefix, new_prefix):
     return new_ip
 
 
+class PrefixIndex:
+    """
+    Interval index of ip prefixes that answers which prefixes contain
+    an ip address in O(log n).
+
+    Prefixes are kept as sorted integer start and end address arrays
+    per address family. Prefixes may be nested or duplicated.
+    """
+
+    def __init__(self, prefixes):
+        """
+        Arguments:
+            - prefixes (iterable): (prefix, value) tuples, prefix can be
+                an ipaddress.IPv4Network, ipaddress.IPv6Network or str
+        """
+
+        ranges = {4: [], 6: []}
+
+        for prefix, value in prefixes:
+            prefix = ipaddress.ip_network(prefix)
+            ranges[prefix.version].append(
+                (int(prefix.network_address), int(prefix.broadcast_address), value)
+            )
+
+        self.families = {}
+
+        for version, family in ranges.items():
+            family.sort(key=lambda item: (item[0], -item[1]))
+            starts, ends, max_ends, values = [], [], [], []
+            max_end = -1
+            for start, end, value in family:
+                max_end = max(max_end, end)
+                starts.append(start)
+                ends.append(end)
+                max_ends.append(max_end)
+                values.append(value)
+            self.families[version] = (starts, ends, max_ends, values)
+
+    def lookup(self, addr):
+        """
+        Returns the values of all prefixes containing the ip address,
+        most specific prefix first.
+
+        Arguments:
+            - addr (ipaddress.IPv4Address or ipaddress.IPv6Address or str)
+
+        Returns:
+            - list: empty if the address is not valid or not contained
+                in any of the prefixes
+        """
+
+        try:
+            addr = ipaddress.ip_address(addr)
+        except ValueError:
+            return []
+
+        starts, ends, max_ends, values = self.families[addr.version]
+        addr = int(addr)
+
+        # the prefixes starting at or before the address, walked back
+        # for as long as one of them can still reach the address
+
+        result = []
+        i = bisect.bisect_right(starts, addr) - 1
+        while i >= 0 and max_ends[i] >= addr:
+            if ends[i] >= addr:
+                result.append(values[i])
+            i -= 1
+
+        return result
+
+
 def get_client_ip(request):
     x_forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
     if x_forwarded_for:
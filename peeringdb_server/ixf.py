@@ -9,10 +9,15 @@ Handles notifications of networks and exchanges as part of that process.
 A substantial part of the import logic is handled through models.py::IXFMemberData
 """
 
+import codecs
 import datetime
+import hashlib
 import ipaddress
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from smtplib import SMTPException
+from urllib.parse import urlparse
 
 import requests
 import reversion
@@ -21,6 +26,7 @@ from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.mail.message import EmailMultiAlternatives
 from django.db import transaction
+from django.db.models import Count, Max
 from django.template import loader
 from django.utils.html import strip_tags
 from django.utils.translation import ugettext_lazy as _
@@ -34,6 +40,7 @@ from peeringdb_server.models import (
     IXLanIXFMemberImportAttempt,
     IXLanIXFMemberImportLog,
     IXLanIXFMemberImportLogEntry,
+    IXLanPrefix,
     Network,
     NetworkIXLan,
     NetworkProtocolsDisabled,
@@ -56,6 +63,145 @@ REASON_VALUES_CHANGED = _(
 )
 
 
+# size of the chunks ix-f member lists are read and parsed in
+IXF_STREAM_CHUNK_SIZE = 65536
+
+
+class JSONStreamReader:
+    """
+    Reads json values one at a time from an iterable of text chunks,
+    only keeping the unread part of the current chunks in memory.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.exhausted = False
+        self.decoder = json.JSONDecoder()
+
+    def read_more(self):
+        """
+        Append the next chunk to the buffer, returns False if there
+        are no more chunks.
+        """
+        if self.exhausted:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.exhausted = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Return the next non-whitespace character without consuming it,
+        or an empty string at the end of the stream.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read_more():
+                return ""
+
+    def expect(self, chars):
+        """
+        Consume and return the next non-whitespace character, raises
+        a ValueError if it is not one of `chars`.
+        """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of '{chars}' at '{char}'")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Read and return the next json value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+
+                # a value ending with the buffer may continue in the
+                # next chunk (numbers)
+                if end < len(self.buffer) or self.exhausted:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.exhausted:
+                    raise
+            self.read_more()
+
+
+def iter_json_object(chunks, stream_key):
+    """
+    Incrementally parse a json object from an iterable of text chunks.
+
+    Yields (key, value) for each of the object's keys, the items of the
+    array at `stream_key` are yielded one at a time as (stream_key, item)
+    as they are read.
+
+    Raises a ValueError if the data is not valid json.
+    """
+
+    reader = JSONStreamReader(chunks)
+    reader.expect("{")
+
+    if reader.peek() == "}":
+        reader.expect("}")
+    else:
+        while True:
+            key = reader.value()
+            if not isinstance(key, str):
+                raise ValueError("Object keys need to be strings")
+            reader.expect(":")
+
+            if key == stream_key:
+                reader.expect("[")
+                if reader.peek() == "]":
+                    reader.expect("]")
+                else:
+                    while True:
+                        yield key, reader.value()
+                        if reader.expect(",]") == "]":
+                            break
+            else:
+                yield key, reader.value()
+
+            if reader.expect(",}") == "}":
+                break
+
+    if reader.peek():
+        raise ValueError("Extra data")
+
+
+def freeze(value):
+    """
+    Returns a hashable copy of a parsed json value, dicts and lists
+    become tuples (dict keys keep their order).
+
+    Values that serialize to the same json are frozen to equal tuples.
+    Scalars are paired with their type, so `true`, `1` and `1.0` are
+    told apart as they are in json, floats are kept by their repr so
+    `0.0` and `-0.0` are as well.
+    """
+
+    if isinstance(value, dict):
+        return tuple((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return (list, tuple(freeze(item) for item in value))
+    if isinstance(value, float):
+        return (float, repr(value))
+    return (type(value), value)
+
+
 class MultipleVlansInPrefix(ValueError):
 
     """
@@ -165,6 +311,7 @@ class Importer:
             "noop": [],
         }
         self.pending_save = []
+        self.netixlan_versions = None
         self.deletions = {}
         self.asns = []
         self.ixlan = ixlan
@@ -192,31 +339,194 @@ class Importer:
             - timeout <float>: max time to spend on request
         """
 
+        data = self.fetch_remote(
+            url, timeout=timeout, validators=self.cached_validators(url)
+        )
+        self.cache_result(url, data)
+
+        if data.get("pdb_not_modified"):
+            return self.fetch_cached(url)
+
+        return data
+
+    def fetch_remote(self, url, timeout=5, validators=None):
+        """
+        Retrieve and sanitize ixf member export data from the url
+        without caching it.
+
+        This does not touch the database and is safe to call from
+        multiple threads.
+
+        If validators are passed, a conditional request is made and
+        `{"pdb_not_modified": True}` is returned if the remote data has
+        not changed.
+
+        The sha256 hash of the response body is stored in the returned
+        data as `pdb_content_hash` and the response's validators as
+        `pdb_validators`.
+
+        Arguments:
+            - url <str>
+
+        Keyword arguments:
+            - timeout <float>: max time to spend on request
+            - validators <dict>: `etag` and `last_modified` of the
+              locally cached data
+        """
+
         if not url:
             return {"pdb_error": _("IX-F import url not specified")}
 
+        headers = {}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
         try:
-            result = requests.get(url, timeout=timeout)
+            result = requests.get(url, timeout=timeout, headers=headers, stream=True)
         except Exception as exc:
             return {"pdb_error": exc}
 
-        if result.status_code != 200:
-            return {"pdb_error": f"Got HTTP status {result.status_code}"}
-
         try:
-            data = result.json()
-        except Exception:
-            data = {"pdb_error": _("No JSON could be parsed")}
-            return data
+            if result.status_code == 304 and headers:
+                return {"pdb_not_modified": True}
 
-        data = self.sanitize(data)
+            if result.status_code != 200:
+                return {"pdb_error": f"Got HTTP status {result.status_code}"}
 
-        # locally cache result
+            # the response is parsed as it is read, one member at a time,
+            # so the raw document is never held in memory as a whole
+            #
+            # the sanitized member list is, since it is cached and
+            # imported in one go, so memory use still grows with the
+            # size of the feed
+
+            content_hash = hashlib.sha256()
+            data = {}
+
+            def chunks():
+                decoder = codecs.getincrementaldecoder(result.encoding or "utf-8")()
+                for chunk in result.iter_content(chunk_size=IXF_STREAM_CHUNK_SIZE):
+                    content_hash.update(chunk)
+                    yield decoder.decode(chunk)
+                yield decoder.decode(b"", final=True)
+
+            def members():
+                for key, value in iter_json_object(chunks(), "member_list"):
+                    if key == "member_list":
+                        yield value
+                    else:
+                        data[key] = value
+
+            try:
+                member_list, invalid = self.sanitize_members(members())
+            except requests.RequestException as exc:
+                return {"pdb_error": exc}
+            except ValueError:
+                return {"pdb_error": _("No JSON could be parsed")}
+        finally:
+            result.close()
+
+        data["pdb_error"] = invalid
+        data["member_list"] = member_list
+        data["pdb_content_hash"] = content_hash.hexdigest()
+        data["pdb_validators"] = {
+            "etag": result.headers.get("ETag"),
+            "last_modified": result.headers.get("Last-Modified"),
+        }
+        return data
+
+    def cache_result(self, url, data):
+        """
+        Locally cache fetched ixf data if it is valid.
+
+        Returns whether or not the data was cached (or is already
+        cached, in case the remote data was not modified).
+        """
+
+        if data.get("pdb_not_modified"):
+            return True
+
+        validators = data.pop("pdb_validators", None)
 
         if data and not data.get("pdb_error"):
             cache.set(self.cache_key(url), data, timeout=None)
+            cache.set(self.validators_key(url), validators, timeout=None)
+            return True
+        return False
 
-        return data
+    def cached_validators(self, url):
+        """
+        Return the validators (`etag`, `last_modified`) of the locally
+        cached data for the url, or None if there is no cached data.
+        """
+
+        if not url or not cache.has_key(self.cache_key(url)):
+            return None
+        return cache.get(self.validators_key(url))
+
+    def fetch_all(self, urls, timeout=5, workers=8, max_per_host=2):
+        """
+        Retrieve ixf member export data from multiple urls concurrently
+        and cache the results.
+
+        The apply phase can then read successfully fetched data through
+        `fetch_cached`.
+
+        Arguments:
+            - urls <list>
+
+        Keyword arguments:
+            - timeout <float>: max time to spend on each request
+            - workers <int>: max number of concurrent requests
+            - max_per_host <int>: max number of concurrent requests to
+              the same host
+
+        Returns:
+            - dict: url -> fetched data, for urls whose data could not
+              be cached (fetch or validation errors)
+        """
+
+        urls = list(dict.fromkeys(url for url in urls if url))
+        host_limits = {
+            host: threading.BoundedSemaphore(max_per_host)
+            for host in {urlparse(url).netloc for url in urls}
+        }
+
+        validators = {url: self.cached_validators(url) for url in urls}
+
+        def fetch(url):
+            with host_limits[urlparse(url).netloc]:
+                return self.fetch_remote(
+                    url, timeout=timeout, validators=validators[url]
+                )
+
+        failed = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {executor.submit(fetch, url): url for url in urls}
+
+            # cache writes happen in this thread, as the cache is
+            # database backed
+            #
+            # completed futures are dropped once their data is cached,
+            # so only the feeds that have not been cached yet are held
+            # in memory
+
+            for future in as_completed(futures):
+                url = futures.pop(future)
+                try:
+                    data = future.result()
+                except Exception as exc:
+                    data = {"pdb_error": exc}
+                del future
+                if not self.cache_result(url, data):
+                    failed[url] = data
+                del data
+
+        return failed
 
     def cache_key(self, url):
         """
@@ -229,6 +539,18 @@ class Importer:
 
         return f"IXF-CACHE-{url}"
 
+    def validators_key(self, url):
+        """
+        Return the django cache key to use for caching the http
+        validators of the ix-f data.
+
+        Argument:
+
+            url <str>
+        """
+
+        return f"IXF-VALIDATORS-{url}"
+
     def fetch_cached(self, url):
         """
         Return locally cached IX-F data.
@@ -295,7 +617,63 @@ class Importer:
 
         return cxns_that_match
 
+    def connection_key(self, connection):
+        """
+        Return a hashable key for the connection, connections match
+        (see `connections_match`) if their keys are equal.
+        """
+        return (
+            connection.get("state", "undefined"),
+            tuple(self.get_if_speed_list(connection)),
+        )
+
     def match_vlans_across_connections(self, connection_list):
+        """
+        Move vlans that only have an ipv4 or ipv6 address into an earlier
+        matching connection (see `connections_match`) that has a lone vlan
+        for the other protocol with the same vlan id.
+
+        Candidate vlans are indexed by connection key, vlan id and the
+        protocols they have set, so each lone vlan is paired through hash
+        lookups instead of scanning all remaining connections.
+        """
+
+        # (connection key, vlan id, has ipv4, has ipv6) -> candidate vlans
+        # as (connection index, position, vlan) in feed order
+
+        candidates = {}
+        for i, connection in enumerate(connection_list):
+            key = self.connection_key(connection)
+            for position, vlan in enumerate(connection.get("vlan_list", [])):
+                bucket = (
+                    key,
+                    vlan.get("vlan_id", 0),
+                    bool(vlan.get("ipv4")),
+                    bool(vlan.get("ipv6")),
+                )
+                candidates.setdefault(bucket, []).append((i, position, vlan))
+
+        # index of the next candidate to consider in each bucket
+        heads = {}
+        moved = set()
+
+        def next_candidate(bucket, i):
+            """
+            Return the first candidate in the bucket that is part of a
+            connection after `i` and has not been moved yet.
+            """
+            items = candidates.get(bucket, [])
+            head = heads.get(bucket, 0)
+            while head < len(items):
+                index, position, vlan = items[head]
+                if index > i and id(vlan) not in moved:
+                    break
+                head += 1
+            heads[bucket] = head
+            if head < len(items):
+                return items[head]
+            return None
+
         modified_connection_list = []
 
         for i, connection in enumerate(connection_list):
@@ -307,7 +685,6 @@ class Importer:
             if len(connection.get("vlan_list", [])) == 0:
                 continue
 
-            remaining_connections = connection_list[i + 1 :]
             vlans_needing_pair = self.find_vlan_needing_pair(connection)
             # If there aren't any vlans that need to be paired,
             # we're done looking at this connection
@@ -315,24 +692,37 @@ class Importer:
                 modified_connection_list.append(connection)
                 continue
 
-            cxns_that_match = self.find_connections_that_match(
-                connection, remaining_connections
-            )
-            # If there aren't any connections we could match up,
-            # we're done looking at this connection
-            if cxns_that_match is None:
-                modified_connection_list.append(connection)
-                continue
+            key = self.connection_key(connection)
 
-            # If we have vlans we want to match, and
-            # at least one connection we can look for
-            # start looking
             for lone_vlan in vlans_needing_pair:
-                matching_vlan = self.find_matching_vlan(lone_vlan, cxns_that_match)
-                # if we found one we need to transfer it
-                if matching_vlan is not None:
-                    # matching vlan goes into connection vlan_list
-                    connection["vlan_list"].append(matching_vlan)
+                vlan_id = lone_vlan.get("vlan_id", 0)
+
+                # a lone ipv4 vlan pairs with a vlan that has no ipv4
+                # address and vice versa
+                pair_ipv4 = not lone_vlan.get("ipv4")
+                found = [
+                    candidate
+                    for candidate in (
+                        next_candidate((key, vlan_id, pair_ipv4, not pair_ipv4), i),
+                        next_candidate((key, vlan_id, False, False), i),
+                    )
+                    if candidate
+                ]
+                if not found:
+                    continue
+
+                # first match in connection order, then vlan list order
+                index, _, matching_vlan = min(found, key=lambda c: c[:2])
+                moved.add(id(matching_vlan))
+
+                # matching vlan gets moved from the other connection
+                # into this connection's vlan_list
+                vlan_list = connection_list[index]["vlan_list"]
+                for position, vlan in enumerate(vlan_list):
+                    if vlan is matching_vlan:
+                        vlan_list.pop(position)
+                        break
+                connection["vlan_list"].append(matching_vlan)
 
             modified_connection_list.append(connection)
         return modified_connection_list
@@ -431,17 +821,42 @@ class Importer:
         Take ixf data dict and run sanitization on it.
         """
 
+        member_list, invalid = self.sanitize_members(data.get("member_list", []))
+
+        data["pdb_error"] = invalid
+
+        # set member_list to the sanitized copy
+        data["member_list"] = member_list
+
+        return data
+
+    def sanitize_members(self, members):
+        """
+        Dedupe and sanitize ixf member list entries.
+
+        Members are processed one at a time as they are read from the
+        iterable, so it can be a generator reading from a stream. The
+        sanitized member list is returned as a whole.
+
+        Returns a tuple of the sanitized member list and the error
+        message for the data if it is invalid (None otherwise).
+        """
+
         invalid = None
         ipv4_addresses = {}
         ipv6_addresses = {}
+        member_list = []
 
-        # dedupe identical entries in member list
-        member_list = [json.dumps(m) for m in data.get("member_list", [])]
-        member_list = [json.loads(m) for m in set(member_list)]
+        # members seen so far, to dedupe identical entries in member list
+        seen = set()
 
-        # This fixes instances where ixps provide two separate entries for
-        # vlans in vlan_list for ipv4 and ipv6 (AMS-IX for example)
-        for member in member_list:
+        for member in members:
+
+            key = freeze(member)
+            if key in seen:
+                continue
+            seen.add(key)
+            member_list.append(member)
 
             # handle `null` properties inside connection list
 
@@ -461,6 +876,8 @@ class Importer:
 
             asn = member.get("asnum")
 
+            # This fixes instances where ixps provide two separate entries for
+            # vlans in vlan_list for ipv4 and ipv6 (AMS-IX for example)
             connection_list = self.match_vlans_across_connections(
                 member.get("connection_list", [])
             )
@@ -495,12 +912,8 @@ class Importer:
                     break
 
                 ipv6_addresses[ipv6] = ixf_id
-        data["pdb_error"] = invalid
-
-        # set member_list to the sanitized copy
-        data["member_list"] = member_list
 
-        return data
+        return member_list, invalid
 
     def update(self, ixlan, save=True, data=None, timeout=5, asn=None):
         """
@@ -542,6 +955,22 @@ class Importer:
         if self.skip_import:
             return True
 
+        # skip the import if neither the ix-f data nor the database state
+        # relevant to it changed since the last successful import
+
+        if not ixlan.ixf_ixp_import_error:
+            import_state = self.import_state(data)
+            if import_state and import_state == cache.get(self.import_state_key()):
+                if save:
+                    self.update_ix(net_count=ixlan.ix.ixf_net_count)
+                    IXLanIXFMemberImportAttempt.objects.filter(ixlan=ixlan).update(
+                        updated=self.now
+                    )
+                    IXFMemberData.objects.filter(ixlan=ixlan).update(
+                        fetched=self.now
+                    )
+                return True
+
         try:
             # parse the ixf data
             self.parse(data)
@@ -608,9 +1037,60 @@ class Importer:
 
             self.save_log()
 
+            import_state = self.import_state(data)
+            if import_state:
+                cache.set(self.import_state_key(), import_state, timeout=None)
+
         return True
 
-    def update_ix(self):
+    def import_state_key(self):
+        """
+        Return the django cache key to use for storing the state
+        of the last successful import of the current ixlan.
+        """
+
+        return f"IXF-IMPORT-STATE-{self.ixlan.id}"
+
+    def import_state(self, data):
+        """
+        Return a fingerprint of the ix-f data and of the database state
+        that affects the import of it into the current ixlan.
+
+        Returns None if the import of the data should never be skipped,
+        e.g., because it was not fetched remotely or only a single
+        asn is processed.
+
+        Arguments:
+            - data <dict>: result from fetch()
+        """
+
+        content_hash = data.get("pdb_content_hash")
+
+        if (
+            not content_hash
+            or not self.save
+            or self.asn
+            or not settings.IXF_SKIP_UNCHANGED_IMPORTS
+        ):
+            return None
+
+        asns = {member.get("asnum") for member in data.get("member_list", [])}
+        stats = {"count": Count("id"), "updated": Max("updated")}
+
+        state = [
+            content_hash,
+            self.ixlan.updated,
+            NetworkIXLan.objects.filter(ixlan=self.ixlan).aggregate(**stats),
+            IXFMemberData.objects.filter(ixlan=self.ixlan).aggregate(**stats),
+            self.ixlan.ixpfx_set.aggregate(**stats),
+            Network.objects.filter(asn__in=asns).aggregate(**stats),
+        ]
+
+        return hashlib.sha256(
+            json.dumps(state, default=str, sort_keys=True).encode()
+        ).hexdigest()
+
+    def update_ix(self, net_count=None):
 
         """
         Determine if any data was changed during this import
@@ -619,6 +1099,10 @@ class Importer:
 
         Set the ixf_net_count value if it has changed
         from before.
+
+        Keyword Arguments:
+            - net_count (int): the ixf_net_count to set, defaults to
+              the number of netixlans processed during this import
         """
 
         ix = self.ixlan.ix
@@ -633,7 +1117,9 @@ class Importer:
 
         ix.ixf_last_import = self.now
 
-        ixf_net_count = len(self.pending_save)
+        ixf_net_count = net_count
+        if ixf_net_count is None:
+            ixf_net_count = len(self.pending_save)
         if ixf_net_count != ix.ixf_net_count:
             ix.ixf_net_count = ixf_net_count
 
@@ -682,9 +1168,22 @@ class Importer:
     def process_saves(self):
         reversion.set_user(self.ticket_user)
 
+        self.preload_versions()
+
+        # ix-f member data that only needs its data refreshed
+        # is written in bulk once all the changes are applied
+
+        deferred_saves = {}
+
         for ixf_member in self.pending_save:
+            ixf_member.deferred_saves = deferred_saves
             self.apply_add_or_update(ixf_member)
 
+        for ixf_member in self.pending_save:
+            ixf_member.deferred_saves = None
+
+        IXFMemberData.bulk_save_without_update(list(deferred_saves.values()))
+
     @reversion.create_revision()
     @transaction.atomic()
     def process_deletions(self):
@@ -699,6 +1198,8 @@ class Importer:
 
         reversion.set_user(self.ticket_user)
 
+        self.preload_versions()
+
         netixlan_qset = self.ixlan.netixlan_set_active
 
         # if we are only processing a specific asn ignore
@@ -740,6 +1241,59 @@ class Importer:
                         self.queue_notification(ixf_member_data, "remove")
                     self.log_ixf_member_data(ixf_member_data)
 
+    def preload_versions(self):
+        """
+        Load the most recent version of every netixlan on the ixlan
+        in one query, so `log_apply` does not need to look up the
+        version of each netixlan it logs a change for.
+
+        Needs to be called inside the revision of the changes, as
+        versions are only written once the revision block exits.
+        """
+
+        ids = [
+            str(netixlan_id)
+            for netixlan_id in NetworkIXLan.handleref.filter(
+                ixlan=self.ixlan
+            ).values_list("id", flat=True)
+        ]
+
+        self.netixlan_versions = {int(netixlan_id): None for netixlan_id in ids}
+
+        versions = reversion.models.Version.objects.get_for_model(
+            NetworkIXLan
+        ).filter(object_id__in=ids)
+
+        latest = (
+            versions.order_by().values("object_id").annotate(latest=Max("id"))
+        )
+
+        for version in reversion.models.Version.objects.filter(
+            id__in=latest.values("latest")
+        ):
+            self.netixlan_versions[int(version.object_id)] = version
+
+    def version_before(self, netixlan):
+        """
+        Return the most recent version of the netixlan before it was
+        changed by the current revision.
+        """
+
+        if not netixlan.id:
+            return None
+
+        if self.netixlan_versions is not None:
+            if netixlan.id in self.netixlan_versions:
+                return self.netixlan_versions[netixlan.id]
+
+            # netixlans created during the current revision do not have
+            # a version yet
+
+            if netixlan.ixlan_id == self.ixlan.id:
+                return None
+
+        return reversion.models.Version.objects.get_for_object(netixlan).first()
+
     def cleanup_ixf_member_data(self):
 
         if not self.save:
@@ -800,19 +1354,29 @@ class Importer:
             return
 
         persist_log = IXLanIXFMemberImportLog.objects.create(ixlan=self.ixlan)
+        versions = self.versions_after()
+        entries = []
+
         for action in ["delete", "modify", "add"]:
             for info in self.actions_taken[action]:
 
                 netixlan = info["netixlan"]
                 version_before = info["version"]
 
-                versions = reversion.models.Version.objects.get_for_object(netixlan)
+                # the version following `version_before` or, if the netixlan
+                # did not have a version yet, its most recent version
+
+                candidates = versions.get(netixlan.id, [])
 
                 if version_before:
-                    versions = versions.filter(id__gt=version_before.id)
-                    version_after = versions.last()
+                    candidates = [
+                        version
+                        for version in candidates
+                        if version.id > version_before.id
+                    ]
+                    version_after = candidates[0] if candidates else None
                 else:
-                    version_after = versions.first()
+                    version_after = candidates[-1] if candidates else None
 
                 if not version_after:
                     continue
@@ -822,14 +1386,57 @@ class Importer:
                     "ixf", action, netixlan, version_before, version_after, **info
                 )
 
-                persist_log.entries.create(
-                    netixlan=netixlan,
-                    version_before=version_before,
-                    action=action,
-                    reason=info.get("reason"),
-                    version_after=version_after,
+                entries.append(
+                    IXLanIXFMemberImportLogEntry(
+                        log=persist_log,
+                        netixlan=netixlan,
+                        version_before=version_before,
+                        action=action,
+                        reason=info.get("reason"),
+                        version_after=version_after,
+                    )
                 )
 
+        IXLanIXFMemberImportLogEntry.objects.bulk_create(entries, batch_size=500)
+
+    def versions_after(self):
+        """
+        Return the versions of the netixlans changed by the import
+        that are more recent than their version before the change,
+        as a dict of netixlan id to list of versions ordered by id.
+        """
+
+        versions = {}
+        netixlan_ids = set()
+        min_version_id = None
+
+        for action in ["delete", "modify", "add"]:
+            for info in self.actions_taken[action]:
+                netixlan_ids.add(str(info["netixlan"].id))
+                if info["version"] and (
+                    min_version_id is None or info["version"].id < min_version_id
+                ):
+                    min_version_id = info["version"].id
+
+        if not netixlan_ids:
+            return versions
+
+        # a netixlan without a version before the import only has versions
+        # created by the import, which are more recent than any version
+        # that existed before it
+
+        qset = reversion.models.Version.objects.get_for_model(NetworkIXLan).filter(
+            object_id__in=netixlan_ids
+        )
+
+        if min_version_id is not None:
+            qset = qset.filter(id__gt=min_version_id)
+
+        for version in qset.order_by("id"):
+            versions.setdefault(int(version.object_id), []).append(version)
+
+        return versions
+
     def parse(self, data):
         """
         Parse ixf data.
@@ -840,6 +1447,39 @@ class Importer:
         with transaction.atomic():
             self.parse_members(data.get("member_list", []))
 
+    def preload(self, member_list):
+        """
+        Load the networks and IX-F member data referenced by the
+        member list in bulk, as well as the prefix index (checked
+        against its version stamp), so parsing the members does not
+        need to query them one by one.
+
+        Arguments:
+            - member_list <list>
+        """
+
+        asns = {member["asnum"] for member in member_list}
+        if self.asn:
+            asns &= {self.asn}
+
+        self.networks = {
+            network.asn: network for network in Network.objects.filter(asn__in=asns)
+        }
+
+        self.ixf_member_data = {asn: [] for asn in asns}
+        for ixf_member_data in IXFMemberData.objects.filter(asn__in=asns):
+            self.ixf_member_data[ixf_member_data.asn].append(ixf_member_data)
+
+        self.prefix_index = IXLanPrefix.index(recheck=True)
+
+    def address_in_prefixes(self, addr):
+        """
+        Test that the address falls into one of the ixlan's active
+        prefixes (using the prefix index loaded by `preload`).
+        """
+
+        return self.ixlan.test_ip_address(addr, index=self.prefix_index)
+
     def parse_members(self, member_list):
         """
         Parse the `member_list` section of the ixf schema.
@@ -847,6 +1487,9 @@ class Importer:
         Arguments:
             - member_list <list>
         """
+
+        self.preload(member_list)
+
         for member in member_list:
             asn = member["asnum"]
 
@@ -859,8 +1502,8 @@ class Importer:
             if asn not in self.asns:
                 self.asns.append(asn)
 
-            if Network.objects.filter(asn=asn).exists():
-                network = Network.objects.get(asn=asn)
+            network = self.networks.get(asn)
+            if network:
                 if network.status != "ok":
                     self.log_peer(
                         asn,
@@ -969,8 +1612,8 @@ class Importer:
                 )
                 continue
 
-            ipv4_valid_for_ixlan = self.ixlan.test_ipv4_address(ipv4_addr)
-            ipv6_valid_for_ixlan = self.ixlan.test_ipv6_address(ipv6_addr)
+            ipv4_valid_for_ixlan = self.address_in_prefixes(ipv4_addr)
+            ipv6_valid_for_ixlan = self.address_in_prefixes(ipv6_addr)
 
             if (
                 ipv4_addr
@@ -1034,6 +1677,8 @@ class Importer:
                         ixlan=self.ixlan,
                         save=False,
                         validate_network_protocols=False,
+                        net=network,
+                        preloaded=self.ixf_member_data[asn],
                     ),
                     "protocol-conflict",
                     ac=False,
@@ -1082,6 +1727,8 @@ class Importer:
                     data=json.dumps(member),
                     ixlan=self.ixlan,
                     save=self.save,
+                    net=network,
+                    preloaded=self.ixf_member_data[asn],
                 )
 
                 if not ixf_member_data.ipaddr4 and not ixf_member_data.ipaddr6:
@@ -1313,9 +1960,7 @@ class Importer:
         self.actions_taken[apply_result["action"]].append(
             {
                 "netixlan": netixlan,
-                "version": reversion.models.Version.objects.get_for_object(
-                    netixlan
-                ).first(),
+                "version": self.version_before(netixlan),
                 "reason": reason,
             }
         )
@@ -2,17 +2,29 @@
 Regen the api cache files.
 """
 import datetime
+import json
+import multiprocessing
 import os
 import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Count, Max
+from django.utils import timezone
 from rest_framework.test import APIRequestFactory
 
 import peeringdb_server.models as pdbm
 import peeringdb_server.rest as pdbr
-from peeringdb_server.renderers import MetaJSONRenderer
+from peeringdb_server.api_cache import (
+    APICacheIndex,
+    write_cache_file,
+    write_compressed_variants,
+)
+from peeringdb_server.permissions import APIPermissionsApplicator
 
 MODELS = [
     pdbm.Organization,
@@ -39,9 +51,101 @@ VIEWSETS = {
     "poc": pdbr.NetworkContactViewSet,
 }
 
+# tags whose changes can affect the rendered rows of a tag at depth 0 and 1
+# (relations and object counts), at higher depths any change is considered
+# relevant
+
+RELATED_TAGS = {
+    "org": ["net", "ix", "fac"],
+    "net": ["org", "netfac", "netixlan", "poc"],
+    "ix": ["org", "ixlan", "ixfac", "ixpfx", "netixlan"],
+    "fac": ["org", "netfac", "ixfac"],
+    "ixlan": ["ix", "ixpfx", "netixlan"],
+    "ixfac": ["ix", "fac"],
+    "ixpfx": ["ixlan"],
+    "netfac": ["net", "fac"],
+    "netixlan": ["net", "ixlan", "ix"],
+    "poc": ["net"],
+}
+
+DEPTHS = [0, 1, 2, 3]
+
 settings.DEBUG = False
 
 
+def render_cache_file(tag, depth, dtstr):
+    """
+    Render the api-cache file for the specified tag and depth and
+    write it (with its row offset index and compressed variants) to the
+    api-cache directory.
+
+    The files are written to temporary files first and then moved into
+    place, so readers never see a partially written cache file.
+
+    Returns the number of rows written.
+    """
+
+    rf = APIRequestFactory()
+    su = pdbm.User.objects.filter(is_superuser=True).first()
+
+    if depth:
+        req = rf.get("/api/%s?depth=%d&updated__lte=%s&_ctf" % (tag, depth, dtstr))
+    else:
+        req = rf.get(f"/api/{tag}?updated__lte={dtstr}&_ctf")
+    req.user = su
+    vs = VIEWSETS[tag].as_view({"get": "list"})
+    res = vs(req)
+
+    path = os.path.join(settings.API_CACHE_ROOT, f"{tag}-{depth}.json")
+    index_path = APICacheIndex.index_path(path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    tmp_index_path = f"{index_path}.{os.getpid()}.tmp"
+
+    tmp_paths = [tmp_path, tmp_index_path]
+
+    try:
+        with open(tmp_path, "wb") as output:
+            rows = (row for row in res.data if row is not None)
+            index = write_cache_file(output, rows)
+        with open(tmp_index_path, "wb") as output:
+            index.write(output)
+
+        # pre-compressed variants of the response as served to anonymous
+        # users, the cache file is about to be moved into place unchanged
+        # so its mtime is the `generated` timestamp the response will have
+
+        applicator = APIPermissionsApplicator(AnonymousUser())
+        applicator.drop_namespace_key = True
+        meta = {"generated": os.path.getmtime(tmp_path)}
+        variants = write_compressed_variants(tmp_path, tmp_path, applicator, meta)
+        tmp_paths.extend(variants)
+
+        os.replace(tmp_index_path, index_path)
+        os.replace(tmp_path, path)
+
+        # variants are moved into place after the cache file, the loader
+        # ignores variants older than the cache file
+
+        for variant in variants:
+            os.replace(variant, path + variant[len(tmp_path) :])
+    finally:
+        for _path in tmp_paths:
+            if os.path.exists(_path):
+                os.remove(_path)
+
+    return len(index.offsets)
+
+
+def _render_cache_file_worker(tag, depth, dtstr):
+    """
+    Process pool entry point for `render_cache_file`.
+    """
+    try:
+        return render_cache_file(tag, depth, dtstr)
+    finally:
+        connections.close_all()
+
+
 class Command(BaseCommand):
     help = "Regen the api cache files"
 
@@ -55,6 +159,17 @@ class Command(BaseCommand):
             default=None,
             help="generate cache for objects create before or at the specified date (YYYYMMDD)",
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="number of processes to render cache files in",
+        )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="only regenerate cache files whose underlying objects changed since the last run",
+        )
 
     def log(self, id, msg):
         if self.log_file:
@@ -65,9 +180,67 @@ class Command(BaseCommand):
     def row_datetime(self, row, field="created"):
         return datetime.datetime.strptime(row.get(field), "%Y-%m-%dT%H:%M:%SZ")
 
+    @property
+    def state_path(self):
+        return os.path.join(settings.API_CACHE_ROOT, "state.json")
+
+    def load_state(self):
+        """
+        Return the object state recorded during the last run.
+        """
+        try:
+            with open(self.state_path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(state, fh)
+        os.replace(tmp_path, self.state_path)
+
+    def collect_state(self, cutoff):
+        """
+        Return the number of objects and the latest `updated` timestamp
+        for each tag, considering only objects updated at or before
+        `cutoff`, the same objects the cache files are rendered from.
+
+        Soft-deletes are picked up through `updated`, hard-deletes through
+        the number of objects.
+        """
+        state = {}
+        for tag, viewset in VIEWSETS.items():
+            stats = viewset.model.objects.filter(updated__lte=cutoff).aggregate(
+                count=Count("id"), updated=Max("updated")
+            )
+            state[tag] = [
+                stats["count"],
+                stats["updated"].isoformat() if stats["updated"] else None,
+            ]
+        return state
+
+    def needs_update(self, tag, depth, changed):
+        """
+        Check if the cache file for the specified tag and depth needs
+        to be regenerated for the specified set of changed tags.
+        """
+
+        if not os.path.exists(
+            os.path.join(settings.API_CACHE_ROOT, f"{tag}-{depth}.json")
+        ):
+            return True
+
+        if depth > 1:
+            return bool(changed)
+
+        return tag in changed or bool(changed.intersection(RELATED_TAGS[tag]))
+
     def handle(self, *args, **options):
         only = options.get("only", None)
         date = options.get("date", None)
+        workers = options.get("workers") or 1
+        incremental = options.get("incremental", False)
 
         # temporary setting to indicate api-cache is being generated
         # this forced api responses to be generated without permission
@@ -79,19 +252,16 @@ class Command(BaseCommand):
 
         if date:
             dt = datetime.datetime.strptime(date, "%Y%m%d")
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
         else:
-            dt = datetime.datetime.now()
+            dt = timezone.now().replace(microsecond=0)
         dtstr = dt.strftime("%Y-%m-%dT%H:%M:%SZ")
         self.log_file = open(settings.API_CACHE_LOG, "w+")
         self.log("info", "Regnerating cache files to '%s'" % settings.API_CACHE_ROOT)
         self.log("info", "Caching data for timestamp: %s" % dtstr)
-        rf = APIRequestFactory()
-        renderer = MetaJSONRenderer()
 
         t = time.time()
 
-        su = pdbm.User.objects.filter(is_superuser=True).first()
-
         settings.API_DEPTH_ROW_LIMIT = 0
 
         # will be using RequestFactory to spawn requests to generate api-cache
@@ -100,36 +270,45 @@ class Command(BaseCommand):
         settings.CSRF_USE_SESSIONS = False
 
         try:
-            cache = {}
+            # objects updated after the cutoff are left out of both the
+            # state and the cache files, so the next incremental run
+            # picks them up
+
+            state = self.collect_state(dt)
+
+            if incremental:
+                last_state = self.load_state()
+                changed = {
+                    tag for tag in VIEWSETS if state[tag] != last_state.get(tag)
+                }
+                self.log("info", "Changed since last run: %s" % sorted(changed))
+            else:
+                changed = set(VIEWSETS.keys())
 
-            for tag, viewset in list(VIEWSETS.items()):
+            jobs = []
+            for tag in VIEWSETS.keys():
                 if only and tag not in only:
                     continue
 
-                for depth in [0, 1, 2, 3]:
+                for depth in DEPTHS:
+                    if incremental and not self.needs_update(tag, depth, changed):
+                        self.log(tag, "depth %d unchanged, skipping" % depth)
+                        continue
+                    jobs.append((tag, depth))
+
+            if workers > 1:
+                self.render_parallel(jobs, dtstr, workers)
+            else:
+                for tag, depth in jobs:
                     self.log(tag, "generating depth %d" % depth)
-                    if depth:
-                        req = rf.get(
-                            "/api/%s?depth=%d&updated__lte=%s&_ctf"
-                            % (tag, depth, dtstr)
-                        )
-                    else:
-                        req = rf.get(f"/api/{tag}?updated__lte={dtstr}&_ctf")
-                    req.user = su
-                    vs = viewset.as_view({"get": "list"})
-                    res = vs(req)
-                    cache[f"{tag}-{depth}"] = renderer.render(
-                        res.data, renderer_context={"response": res}
-                    )
-                    del res
-                    del vs
-
-            for id, data in list(cache.items()):
-                self.log(id, "saving file")
-                with open(
-                    os.path.join(settings.API_CACHE_ROOT, "%s.json" % (id)), "w+"
-                ) as output:
-                    output.write(data)
+                    count = render_cache_file(tag, depth, dtstr)
+                    self.log(f"{tag}-{depth}", "saved %d rows" % count)
+
+            # only record the state once the cache reflects all tags,
+            # otherwise the next incremental run could skip changes
+
+            if not only:
+                self.save_state(state)
 
         except Exception:
             self.log("error", traceback.format_exc())
@@ -138,3 +317,27 @@ class Command(BaseCommand):
         t2 = time.time()
 
         print("Finished after %.2f seconds" % (t2 - t))
+
+    def render_parallel(self, jobs, dtstr, workers):
+        """
+        Render the cache files for the specified (tag, depth) jobs
+        in a process pool.
+
+        Database connections are closed before the workers are forked
+        so each worker opens its own connection.
+        """
+
+        connections.close_all()
+
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            futures = {}
+            for tag, depth in jobs:
+                self.log(tag, "generating depth %d" % depth)
+                future = executor.submit(_render_cache_file_worker, tag, depth, dtstr)
+                futures[future] = (tag, depth)
+
+            for future in as_completed(futures):
+                tag, depth = futures[future]
+                self.log(f"{tag}-{depth}", "saved %d rows" % future.result())
@@ -0,0 +1,259 @@
+"""
+Micro-benchmarks for hot code paths.
+"""
+import copy
+import ipaddress
+import json
+import pickle
+import random
+import time
+import timeit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory
+
+import peeringdb_server.models as pdbm
+import peeringdb_server.renderers as pdbrenderers
+import peeringdb_server.rest as pdbr
+from peeringdb_server import ixf
+from peeringdb_server.throttle_storage import LocalThrottleStorage
+
+# query parameter sets used to benchmark the filter translation
+
+FILTER_PLAN_PARAMS = [
+    ("net", pdbr.NetworkViewSet, ("asn", "depth")),
+    ("net", pdbr.NetworkViewSet, ("info_type", "status", "name__contains")),
+    ("fac", pdbr.FacilityViewSet, ("country", "state", "city", "limit", "skip")),
+    ("netixlan", pdbr.NetworkIXLanViewSet, ("net_id", "ixlan_id__in", "speed__gt")),
+    ("ix", pdbr.InternetExchangeViewSet, ("org_id", "updated__gte", "fields")),
+]
+
+
+def synthetic_ixf_member_list(members, connections, seed=0):
+    """
+    Return a random IX-F member list with the specified number of members
+    and connections per member, with vlans split across connections
+    in the various ways seen in real feeds.
+    """
+
+    rng = random.Random(seed)
+    member_list = []
+    address = 0
+
+    for asn in range(members):
+        connection_list = []
+        for _ in range(connections):
+            vlan_list = []
+            for _ in range(rng.randint(1, 3)):
+                address += 1
+                vlan = {"vlan_id": rng.choice([0, 100, 200])}
+                protocols = rng.choice(["ipv4", "ipv6", "both", "both", "none"])
+                if protocols in ["ipv4", "both"]:
+                    vlan["ipv4"] = {"address": str(ipaddress.ip_address(address))}
+                if protocols in ["ipv6", "both"]:
+                    vlan["ipv6"] = {"address": f"2001:db8::{address:x}"}
+                vlan_list.append(vlan)
+            connection_list.append(
+                {
+                    "state": rng.choice(["active", "active", "inactive"]),
+                    "if_list": [
+                        {"if_speed": rng.choice([1000, 10000, 100000])}
+                        for _ in range(rng.randint(1, 2))
+                    ],
+                    "vlan_list": vlan_list,
+                }
+            )
+        member_list.append({"asnum": 64512 + asn, "connection_list": connection_list})
+
+    return member_list
+
+
+def match_vlans_across_connections_reference(importer, connection_list):
+    """
+    Reference implementation of `Importer.match_vlans_across_connections`
+    that compares each connection against all remaining connections.
+    """
+
+    modified_connection_list = []
+
+    for i, connection in enumerate(connection_list):
+        if len(connection.get("vlan_list", [])) == 0:
+            continue
+
+        remaining_connections = connection_list[i + 1 :]
+        vlans_needing_pair = importer.find_vlan_needing_pair(connection)
+        if vlans_needing_pair is None:
+            modified_connection_list.append(connection)
+            continue
+
+        cxns_that_match = importer.find_connections_that_match(
+            connection, remaining_connections
+        )
+        if cxns_that_match is None:
+            modified_connection_list.append(connection)
+            continue
+
+        for lone_vlan in vlans_needing_pair:
+            matching_vlan = importer.find_matching_vlan(lone_vlan, cxns_that_match)
+            if matching_vlan is not None:
+                connection["vlan_list"].append(matching_vlan)
+
+        modified_connection_list.append(connection)
+    return modified_connection_list
+
+
+class Command(BaseCommand):
+    help = "Run micro-benchmarks for hot code paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--only",
+            action="store",
+            default=False,
+            help="only run specified benchmarks (comma separated)",
+        )
+        parser.add_argument(
+            "--number",
+            type=int,
+            default=10000,
+            help="number of iterations per measurement",
+        )
+
+    def log(self, id, msg):
+        print(f"{id}: {msg}")
+
+    def measure(self, fn, number):
+        """
+        Returns the best per call time of `fn` in microseconds
+        """
+        return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1000000
+
+    def handle(self, *args, **options):
+        only = options.get("only")
+        number = options.get("number")
+
+        if only:
+            only = only.split(",")
+
+        for name in ["filter_plan", "renderer", "ixf_sanitize", "throttle"]:
+            if only and name not in only:
+                continue
+            getattr(self, f"bench_{name}")(number)
+
+    def bench_filter_plan(self, number):
+        """
+        Per request cost of translating list query parameters into
+        orm filters, uncached vs. memoized
+        """
+
+        uncached = pdbr.compile_filter_plan.__wrapped__
+
+        for tag, viewset, params in FILTER_PLAN_PARAMS:
+            before = self.measure(lambda: uncached(viewset, params), number)
+            pdbr.compile_filter_plan(viewset, params)
+            after = self.measure(
+                lambda: pdbr.compile_filter_plan(viewset, params), number
+            )
+            self.log(
+                "filter_plan",
+                f"{tag} {','.join(params)}: {before:.2f}us -> {after:.2f}us",
+            )
+
+    def bench_renderer(self, number):
+        """
+        Time to serialize a depth 2 `net` result set to json
+        with each of the json backends
+        """
+
+        settings.API_CACHE_ENABLED = False
+        settings.API_DEPTH_ROW_LIMIT = 0
+
+        # requests are spawned with RequestFactory and are not session-enabled
+        settings.CSRF_USE_SESSIONS = False
+
+        request = APIRequestFactory().get("/api/net?depth=2")
+        request.user = pdbm.User.objects.filter(is_superuser=True).first()
+        data = {
+            "data": pdbr.NetworkViewSet.as_view({"get": "list"})(request).data,
+            "meta": {},
+        }
+
+        if not data["data"]:
+            self.log("renderer", "no networks in the database, skipping")
+            return
+
+        number = max(1, number // 1000)
+
+        for backend, dumps in pdbrenderers.JSON_BACKENDS.items():
+            if backend == "orjson" and not pdbrenderers.orjson:
+                self.log("renderer", "orjson not installed, skipping")
+                continue
+            size = len(dumps(data))
+            took = self.measure(lambda: dumps(data), number) / 1000
+            self.log(
+                "renderer",
+                f"{backend}: {len(data['data'])} rows, {size} bytes, {took:.2f}ms",
+            )
+
+    def bench_ixf_sanitize(self, number):
+        """
+        Time to pair vlans across the connections of a synthetic
+        5000 connection IX-F feed, reference vs. indexed implementation,
+        and to sanitize the whole feed
+        """
+
+        importer = ixf.Importer()
+        member_list = synthetic_ixf_member_list(10, 500)
+        number = max(1, number // 10000)
+
+        def timed(fn):
+            took = []
+            for _ in range(number):
+                data = copy.deepcopy(member_list)
+                t = time.perf_counter()
+                result = [fn(member["connection_list"]) for member in data]
+                took.append(time.perf_counter() - t)
+            return result, min(took) * 1000
+
+        expected, before = timed(
+            lambda cxns: match_vlans_across_connections_reference(importer, cxns)
+        )
+        result, after = timed(importer.match_vlans_across_connections)
+
+        if json.dumps(result) != json.dumps(expected):
+            raise AssertionError("vlan pairing output differs from reference")
+
+        self.log("ixf_sanitize", f"match vlans: {before:.2f}ms -> {after:.2f}ms")
+
+        data = {"member_list": copy.deepcopy(member_list)}
+        t = time.perf_counter()
+        importer.sanitize(data)
+        took = (time.perf_counter() - t) * 1000
+        self.log("ixf_sanitize", f"sanitize: {took:.2f}ms")
+
+    def bench_throttle(self, number):
+        """
+        Per request cost and stored state size of the throttle
+        algorithms for a client at a 1000/minute rate limit
+        """
+
+        limit, duration = 1000, 60
+
+        for algorithm in ["sliding_log", "sliding_window"]:
+            storage = LocalThrottleStorage()
+            clock = iter(range(number * 3 + limit))
+
+            if algorithm == "sliding_log":
+                hit = storage.hit
+            else:
+                hit = storage.count
+
+            for _ in range(limit):
+                hit("key", next(clock) / limit, duration, limit)
+
+            took = self.measure(
+                lambda: hit("key", next(clock) / limit, duration, limit), number
+            )
+            size = len(pickle.dumps(storage.windows["key"][1]))
+            self.log("throttle", f"{algorithm}: {took:.2f}us, {size} bytes")
@@ -1,13 +1,16 @@
 """
 Run the IX-F Importer.
 """
+import io
 import json
+import multiprocessing
 import sys
 import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connections, transaction
 
 from peeringdb_server import ixf
 from peeringdb_server.models import (
@@ -20,6 +23,30 @@ from peeringdb_server.models import (
 )
 
 
+def _import_ixlan_worker(options, ixlan_id, asn, data, process_requested):
+    """
+    Process pool entry point for `Command.import_ixlan`.
+
+    Returns the import log and notifications along with the command
+    output and runtime errors collected in the worker.
+    """
+
+    command = Command(stdout=io.StringIO())
+    command.stderr = command.stdout
+    command.runtime_errors = []
+    for name, value in options.items():
+        setattr(command, name, value)
+
+    try:
+        ixlan = IXLan.objects.get(id=ixlan_id)
+        log, notifications = command.import_ixlan(
+            ixlan, asn, data, process_requested
+        )
+        return log, notifications, command.stdout.getvalue(), command.runtime_errors
+    finally:
+        connections.close_all()
+
+
 class Command(BaseCommand):
     help = "Updates netixlan instances for all ixlans that have their ixf_ixp_member_list_url specified"
     commit = False
@@ -48,6 +75,19 @@ class Command(BaseCommand):
         parser.add_argument(
             "--cache", action="store_true", help="Only use locally cached IX-F data"
         )
+        parser.add_argument(
+            "--fetch-workers",
+            type=int,
+            default=None,
+            help="Number of IX-F member lists to fetch concurrently (defaults to IXF_FETCH_WORKERS)",
+            dest="fetch_workers",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of processes to import ixlans in",
+        )
         parser.add_argument(
             "--skip-import",
             action="store_true",
@@ -194,12 +234,151 @@ class Command(BaseCommand):
         resent_emails = importer.resend_emails()
         self.log(f"RE-SENT EMAILS: {len(resent_emails)}.")
 
+    def fetch_all(self, ixlans):
+        """
+        Fetch the IX-F member lists of the specified ixlans concurrently
+        and cache them.
+
+        Returns a dict of url -> data for urls that could not be cached
+        (errors), to be passed to `Importer.update` as is.
+        """
+
+        for ixlan in ixlans:
+            self.log(
+                "Fetching data for -ixlan{} from {}".format(
+                    ixlan.id, ixlan.ixf_ixp_member_list_url
+                )
+            )
+
+        return ixf.Importer().fetch_all(
+            [ixlan.ixf_ixp_member_list_url for ixlan in ixlans],
+            timeout=settings.IXF_FETCH_TIMEOUT,
+            workers=self.fetch_workers,
+            max_per_host=settings.IXF_FETCH_MAX_PER_HOST,
+        )
+
+    def import_ixlan(self, ixlan, asn, data, process_requested):
+        """
+        Run the import for the specified ixlan in its own transaction.
+
+        Returns a tuple of the import log (errors prefixed with the
+        exchange) and the notifications queued by the importer.
+        """
+
+        log = {"data": [], "errors": []}
+        notifications = []
+
+        try:
+            importer = ixf.Importer()
+            importer.skip_import = self.skip_import
+            importer.cache_only = True
+            self.log(f"Processing {ixlan.ix.name} ({ixlan.id})")
+            success = None
+            with transaction.atomic():
+                success = importer.update(
+                    ixlan,
+                    save=self.commit,
+                    asn=asn,
+                    data=data,
+                    timeout=settings.IXF_FETCH_TIMEOUT,
+                )
+            self.log(json.dumps(importer.log), debug=True)
+            self.log(
+                "Success: {}, added: {}, updated: {}, deleted: {}".format(
+                    success,
+                    len(importer.actions_taken["add"]),
+                    len(importer.actions_taken["modify"]),
+                    len(importer.actions_taken["delete"]),
+                )
+            )
+            log["data"].extend(importer.log["data"])
+            log["errors"].extend(
+                [
+                    f"{ixlan.ix.name}({ixlan.id}): {err}"
+                    for err in importer.log["errors"]
+                ]
+            )
+            notifications = importer.notifications
+
+        except Exception as inst:
+            self.store_runtime_error(inst, ixlan=ixlan)
+        finally:
+            if process_requested:
+                if success:
+                    ixlan.ix.ixf_import_request_status = "finished"
+                else:
+                    ixlan.ix.ixf_import_request_status = "error"
+                ixlan.ix.save_without_timestamp()
+
+        return log, notifications
+
+    def import_parallel(self, ixlans, asn, fetch_failed, process_requested):
+        """
+        Run the imports for the specified ixlans in a process pool,
+        one ixlan per job.
+
+        Database connections are closed before the workers are forked
+        so each worker opens its own connection.
+
+        Yields the import log and notifications of each ixlan as
+        they complete, output and runtime errors of the workers are
+        passed on to this command. A job that fails is recorded as a
+        runtime error of its ixlan and does not stop the other imports.
+        """
+
+        options = {
+            "commit": self.commit,
+            "debug": self.debug,
+            "preview": self.preview,
+            "skip_import": self.skip_import,
+        }
+
+        connections.close_all()
+
+        with ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            futures = {}
+            for ixlan in ixlans:
+                data = fetch_failed.get(ixlan.ixf_ixp_member_list_url)
+
+                # fetch errors can hold exceptions that cannot be pickled
+                if data and data.get("pdb_error"):
+                    data = dict(data, pdb_error=f"{data['pdb_error']}")
+
+                future = executor.submit(
+                    _import_ixlan_worker,
+                    options,
+                    ixlan.id,
+                    asn,
+                    data,
+                    process_requested,
+                )
+                futures[future] = ixlan
+
+            for future in as_completed(futures):
+                try:
+                    log, notifications, output, runtime_errors = future.result()
+                except Exception as inst:
+                    ixlan = futures[future]
+                    self.store_runtime_error(inst, ixlan=ixlan)
+                    if process_requested:
+                        ixlan.ix.ixf_import_request_status = "error"
+                        ixlan.ix.save_without_timestamp()
+                    continue
+
+                self.stdout.write(output, ending="")
+                self.runtime_errors.extend(runtime_errors)
+                yield log, notifications
+
     def handle(self, *args, **options):
         self.commit = options.get("commit", False)
         self.debug = options.get("debug", False)
         self.preview = options.get("preview", False)
         self.cache = options.get("cache", False)
         self.skip_import = options.get("skip_import", False)
+        self.fetch_workers = options.get("fetch_workers") or settings.IXF_FETCH_WORKERS
+        self.workers = options.get("workers") or 1
         process_requested = options.get("process_requested", None)
         ixlan_ids = options.get("ixlan")
         asn = options.get("asn", 0)
@@ -260,54 +439,36 @@ class Command(BaseCommand):
             if ixlan_ids:
                 qset = qset.filter(id__in=ixlan_ids)
 
-        total_log = {"data": [], "errors": []}
-        total_notifications = []
-        for ixlan in qset:
-            self.log(
-                "Fetching data for -ixlan{} from {}".format(
-                    ixlan.id, ixlan.ixf_ixp_member_list_url
-                )
+        ixlans = list(qset)
+
+        # fetch all member lists concurrently into the IX-F cache, the
+        # import below then reads them from there
+
+        fetch_failed = {}
+        if not self.cache:
+            fetch_failed = self.fetch_all(ixlans)
+
+        if self.workers > 1:
+            results = self.import_parallel(
+                ixlans, asn, fetch_failed, process_requested is not None
             )
-            try:
-                importer = ixf.Importer()
-                importer.skip_import = self.skip_import
-                importer.cache_only = self.cache
-                self.log(f"Processing {ixlan.ix.name} ({ixlan.id})")
-                success = None
-                with transaction.atomic():
-                    success = importer.update(
-                        ixlan,
-                        save=self.commit,
-                        asn=asn,
-                        timeout=settings.IXF_FETCH_TIMEOUT,
-                    )
-                self.log(json.dumps(importer.log), debug=True)
-                self.log(
-                    "Success: {}, added: {}, updated: {}, deleted: {}".format(
-                        success,
-                        len(importer.actions_taken["add"]),
-                        len(importer.actions_taken["modify"]),
-                        len(importer.actions_taken["delete"]),
-                    )
-                )
-                total_log["data"].extend(importer.log["data"])
-                total_log["errors"].extend(
-                    [
-                        f"{ixlan.ix.name}({ixlan.id}): {err}"
-                        for err in importer.log["errors"]
-                    ]
+        else:
+            results = (
+                self.import_ixlan(
+                    ixlan,
+                    asn,
+                    fetch_failed.get(ixlan.ixf_ixp_member_list_url),
+                    process_requested is not None,
                 )
-                total_notifications += importer.notifications
-
-            except Exception as inst:
-                self.store_runtime_error(inst, ixlan=ixlan)
-            finally:
-                if process_requested is not None:
-                    if success:
-                        ixlan.ix.ixf_import_request_status = "finished"
-                    else:
-                        ixlan.ix.ixf_import_request_status = "error"
-                    ixlan.ix.save_without_timestamp()
+                for ixlan in ixlans
+            )
+
+        total_log = {"data": [], "errors": []}
+        total_notifications = []
+        for log, notifications in results:
+            total_log["data"].extend(log["data"])
+            total_log["errors"].extend(log["errors"])
+            total_notifications += notifications
 
         if self.preview:
             self.stdout.write(json.dumps(total_log, indent=2))
@@ -13,8 +13,8 @@ from django.urls import reverse
 from django.utils.deprecation import MiddlewareMixin
 
 from peeringdb_server.context import current_request
-from peeringdb_server.models import OrganizationAPIKey, UserAPIKey
-from peeringdb_server.permissions import get_key_from_request
+from peeringdb_server.models import OrganizationAPIKey
+from peeringdb_server.permissions import get_api_key_from_request, get_key_from_request
 
 ERR_MULTI_AUTH = "Cannot authenticate through Authorization header while logged in. Please log out and try again."
 
@@ -204,17 +204,7 @@ class PDBPermissionMiddleware(MiddlewareMixin):
 
         # Check API keys
         if req_key:
-            try:
-                api_key = OrganizationAPIKey.objects.get_from_key(req_key)
-
-            except OrganizationAPIKey.DoesNotExist:
-                pass
-
-            try:
-                api_key = UserAPIKey.objects.get_from_key(req_key)
-
-            except UserAPIKey.DoesNotExist:
-                pass
+            api_key = get_api_key_from_request(request)
 
             # If api key is not valid return 401 Unauthorized
             if not api_key:
@@ -23,6 +23,7 @@ Please open a merge request in peeringdb/django-peeringdb for the field addition
 """
 
 
+import copy
 import datetime
 import ipaddress
 import json
@@ -67,7 +68,8 @@ from passlib.hash import sha256_crypt
 from rest_framework_api_key.models import AbstractAPIKey
 
 import peeringdb_server.geo as geo
-from peeringdb_server.inet import RdapLookup, RdapNotFoundError
+from peeringdb_server.inet import PrefixIndex, RdapLookup, RdapNotFoundError
+from peeringdb_server.process_cache import VersionedProcessCache
 from peeringdb_server.request import bypass_validation
 from peeringdb_server.validators import (
     validate_address_space,
@@ -1722,6 +1724,26 @@ class Facility(ProtectedMixin, pdb_models.FacilityBase, GeocodeBaseMixin):
         q = InternetExchangeFacility.handleref.filter(**filt)
         return qset.exclude(id__in=[i.facility_id for i in q])
 
+    @classmethod
+    def org_presence(cls, org_list):
+        """
+        Returns a filter expression matching Facility objects that
+        any of the organizations specified in `org_list` have a presence
+        at, either through a network (netfac) or an exchange (ixfac).
+
+        Used in Advanced Search (org_present / org_not_present).
+        """
+
+        return models.Exists(
+            NetworkFacility.objects.filter(
+                facility_id=models.OuterRef("id"), network__org_id__in=org_list
+            )
+        ) | models.Exists(
+            InternetExchangeFacility.objects.filter(
+                facility_id=models.OuterRef("id"), ix__org_id__in=org_list
+            )
+        )
+
     @classmethod
     def overlapping_asns(cls, asns, qset=None):
         """
@@ -1740,8 +1762,6 @@ class Facility(ProtectedMixin, pdb_models.FacilityBase, GeocodeBaseMixin):
             - Facility QuerySet
         """
 
-        facilities = {}
-        shared_facilities = []
         count = len(asns)
 
         if count == 1:
@@ -1750,24 +1770,19 @@ class Facility(ProtectedMixin, pdb_models.FacilityBase, GeocodeBaseMixin):
         if count > 25:
             raise ValidationError(_("Can only compare a maximum of 25 asns"))
 
-        # fist we need to collect all active facilities related to any
-        # of the specified asns
-        for asn in asns:
-            for netfac in NetworkFacility.objects.filter(
-                network__asn=asn, status="ok"
-            ).select_related("network"):
-                if netfac.facility_id not in facilities:
-                    facilities[netfac.facility_id] = {}
-                facilities[netfac.facility_id][asn] = True
-
-        # then we check for the facilities that have all of the asns
-        # peering by comparing the counts of collected asns at each
-        # facility with the count of asns provided
-        for fac_id, collected_asns in list(facilities.items()):
-            if len(list(collected_asns.keys())) == count:
-                shared_facilities.append(fac_id)
+        # facilities that have all of the asns present, by comparing
+        # the number of distinct asns among the active netfacs at
+        # each facility with the number of asns provided
+        shared_facilities = (
+            NetworkFacility.objects.filter(network__asn__in=asns, status="ok")
+            .order_by()
+            .values("facility_id")
+            .annotate(asn_count=models.Count("network__asn", distinct=True))
+            .filter(asn_count=count)
+            .values("facility_id")
+        )
 
-        if not qset:
+        if qset is None:
             qset = cls.handleref.undeleted()
 
         return qset.filter(id__in=shared_facilities)
@@ -2105,14 +2120,33 @@ class InternetExchange(ProtectedMixin, pdb_models.InternetExchangeBase):
         Relationship  through ixlan -> ixpfx
         """
 
-        if not qset:
+        if qset is None:
             qset = cls.handleref.undeleted()
 
-        q = IXLanPrefix.objects.select_related("ixlan").filter(
-            prefix__startswith=ipblock
-        )
+        q = IXLanPrefix.objects.filter(prefix__startswith=ipblock)
 
-        return qset.filter(id__in=[pfx.ixlan.ix_id for pfx in q])
+        return qset.filter(id__in=q.values("ixlan__ix_id"))
+
+    @classmethod
+    def org_presence(cls, org_list):
+        """
+        Returns a filter expression matching InternetExchange objects
+        that any of the organizations specified in `org_list` have a
+        presence at, either through a network (netixlan) or a facility
+        (ixfac).
+
+        Used in Advanced Search (org_present / org_not_present).
+        """
+
+        return models.Exists(
+            NetworkIXLan.objects.filter(
+                ixlan__ix_id=models.OuterRef("id"), network__org_id__in=org_list
+            )
+        ) | models.Exists(
+            InternetExchangeFacility.objects.filter(
+                ix_id=models.OuterRef("id"), facility__org_id__in=org_list
+            )
+        )
 
     @classmethod
     def overlapping_asns(cls, asns, qset=None):
@@ -2132,8 +2166,6 @@ class InternetExchange(ProtectedMixin, pdb_models.InternetExchangeBase):
             - InternetExchange QuerySet
         """
 
-        exchanges = {}
-        shared_exchanges = []
         count = len(asns)
 
         if count == 1:
@@ -2142,24 +2174,19 @@ class InternetExchange(ProtectedMixin, pdb_models.InternetExchangeBase):
         if count > 25:
             raise ValidationError(_("Can only compare a maximum of 25 asns"))
 
-        # fist we need to collect all active exchanges related to any
-        # of the specified asns
-        for asn in asns:
-            for netixlan in NetworkIXLan.objects.filter(
-                network__asn=asn, status="ok"
-            ).select_related("network", "ixlan"):
-                if netixlan.ixlan.ix_id not in exchanges:
-                    exchanges[netixlan.ixlan.ix_id] = {}
-                exchanges[netixlan.ixlan.ix_id][asn] = True
-
-        # then we check for the exchanges that have all of the asns
-        # peering by comparing the counts of collected asns at each
-        # exchange with the count of asns provided
-        for ix_id, collected_asns in list(exchanges.items()):
-            if len(list(collected_asns.keys())) == count:
-                shared_exchanges.append(ix_id)
+        # exchanges that have all of the asns peering, by comparing
+        # the number of distinct asns among the active netixlans at
+        # each exchange with the number of asns provided
+        shared_exchanges = (
+            NetworkIXLan.objects.filter(network__asn__in=asns, status="ok")
+            .order_by()
+            .values("ixlan__ix_id")
+            .annotate(asn_count=models.Count("network__asn", distinct=True))
+            .filter(asn_count=count)
+            .values("ixlan__ix_id")
+        )
 
-        if not qset:
+        if qset is None:
             qset = cls.handleref.undeleted()
 
         return qset.filter(id__in=shared_exchanges)
@@ -2677,19 +2704,35 @@ class IXLan(pdb_models.IXLanBase):
         """
         Test that the ipv4 a exists in one of the prefixes in this ixlan.
         """
-        for pfx in self.ixpfx_set_active:
-            if pfx.test_ip_address(ipv4):
-                return True
-        return False
+        return self.test_ip_address(ipv4)
 
     def test_ipv6_address(self, ipv6):
         """
         Test that the ipv6 address exists in one of the prefixes in this ixlan.
         """
-        for pfx in self.ixpfx_set_active:
-            if pfx.test_ip_address(ipv6):
-                return True
-        return False
+        return self.test_ip_address(ipv6)
+
+    def test_ip_address(self, addr, index=None):
+        """
+        Test that the ip address exists in one of the active prefixes
+        in this ixlan.
+
+        Arguments:
+            - addr (ipaddress.IPv4Address or ipaddress.IPv6Address or str)
+
+        Keyword Arguments:
+            - index (PrefixIndex): prefix index as returned by
+                `IXLanPrefix.index`, if not specified the index is
+                checked against its version stamp and used
+        """
+
+        if index is None:
+            index = IXLanPrefix.index(recheck=True)
+
+        return any(
+            ixlan_id == self.id and status == "ok"
+            for _, ixlan_id, status in index.lookup(addr)
+        )
 
     def clean(self):
         # id is set and does not match the parent ix id
@@ -3141,6 +3184,11 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
         "is_rs_peer",
     ]
 
+    # when set to a dict, `save_without_update` will queue the
+    # instance in it (by id) instead of writing it to the database
+
+    deferred_saves = None
+
     class Meta:
         db_table = "peeringdb_ixf_member_data"
         verbose_name = _("IX-F Member Data")
@@ -3150,14 +3198,18 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
         tag = "ixfmember"
 
     @classmethod
-    def id_filters(cls, asn, ipaddr4, ipaddr6, check_protocols=True):
+    def id_filters(cls, asn, ipaddr4, ipaddr6, check_protocols=True, net=None):
         """
         Returns a dict of filters to use with a
         IXFMemberData or NetworkIXLan query set
         to retrieve a unique entry.
+
+        The network with the specified asn can be passed as `net`
+        to avoid looking it up.
         """
 
-        net = Network.objects.get(asn=asn)
+        if net is None:
+            net = Network.objects.get(asn=asn)
 
         ipv4_support = net.ipv4_support or not check_protocols
         ipv6_support = net.ipv6_support or not check_protocols
@@ -3194,21 +3246,35 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
         - speed(int=0) : network speed (mbit)
         - operational(bool=True): peer is operational
         - is_rs_peer(bool=False): peer is route server
+        - net(Network): the network with the specified asn, looked
+          up if not specified
+        - preloaded(list): all IXFMemberData objects with the specified
+          asn, queried if not specified
         """
 
         fetched = datetime.datetime.now().replace(tzinfo=UTC())
-        net = Network.objects.get(asn=asn)
+        net = kwargs.get("net") or Network.objects.get(asn=asn)
         validate_network_protocols = kwargs.get("validate_network_protocols", True)
         for_deletion = kwargs.get("delete", False)
+        preloaded = kwargs.get("preloaded")
 
         try:
-            id_filters = cls.id_filters(asn, ipaddr4, ipaddr6)
-            instances = cls.objects.filter(**id_filters)
+            id_filters = cls.id_filters(asn, ipaddr4, ipaddr6, net=net)
+
+            if preloaded is not None:
+                # copies, as each call needs to work on its own instance
+                instances = [
+                    copy.copy(instance)
+                    for instance in preloaded
+                    if instance.matches_id_filters(id_filters)
+                ]
+            else:
+                instances = list(cls.objects.filter(**id_filters))
 
-            if not instances.exists():
+            if not instances:
                 raise cls.DoesNotExist()
 
-            if instances.count() > 1:
+            if len(instances) > 1:
 
                 # this only happens when a network switches on/off
                 # ipv4/ipv6 protocol support inbetween importer
@@ -3216,11 +3282,15 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
 
                 for instance in instances:
                     if ipaddr4 != instance.ipaddr4 or ipaddr6 != instance.ipaddr6:
+                        if preloaded is not None:
+                            preloaded[:] = [
+                                other for other in preloaded if other.id != instance.id
+                            ]
                         instance.delete(hard=True)
 
                 instance = cls.objects.get(**id_filters)
             else:
-                instance = instances.first()
+                instance = instances[0]
 
             for field in cls.data_fields:
                 setattr(instance, f"previous_{field}", getattr(instance, field))
@@ -3257,6 +3327,7 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
         instance.ixlan = ixlan
         instance.fetched = fetched
         instance.for_deletion = for_deletion
+        instance._net = net
 
         if ipaddr4:
             instance.init_ipaddr4 = ipaddress.ip_address(ipaddr4)
@@ -3273,6 +3344,28 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
 
         return instance
 
+    def matches_id_filters(self, id_filters):
+        """
+        Returns whether or not this entry matches the
+        filters returned by `id_filters`.
+        """
+
+        for key, value in id_filters.items():
+            if key.endswith("__isnull"):
+                if (getattr(self, key[: -len("__isnull")]) is None) != value:
+                    return False
+            elif key == "asn":
+                if self.asn != value:
+                    return False
+            else:
+                field_value = getattr(self, key)
+                if field_value is None or ipaddress.ip_address(
+                    field_value
+                ) != ipaddress.ip_address(value):
+                    return False
+
+        return True
+
     @classmethod
     def get_for_network(cls, net):
         """
@@ -3835,10 +3928,16 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
             try:
                 if self.for_deletion:
                     filters = self.id_filters(
-                        self.asn, self.ipaddr4, self.ipaddr6, check_protocols=False
+                        self.asn,
+                        self.ipaddr4,
+                        self.ipaddr6,
+                        check_protocols=False,
+                        net=self.net,
                     )
                 else:
-                    filters = self.id_filters(self.asn, self.ipaddr4, self.ipaddr6)
+                    filters = self.id_filters(
+                        self.asn, self.ipaddr4, self.ipaddr6, net=self.net
+                    )
 
                 if "ipaddr6" not in filters and "ipaddr4" not in filters:
                     raise NetworkIXLan.DoesNotExist()
@@ -4011,10 +4110,28 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
                 raise ValidationError(error_data)
 
     def save_without_update(self):
+        if self.deferred_saves is not None and self.id:
+            self.deferred_saves[self.id] = self
+            return
+
         self._meta.get_field("updated").auto_now = False
         self.save()
         self._meta.get_field("updated").auto_now = True
 
+    @classmethod
+    def bulk_save_without_update(cls, instances, batch_size=500):
+        """
+        Persist all fields of the specified IXFMemberData instances
+        without touching their `updated` timestamp, in bulk.
+        """
+
+        fields = [
+            field.name
+            for field in cls._meta.concrete_fields
+            if not field.primary_key and field.name != "created"
+        ]
+        cls.objects.bulk_update(instances, fields, batch_size=batch_size)
+
     def grab_validation_errors(self):
         """
         This will attempt to validate the netixlan associated
@@ -4207,6 +4324,11 @@ class IXFMemberData(pdb_models.NetworkIXLanBase):
 # validate could check
 
 
+# in-process prefix index, see `IXLanPrefix.index`
+
+IXPFX_INDEX = VersionedProcessCache("IXPFX-INDEX-VERSION", "IXPFX_INDEX_CACHE_TIMEOUT")
+
+
 @grainy_model(
     namespace="prefix",
     namespace_instance="{instance.ixlan.grainy_namespace}.{namespace}.{instance.pk}",
@@ -4225,6 +4347,10 @@ class IXLanPrefix(ProtectedMixin, pdb_models.IXLanPrefixBase):
 
     in_dfz = models.BooleanField(default=True)
 
+    # cache key of the version stamp bumped on every write, see `index`
+
+    index_version_cache_key = IXPFX_INDEX.version_key
+
     @property
     def descriptive_name(self):
         """
@@ -4255,16 +4381,46 @@ class IXLanPrefix(ProtectedMixin, pdb_models.IXLanPrefixBase):
         if not qset:
             qset = cls.handleref.undeleted()
 
-        ids = []
-
         ipaddr = ipaddress.ip_address(ipaddr)
 
-        for ixpfx in qset:
-            if ipaddr in ixpfx.prefix:
-                ids.append(ixpfx.id)
+        ids = [ixpfx_id for ixpfx_id, _, _ in cls.index().lookup(ipaddr)]
 
         return qset.filter(id__in=ids)
 
+    @classmethod
+    def index(cls, recheck=False):
+        """
+        Returns a `PrefixIndex` of all prefixes, regardless of status,
+        with (ixpfx id, ixlan id, status) tuples as values.
+
+        The index is kept in memory, see `IXPFX_INDEX`. It can lag
+        behind writes made by other processes for up to
+        IXPFX_INDEX_CACHE_TIMEOUT seconds, unless `recheck` is True,
+        in which case it is checked against its version stamp first.
+        Address validation passes `recheck`.
+
+        Keyword Arguments:
+            - recheck (bool)
+        """
+
+        def build():
+            rows = cls.handleref.values_list("id", "ixlan_id", "status", "prefix")
+            return PrefixIndex(
+                (prefix, (ixpfx_id, ixlan_id, status))
+                for ixpfx_id, ixlan_id, status, prefix in rows
+            )
+
+        return IXPFX_INDEX.get(build, recheck=recheck)
+
+    @classmethod
+    def invalidate_index(cls):
+        """
+        Drop the in-process prefix index so it is rebuilt, in other
+        processes once the current transaction commits.
+        """
+
+        IXPFX_INDEX.invalidate()
+
     def __str__(self):
         return f"{self.prefix}"
 
@@ -5349,9 +5505,10 @@ class User(AbstractBaseUser, PermissionsMixin):
         )
 
     @property
-    def organizations(self):
+    def organization_ids(self):
         """
-        Returns all organizations this user is a member or admin of.
+        Returns the ids of all organizations this user is a member or admin
+        of, regardless of the organization's status.
         """
         ids = []
         for group in self.groups.all():
@@ -5359,6 +5516,14 @@ class User(AbstractBaseUser, PermissionsMixin):
             if m and int(m.group(1)) not in ids:
                 ids.append(int(m.group(1)))
 
+        return ids
+
+    @property
+    def organizations(self):
+        """
+        Returns all organizations this user is a member or admin of.
+        """
+        ids = self.organization_ids
         return [org for org in Organization.objects.filter(id__in=ids, status="ok")]
 
     @property
@@ -5834,6 +5999,14 @@ class CommandLineTool(models.Model):
         self.status = "running"
 
 
+# in-process snapshot of the environment setting overrides, see
+# `EnvironmentSetting.snapshot`
+
+ENV_SETTINGS = VersionedProcessCache(
+    "ENV-SETTINGS-VERSION", "ENV_SETTINGS_CACHE_TIMEOUT"
+)
+
+
 class EnvironmentSetting(models.Model):
 
     """
@@ -5841,6 +6014,11 @@ class EnvironmentSetting(models.Model):
     django admin (/cp).
     """
 
+    # cache key of the version stamp that is bumped whenever a
+    # setting is written
+
+    version_cache_key = ENV_SETTINGS.version_key
+
     class Meta:
         db_table = "peeringdb_settings"
         verbose_name = _("Environment Setting")
@@ -6053,11 +6231,31 @@ class EnvironmentSetting(models.Model):
         If no instance has been saved for the specified setting
         the default value will be returned.
         """
-        try:
-            instance = cls.objects.get(setting=setting)
-            return instance.value
-        except cls.DoesNotExist:
-            return getattr(settings, setting)
+        values = cls.snapshot()
+        if setting in values:
+            return values[setting]
+        return getattr(settings, setting)
+
+    @classmethod
+    def snapshot(cls):
+        """
+        Returns a dict of the values of all saved settings.
+
+        The values are kept in memory, see `ENV_SETTINGS`.
+        """
+
+        return ENV_SETTINGS.get(
+            lambda: {instance.setting: instance.value for instance in cls.objects.all()}
+        )
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Drop the in-process snapshot so it is reloaded, in other
+        processes once the current transaction commits.
+        """
+
+        ENV_SETTINGS.invalidate()
 
     @classmethod
     def validate_value(cls, setting, value):
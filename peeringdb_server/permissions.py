@@ -10,10 +10,15 @@ Determine permission holder from request (api key or user).
 Read only user api key handling.
 
 Censor API output data according to permissions using grainy Applicators.
+
+Compiled permission sets are cached per permission holder in process memory
+and invalidated when permissions, groups or group memberships change.
 """
 
 
 # from django_grainy.rest import ModelViewSetPermissions, PermissionDenied
+import hashlib
+
 import grainy.const as grainy_constant
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
@@ -21,11 +26,41 @@ from django_grainy.helpers import request_method_to_flag
 
 # from django_grainy.const import *
 from django_grainy.util import Permissions
-from grainy.core import NamespaceKeyApplicator
+from grainy.core import NamespaceKeyApplicator, PermissionSet
 from rest_framework.permissions import BasePermission
 from rest_framework_api_key.permissions import KeyParser
 
-from peeringdb_server.models import Group, OrganizationAPIKey, User, UserAPIKey
+from peeringdb_server.models import (
+    Group,
+    Organization,
+    OrganizationAPIKey,
+    User,
+    UserAPIKey,
+)
+from peeringdb_server.process_cache import VersionedProcessCache
+
+# compiled permission sets per permission holder, see `compiled_permission_sets`
+
+PERMISSION_SETS = VersionedProcessCache(
+    "PERMISSION-SETS-VERSION", "PERMISSION_SETS_CACHE_TIMEOUT"
+)
+
+# drop all compiled permission sets once this many are cached
+
+PERMISSION_SETS_MAX_ENTRIES = 10000
+
+# cache key of the version stamp that is bumped whenever permissions change
+
+PERMISSION_SETS_VERSION_KEY = PERMISSION_SETS.version_key
+
+# hashed key of api keys by digest of the keys that have been verified
+# against them, see `verify_api_key`
+
+VERIFIED_API_KEYS = {}
+
+# drop all verified api keys once this many are cached
+
+VERIFIED_API_KEYS_MAX_ENTRIES = 10000
 
 
 def validate_rdap_user_or_key(request, rdap):
@@ -52,31 +87,71 @@ def get_key_from_request(request):
     return KeyParser().get(request)
 
 
-def get_permission_holder_from_request(request):
-    """Return either an API Key instance or User instance
-    depending on how the request is Authenticated.
+def verify_api_key(model, key):
     """
+    Return the usable api key of `model` (OrganizationAPIKey or UserAPIKey)
+    for the key presented by the client.
 
-    if hasattr(request, "_permission_holder"):
-        return request._permission_holder
+    Works like `get_from_key`, but remembers successful verifications so
+    the password hasher only runs the first time a key is presented to
+    this process. Revoked keys are never returned.
+
+    Raises `model.DoesNotExist` if the key is not valid.
+    """
+
+    prefix, _, _ = key.partition(".")
+    api_key = model.objects.get_usable_keys().get(prefix=prefix)
+
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    if VERIFIED_API_KEYS.get(digest) != api_key.hashed_key:
+        if not api_key.is_valid(key):
+            raise model.DoesNotExist("Key is not valid.")
+        if len(VERIFIED_API_KEYS) >= VERIFIED_API_KEYS_MAX_ENTRIES:
+            VERIFIED_API_KEYS.clear()
+        VERIFIED_API_KEYS[digest] = api_key.hashed_key
+
+    return api_key
+
+
+def get_api_key_from_request(request):
+    """Return the OrganizationAPIKey or UserAPIKey instance the
+    request was made with, None if the request was not made with
+    a valid api key.
+
+    The key is resolved once per request.
+    """
+
+    if hasattr(request, "_api_key"):
+        return request._api_key
 
     key = get_key_from_request(request)
+    api_key = None
+
     if key is not None:
-        try:
-            api_key = OrganizationAPIKey.objects.get_from_key(key)
-            request._permission_holder = api_key
-            return api_key
+        for model in [OrganizationAPIKey, UserAPIKey]:
+            try:
+                api_key = verify_api_key(model, key)
+                break
+            except model.DoesNotExist:
+                pass
 
-        except OrganizationAPIKey.DoesNotExist:
-            pass
+    request._api_key = api_key
+    return api_key
 
-        try:
-            api_key = UserAPIKey.objects.get_from_key(key)
-            request._permission_holder = api_key
-            return api_key
 
-        except UserAPIKey.DoesNotExist:
-            pass
+def get_permission_holder_from_request(request):
+    """Return either an API Key instance or User instance
+    depending on how the request is Authenticated.
+    """
+
+    if hasattr(request, "_permission_holder"):
+        return request._permission_holder
+
+    api_key = get_api_key_from_request(request)
+    if api_key is not None:
+        request._permission_holder = api_key
+        return api_key
 
     if hasattr(request, "user"):
         request._permission_holder = request.user
@@ -153,24 +228,115 @@ def check_permissions(obj, target, permissions, **kwargs):
     return obj._permissions_util.check(target, permissions, **kwargs)
 
 
+class CachedPermissions(Permissions):
+    """
+    Permissions util initialized with an already compiled
+    permission set instead of loading it from the database
+    """
+
+    def __init__(self, obj, pset):
+        self.cached_pset = pset
+        super().__init__(obj)
+
+    def load(self, refresh=False):
+        if refresh:
+            return super().load(refresh=True)
+
+        if not self.loaded:
+            self.pset = self.cached_pset
+            self.loaded = True
+
+
+def permission_holder_key(obj):
+    """
+    Returns the key compiled permission sets of the permission
+    holder are cached under, None if they should not be cached
+    """
+
+    if isinstance(obj, UserAPIKey):
+        return ("user", obj.user_id, bool(obj.readonly))
+    if isinstance(obj, OrganizationAPIKey):
+        return ("org-key", obj.id)
+    if isinstance(obj, User):
+        return ("user", obj.id, False)
+    if isinstance(obj, AnonymousUser):
+        return ("anonymous",)
+    return None
+
+
+def invalidate_permission_sets():
+    """
+    Drop the compiled permission sets of this process so they are
+    compiled again, in other processes once the current transaction
+    commits
+    """
+
+    PERMISSION_SETS.invalidate()
+
+
+def compiled_permission_sets():
+    """
+    Returns the compiled permission sets of this process, keyed by
+    permission holder, see `PERMISSION_SETS`
+    """
+
+    return PERMISSION_SETS.get(dict)
+
+
 def init_permissions_helper(obj):
     """Initialize the Permission Util based on
     whether the provided object is a UserAPIKey, OrgAPIKey,
     or a different object.
+
+    Permission sets are compiled once per permission holder and
+    reused until permissions change, periodic re-authentication is
+    checked on every call.
     """
 
     if hasattr(obj, "_permissions_util"):
         return obj._permissions_util
 
-    if isinstance(obj, UserAPIKey):
-        perms = return_user_api_key_perms(obj)
-    elif isinstance(obj, OrganizationAPIKey):
-        perms = return_org_api_key_perms(obj)
+    key = permission_holder_key(obj)
+    sets = compiled_permission_sets() if key else {}
+    cached = sets.get(key)
+
+    if cached:
+        pset, org_ids = cached
+        if isinstance(obj, UserAPIKey):
+            perms = CachedPermissions(obj.user, pset)
+        else:
+            perms = CachedPermissions(obj, pset)
     else:
-        perms = Permissions(obj)
-        if isinstance(obj, User):
-            for org in obj.organizations:
-                org.adjust_permissions_for_periodic_reauth(obj, perms)
+        if isinstance(obj, UserAPIKey):
+            perms = return_user_api_key_perms(obj)
+        elif isinstance(obj, OrganizationAPIKey):
+            perms = return_org_api_key_perms(obj)
+        else:
+            perms = Permissions(obj)
+
+        org_ids = obj.organization_ids if isinstance(obj, User) else []
+
+        if key:
+            if len(sets) >= PERMISSION_SETS_MAX_ENTRIES:
+                sets.clear()
+            sets[key] = (perms.pset, org_ids)
+
+    if isinstance(obj, User) and org_ids and settings.PERIODIC_REAUTH_ENABLED:
+        orgs = list(
+            Organization.objects.filter(
+                id__in=org_ids, status="ok", periodic_reauth=True
+            )
+        )
+
+        # the compiled permission set is shared, adjust a copy
+
+        if orgs and key:
+            pset = PermissionSet()
+            pset.update(perms.pset.permissions)
+            perms.pset = pset
+
+        for org in orgs:
+            org.adjust_permissions_for_periodic_reauth(obj, perms)
 
     obj._permissions_util = perms
     return perms
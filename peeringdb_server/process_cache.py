@@ -0,0 +1,109 @@
+"""
+Values computed from the database and kept in process memory.
+
+Each value is paired with a version stamp stored in the django cache.
+Writes drop the value of the current process right away and bump the
+stamp once their transaction commits, other processes compare their
+value against the stamp at most every n seconds and rebuild it if it
+changed.
+"""
+
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+class VersionedProcessCache:
+    """
+    A single value kept in process memory and invalidated through a
+    version stamp in the django cache.
+
+    A value built after a write in a transaction that has not committed
+    yet may contain rows that are rolled back later, so it is returned
+    but not kept until that transaction is over.
+    """
+
+    def __init__(self, version_key, timeout_setting):
+        """
+        Arguments:
+            - version_key (str): django cache key of the version stamp
+            - timeout_setting (str): name of the setting that holds the
+                number of seconds between version stamp checks
+        """
+
+        self.version_key = version_key
+        self.timeout_setting = timeout_setting
+        self.entry = None
+        self.pending = False
+
+    def get(self, build, recheck=False):
+        """
+        Returns the value of this process, calling `build` to compute
+        it if there is none or its version stamp has changed.
+
+        The version stamp is checked at most every n seconds, unless
+        `recheck` is True.
+        """
+
+        if self.pending:
+            if transaction.get_connection().in_atomic_block:
+                return build()
+
+            # the transaction that wrote has been rolled back,
+            # nothing built during it was kept
+
+            self.pending = False
+
+        now = time.monotonic()
+        entry = self.entry
+
+        timeout = getattr(settings, self.timeout_setting)
+
+        if entry and not recheck and now - entry["checked"] < timeout:
+            return entry["value"]
+
+        version = cache.get(self.version_key)
+
+        if version is None:
+            # there is no stamp yet or it has been culled from the cache,
+            # set one so values built from now on are told apart from
+            # values built before the next bump
+
+            cache.add(self.version_key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(self.version_key)
+
+        if not entry or entry["version"] != version:
+            entry = {"version": version, "value": build()}
+
+        entry["checked"] = now
+        self.entry = entry
+
+        return entry["value"]
+
+    def invalidate(self):
+        """
+        Drop the value of this process and, once the current transaction
+        commits, bump the version stamp so other processes drop theirs
+        as well.
+        """
+
+        self.entry = None
+        self.pending = True
+
+        def bump():
+            self.entry = None
+            self.pending = False
+            cache.set(self.version_key, uuid.uuid4().hex, timeout=None)
+
+        transaction.on_commit(bump)
+
+    def clear(self):
+        """
+        Drop the value of this process without bumping the version stamp.
+        """
+
+        self.entry = None
+        self.pending = False
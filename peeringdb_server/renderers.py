@@ -4,13 +4,21 @@ REST API renderer.
 Ensure valid json output of the REST API.
 """
 
+import datetime
 import json
 
+import django_countries.fields
+from django.conf import settings
 from rest_framework import renderers
 from rest_framework.utils import encoders
 
 from peeringdb_server.rest_throttles import ResponseSizeThrottle
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class JSONEncoder(encoders.JSONEncoder):
     """
@@ -23,9 +31,6 @@ class JSONEncoder(encoders.JSONEncoder):
 
     def default(self, obj):
         """Default JSON serializer."""
-        import datetime
-
-        import django_countries.fields
 
         if isinstance(obj, datetime.datetime):
             return obj.isoformat()
@@ -36,6 +41,58 @@ class JSONEncoder(encoders.JSONEncoder):
         return encoders.JSONEncoder.default(self, obj)
 
 
+JSON_ENCODER = JSONEncoder()
+
+
+def orjson_default(obj):
+    """
+    Serialize objects orjson does not handle natively
+    (countries, decimals, lazy translation strings etc.)
+    """
+    return JSON_ENCODER.default(obj)
+
+
+def dumps_json(data, indent=None):
+    """
+    Serialize to json using the standard library json module.
+    """
+    return json.dumps(data, cls=JSONEncoder, indent=indent)
+
+
+def dumps_orjson(data, indent=None):
+    """
+    Serialize to json using orjson.
+
+    Datetimes are serialized natively, in the same format as
+    `datetime.isoformat`. Returns bytes.
+    """
+    option = orjson.OPT_NON_STR_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+    return orjson.dumps(data, default=orjson_default, option=option)
+
+
+JSON_BACKENDS = {
+    "json": dumps_json,
+    "orjson": dumps_orjson,
+}
+
+
+def dumps(data, indent=None):
+    """
+    Serialize to json using the backend specified in the
+    `API_JSON_BACKEND` setting.
+
+    Falls back to the standard library json module if orjson
+    is selected but not installed.
+    """
+
+    backend = getattr(settings, "API_JSON_BACKEND", "json")
+    if backend == "orjson" and not orjson:
+        backend = "json"
+    return JSON_BACKENDS[backend](data, indent=indent)
+
+
 class MungeRenderer(renderers.BaseRenderer):
     media_type = "text/plain"
     format = "txt"
@@ -48,7 +105,7 @@ class MungeRenderer(renderers.BaseRenderer):
             request = renderer_context.get("request")
             if "pretty" in request.GET:
                 indent = 2
-        return json.dumps(data, cls=JSONEncoder, indent=indent)
+        return dumps(data, indent=indent)
 
 
 class MetaJSONRenderer(MungeRenderer):
@@ -14,7 +14,10 @@ peeringdb-py client compatibility checking.
 The peeringdb REST API is implemented through django-rest-framework.
 """
 
+import base64
 import datetime
+import functools
+import hashlib
 import importlib
 import re
 import time
@@ -26,8 +29,11 @@ from django.apps import apps
 from django.conf import settings
 from django.core.exceptions import FieldError, ObjectDoesNotExist, ValidationError
 from django.db import connection, transaction
-from django.db.models import DateTimeField
+from django.db.models import Count, DateTimeField, Max, Q, Sum
+from django.http import HttpResponse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, set_response_etag
+from django.utils.http import parse_http_date_safe
 from django.utils.translation import ugettext_lazy as _
 from django_grainy.rest import PermissionDenied
 from django_security_keys.models import SecurityKeyDevice
@@ -47,6 +53,7 @@ from peeringdb_server.permissions import (
     ModelViewSetPermissions,
     check_permissions_from_request,
     get_org_key_from_request,
+    get_permission_holder_from_request,
     get_user_key_from_request,
 )
 from peeringdb_server.rest_throttles import IXFImportThrottle
@@ -336,6 +343,236 @@ class BasicAuthMFABlockWrite(permissions.BasePermission):
 # VIEW SETS
 
 
+def encode_sync_cursor(updated, id):
+    """
+    Encode a position in the (updated, id) ordered object stream
+    into an opaque cursor for incremental sync requests.
+    """
+    value = f"{updated.isoformat()}|{id}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip("=")
+
+
+def decode_sync_cursor(cursor):
+    """
+    Decode a cursor created by `encode_sync_cursor`.
+
+    Returns an (updated, id) tuple, raises a `RestValidationError`
+    if the cursor is not valid.
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        updated, id = value.decode().split("|")
+        updated = datetime.datetime.fromisoformat(updated)
+        id = int(id)
+    except (ValueError, UnicodeDecodeError):
+        raise RestValidationError({"detail": "Invalid cursor"})
+
+    if timezone.is_naive(updated):
+        updated = timezone.make_aware(updated, UTC())
+
+    return updated, id
+
+
+def conditional_response(request, response, validator=None):
+    """
+    Return a 304 response if the client's copy of the response
+    is still current, otherwise return the response.
+
+    Non-streaming responses without an ETag get one from their content.
+
+    If `validator` is passed, the client's copy is compared against the
+    ETag of the content, which is then replaced by `validator`, so clients
+    that hold a content ETag move over to the queryset validator.
+    """
+
+    if not response.streaming and not response.has_header("ETag"):
+        set_response_etag(response)
+
+    last_modified = response.get("Last-Modified")
+    if last_modified:
+        last_modified = parse_http_date_safe(last_modified)
+
+    response = get_conditional_response(
+        request,
+        etag=response.get("ETag"),
+        last_modified=last_modified,
+        response=response,
+    )
+
+    if validator:
+        response["ETag"] = validator
+
+    return response
+
+
+class NotModified(Exception):
+    """
+    Raise this error during viewset.get_queryset to answer a conditional
+    GET request with a 304 response before the queryset is serialized.
+
+    Argument should be the 304 response.
+    """
+
+    def __init__(self, response):
+        super().__init__(self, "Client copy is current")
+        self.response = response
+
+
+@functools.lru_cache(maxsize=None)
+def related_updated_paths(model, hops=2):
+    """
+    Returns the lookup paths of the objects `model` points to (up to
+    `hops` foreign keys away) that have an `updated` field.
+    """
+
+    paths = []
+    for field in model._meta.concrete_fields:
+        related = field.related_model
+        if not field.many_to_one or related is model:
+            continue
+        if any(fld.name == "updated" for fld in related._meta.concrete_fields):
+            paths.append(field.name)
+        if hops > 1:
+            paths += [
+                f"{field.name}__{path}"
+                for path in related_updated_paths(related, hops - 1)
+            ]
+    return paths
+
+
+def queryset_validator(request, qset):
+    """
+    Returns the ETag of the depth 0 list response of the queryset,
+    derived from the database before it is serialized.
+
+    The rows are covered by their max(updated) and count. Object counts
+    (net_count etc.) are written without touching `updated`, they are
+    covered by their sums. Fields of related objects (org_name etc.) are
+    covered by the max(updated) of the objects the rows point to.
+
+    The ETag also covers the query string and the permission holder,
+    since the rows are filtered by the requesting user's permissions.
+
+    There is no matching Last-Modified value: rows that leave the result
+    set and changed object counts do not move max(updated) forward.
+    """
+
+    model = qset.model
+
+    aggregates = {"max_updated": Max("updated"), "rows": Count("id")}
+    for field in model._meta.concrete_fields:
+        if field.name.endswith("_count"):
+            aggregates[f"sum_{field.name}"] = Sum(field.name)
+    for path in related_updated_paths(model):
+        aggregates[f"max_{path}_updated"] = Max(f"{path}__updated")
+
+    values = qset.aggregate(**aggregates)
+
+    holder = get_permission_holder_from_request(request)
+    value = "|".join(
+        [
+            model.HandleRef.tag,
+            request.META.get("QUERY_STRING", ""),
+            f"{holder.__class__.__name__}:{holder.pk}",
+        ]
+        + [f"{key}={values[key]}" for key in sorted(values)]
+    )
+
+    return 'W/"%s"' % hashlib.sha1(value.encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_filter_plan(viewset_class, params):
+    """
+    Translate the query parameter names of a list request into
+    django orm filters for the specified viewset class.
+
+    Returns a list of (param, filter key, suffix, field, internal type)
+    tuples, one for each parameter that maps to a queryable field,
+    parameters that do not are left out.
+
+    The translation only depends on the parameter names so it is
+    memoized per (viewset class, parameter names).
+    """
+
+    model = viewset_class.model
+    serializer_class = viewset_class.serializer_class
+
+    field_names = dict(
+        [(fld.name, fld) for fld in model._meta.get_fields()]
+        + serializer_class.queryable_relations()
+    )
+
+    xl = serializer_class.queryable_field_xl
+
+    plan = []
+
+    for param in params:
+
+        if param == "q":
+            continue
+
+        k = param
+
+        if re.match("^.+[^_]_id$", k) and k not in field_names:
+            # if k[-3:] == "_id" and k not in field_names:
+            k = k[:-3]
+
+        # only apply filter if the field actually exists and uses a
+        # valid suffix
+        m = re.match("^(.+)__(lt|lte|gt|gte|contains|startswith|in)$", k)
+
+        # run queryable field translation
+        # on the targeted field so that the filter is actually run on
+        # a field that django orm is aware of - which in most cases is
+        # identical to the serializer field anyways, but in some cases it
+        # may need to be substituted
+        if m:
+            flt = xl(m.group(1))
+            k = k.replace(m.group(1), flt, 1)
+            if re.match("^.+[^_]_id$", flt) and flt not in field_names:
+                flt = flt[:-3]
+        else:
+            k = xl(k)
+            flt = None
+
+        # prepare db filters
+        if m and flt in field_names:
+            # filter by function provided in suffix
+            try:
+                intyp = field_names.get(flt).get_internal_type()
+            except Exception:
+                intyp = "CharField"
+
+            # contains should become icontains because we always
+            # want it to do case-insensitive checks
+            if m.group(2) == "contains":
+                key = "%s__icontains" % flt
+            elif m.group(2) == "startswith":
+                key = "%s__istartswith" % flt
+            else:
+                key = k
+
+            plan.append((param, key, m.group(2), m.group(1), intyp))
+
+        elif k in field_names:
+            # filter exact matches
+            try:
+                intyp = field_names.get(k).get_internal_type()
+            except Exception:
+                intyp = "CharField"
+            if intyp == "ForeignKey":
+                key = "%s_id" % k
+            elif intyp == "DateTimeField" or intyp == "DateField":
+                key = "%s__startswith" % k
+            else:
+                key = "%s__iexact" % k
+
+            plan.append((param, key, None, k, intyp))
+
+    return tuple(plan)
+
+
 class ModelViewSet(viewsets.ModelViewSet):
     """
     Generic ModelViewSet Base Class.
@@ -393,11 +630,6 @@ class ModelViewSet(viewsets.ModelViewSet):
         except ValueError:
             raise RestValidationError({"detail": "'depth' needs to be a number"})
 
-        field_names = dict(
-            [(fld.name, fld) for fld in self.model._meta.get_fields()]
-            + self.serializer_class.queryable_relations()
-        )
-
         date_fields = ["DateTimeField", "DateField"]
 
         # haystack search for the legacy `name_search` parameter
@@ -414,10 +646,9 @@ class ModelViewSet(viewsets.ModelViewSet):
         filters = {}
         query_params = self.request.query_params
 
-        for k, v in list(self.request.query_params.items()):
+        plan = compile_filter_plan(type(self), tuple(query_params.keys()))
 
-            if k == "q":
-                continue
+        for k, key, suffix, fld, intyp in plan:
 
             # if we are doing spatial distance matching, we need to ignore
             # exact filters for location fields
@@ -432,7 +663,7 @@ class ModelViewSet(viewsets.ModelViewSet):
                 ]:
                     continue
 
-            v = unidecode.unidecode(v)
+            v = unidecode.unidecode(query_params[k])
 
             # if country and state are specified, try to normalize state #1079
             if k == "state" and hasattr(
@@ -443,42 +674,11 @@ class ModelViewSet(viewsets.ModelViewSet):
             if k == "ipaddr6":
                 v = coerce_ipaddr(v)
 
-            if re.match("^.+[^_]_id$", k) and k not in field_names:
-                # if k[-3:] == "_id" and k not in field_names:
-                k = k[:-3]
-
-            xl = self.serializer_class.queryable_field_xl
-
-            # only apply filter if the field actually exists and uses a
-            # valid suffix
-            m = re.match("^(.+)__(lt|lte|gt|gte|contains|startswith|in)$", k)
-
-            # run queryable field translation
-            # on the targeted field so that the filter is actually run on
-            # a field that django orm is aware of - which in most cases is
-            # identical to the serializer field anyways, but in some cases it
-            # may need to be substituted
-            if m:
-                flt = xl(m.group(1))
-                k = k.replace(m.group(1), flt, 1)
-                if re.match("^.+[^_]_id$", flt) and flt not in field_names:
-                    flt = flt[:-3]
-            else:
-                k = xl(k)
-                flt = None
-
-            # prepare db filters
-            if m and flt in field_names:
-                # filter by function provided in suffix
-                try:
-                    intyp = field_names.get(flt).get_internal_type()
-                except Exception:
-                    intyp = "CharField"
-
+            if suffix:
                 # for greater than date checks we want to force the time to 1
                 # msecond before midnight
                 if intyp in date_fields:
-                    if m.group(2) in ["gt", "lte"]:
+                    if suffix in ["gt", "lte"]:
                         if len(v) == 10:
                             v = "%s 23:59:59.999" % v
 
@@ -490,32 +690,14 @@ class ModelViewSet(viewsets.ModelViewSet):
                     if timezone.is_naive(v):
                         v = timezone.make_aware(v)
                     if "_ctf" in self.request.query_params:
-                        self.request._ctf = {f"{m.group(1)}__{m.group(2)}": v}
-
-                # contains should become icontains because we always
-                # want it to do case-insensitive checks
-                if m.group(2) == "contains":
-                    filters["%s__icontains" % flt] = v
-                elif m.group(2) == "startswith":
-                    filters["%s__istartswith" % flt] = v
+                        self.request._ctf = {f"{fld}__{suffix}": v}
+
                 # when the 'in' filters is found attempt to split the
                 # provided search value into a list
-                elif m.group(2) == "in":
-                    filters[k] = v.split(",")
-                else:
-                    filters[k] = v
-            elif k in field_names:
-                # filter exact matches
-                try:
-                    intyp = field_names.get(k).get_internal_type()
-                except Exception:
-                    intyp = "CharField"
-                if intyp == "ForeignKey":
-                    filters["%s_id" % k] = v
-                elif intyp == "DateTimeField" or intyp == "DateField":
-                    filters["%s__startswith" % k] = v
-                else:
-                    filters["%s__iexact" % k] = v
+                if suffix == "in":
+                    v = v.split(",")
+
+            filters[key] = v
 
         # any object ids we got back from processing a `q` (haystack)
         # search we will now merge into the `id__in` filter
@@ -540,12 +722,16 @@ class ModelViewSet(viewsets.ModelViewSet):
 
         # check if request qualifies for a cache load
         filters.update(p_filters)
-        api_cache = APICacheLoader(self, qset, filters)
+        api_cache = APICacheLoader(self, qset, filters, p_filters)
         if api_cache.qualifies():
             raise CacheRedirect(api_cache)
 
+        cursor = self.request.query_params.get("cursor")
+
         if not self.kwargs:
-            if since > 0:
+            if cursor is not None:
+                qset = self.sync_queryset(qset, cursor, since)
+            elif since > 0:
                 # .filter(status__in=["ok","deleted"])
                 qset = (
                     qset.since(
@@ -562,27 +748,139 @@ class ModelViewSet(viewsets.ModelViewSet):
         else:
             qset = qset.filter(status__in=["ok", "pending"])
 
-        if not self.kwargs:
+        if not self.kwargs and cursor is not None:
+            # sync pages are capped to the enforced row limit for depth
+            # queries, so they never need to be truncated
+            page_size = limit or settings.API_SYNC_PAGE_SIZE
+            if enforced_limit and depth > 0:
+                page_size = min(page_size, enforced_limit)
+            qset = qset[:page_size]
+
+        elif not self.kwargs:
             if limit > 0:
                 qset = qset[skip : skip + limit]
             else:
                 qset = qset[skip:]
 
-            row_count = qset.count()
-            if enforced_limit and depth > 0 and row_count > enforced_limit:
-                qset = qset[:enforced_limit]
-                self.request.meta_response["truncated"] = (
-                    "Your search query (with depth %d) returned more than %d rows and has been truncated. Please be more specific in your filters, use the limit and skip parameters to page through the resultset or drop the depth parameter"
-                    % (depth, enforced_limit)
-                )
+            # depth queries are truncated to the enforced row limit
+            #
+            # instead of counting the rows up front one extra row is fetched,
+            # `filter_queryset` uses it to tell if the result set needs to
+            # be truncated
+            if (
+                enforced_limit
+                and depth > 0
+                and not (limit > 0 and limit <= enforced_limit)
+            ):
+                qset = qset[: enforced_limit + 1]
+                self.row_limit = (enforced_limit, depth)
 
         if depth > 0 or self.kwargs:
             return self.serializer_class.prefetch_related(
                 qset, self.request, is_list=(len(self.kwargs) == 0)
             )
         else:
+            if self.request.method in ["GET", "HEAD"]:
+                self.check_not_modified(qset)
             return qset
 
+    def check_not_modified(self, qset):
+        """
+        Derive the validator of a depth 0 list response from its queryset
+        and raise NotModified if the client's copy is still current, so
+        the queryset does not need to be serialized.
+
+        Only requests that send If-None-Match pay for the aggregate query,
+        other responses get an ETag from their content.
+        """
+
+        if "HTTP_IF_NONE_MATCH" not in self.request.META:
+            return
+
+        self.validator = etag = queryset_validator(self.request, qset)
+
+        response = HttpResponse()
+        response["ETag"] = etag
+
+        conditional = get_conditional_response(
+            self.request, etag=etag, response=response
+        )
+
+        if conditional is not response:
+            raise NotModified(conditional)
+
+    def filter_queryset(self, queryset):
+        """
+        Truncate depth queries to the enforced row limit before they
+        are serialized, using the extra row fetched by `get_queryset`
+        to tell if the result set was truncated.
+        """
+
+        queryset = super().filter_queryset(queryset)
+
+        if not getattr(self, "row_limit", None):
+            return queryset
+
+        enforced_limit, depth = self.row_limit
+        instances = list(queryset)
+
+        if len(instances) > enforced_limit:
+            self.request.meta_response["truncated"] = (
+                "Your search query (with depth %d) returned more than %d rows and has been truncated. Please be more specific in your filters, use the limit and skip parameters to page through the resultset or drop the depth parameter"
+                % (depth, enforced_limit)
+            )
+            instances = instances[:enforced_limit]
+
+        return instances
+
+    def sync_queryset(self, qset, cursor, since):
+        """
+        Prepare the queryset for an incremental sync request.
+
+        Returns objects (including deleted ones) ordered by (updated, id)
+        starting after the position encoded in the cursor, or after the
+        `since` timestamp if the cursor is empty.
+        """
+
+        if cursor:
+            updated, id = decode_sync_cursor(cursor)
+            qset = qset.filter(Q(updated__gt=updated) | Q(updated=updated, id__gt=id))
+        else:
+            qset = qset.filter(
+                updated__gt=datetime.datetime.fromtimestamp(since).replace(
+                    tzinfo=UTC()
+                )
+            )
+
+        return qset.filter(status__in=["ok", "deleted"]).order_by("updated", "id")
+
+    def next_sync_cursor(self, data):
+        """
+        Return the cursor to request the page following the
+        specified serialized sync page.
+
+        The position is taken from the objects rather than the serialized
+        rows as those only carry the updated timestamp at second precision.
+        """
+
+        serializer = getattr(data, "serializer", None)
+        instances = list(serializer.instance) if serializer else []
+
+        if instances:
+            return encode_sync_cursor(instances[-1].updated, instances[-1].id)
+
+        # empty page, the client is up to date, and should continue
+        # from the same position
+
+        cursor = self.request.query_params.get("cursor")
+        if cursor:
+            return cursor
+
+        since = int(float(self.request.query_params.get("since", 0)))
+        return encode_sync_cursor(
+            datetime.datetime.fromtimestamp(since).replace(tzinfo=UTC()), 0
+        )
+
     @client_check()
     def list(self, request, *args, **kwargs):
         t = time.time()
@@ -597,9 +895,21 @@ class ModelViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST, data={"detail": str(inst)}
             )
         except CacheRedirect as inst:
-            r = Response(status=200, data=inst.loader.load())
+            loader = inst.loader
+            if loader.matches == [] and self.serializer_class.is_unique_query(request):
+                return Response(
+                    status=404, data={"data": [], "detail": "Entity not found"}
+                )
+            # stream cached rows straight from the cache file so the
+            # full result set never has to be held in memory
+            return loader.streaming_response(APIPermissionsApplicator(request))
+        except NotModified as inst:
+            return inst.response
         d = time.time() - t
 
+        if "cursor" in request.query_params:
+            request.meta_response["cursor"] = self.next_sync_cursor(r.data)
+
         # FIXME: this waits for peeringdb-py fix to deal with 404 raise properly
         if not r or not len(r.data):
             if self.serializer_class.is_unique_query(request):
@@ -635,6 +945,34 @@ class ModelViewSet(viewsets.ModelViewSet):
                 return Response(status=status.HTTP_403_FORBIDDEN)
         return r
 
+    def finalize_response(self, request, response, *args, **kwargs):
+        """
+        Handle conditional GET requests (If-None-Match / If-Modified-Since).
+
+        Cached responses come with an ETag and Last-Modified header
+        derived from the cache file. Depth 0 list responses to requests
+        that send If-None-Match get an ETag from their queryset (see
+        `check_not_modified`). Other responses get an ETag from their
+        content once they have been rendered.
+        """
+
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        if request.method not in ["GET", "HEAD"] or response.status_code != 200:
+            return response
+
+        validator = None
+        if not response.has_header("ETag"):
+            validator = getattr(self, "validator", None)
+
+        if isinstance(response, Response) and not response.is_rendered:
+            response.add_post_render_callback(
+                lambda rendered: conditional_response(request, rendered, validator)
+            )
+            return response
+
+        return conditional_response(request, response, validator)
+
     def require_data(self, request):
         """
         Test that the request contains data in its body that
@@ -5,15 +5,79 @@ import ipaddress
 import re
 
 from django.conf import settings
-from django.core.cache import cache
 from rest_framework import throttling
 from rest_framework.exceptions import PermissionDenied
 
 from peeringdb_server.models import EnvironmentSetting
 from peeringdb_server.permissions import get_org_key_from_request, get_user_from_request
+from peeringdb_server.throttle_storage import (
+    get_throttle_storage,
+    window_clamp,
+    window_estimate,
+    window_wait,
+)
 
 
-class IXFImportThrottle(throttling.UserRateThrottle):
+class StorageRateThrottle(throttling.SimpleRateThrottle):
+
+    """
+    SimpleRateThrottle that keeps its request history in the
+    configured throttle storage backend (see `throttle_storage.py`)
+    instead of the django cache
+
+    With `API_THROTTLE_ALGORITHM` set to `sliding_window` a fixed size
+    window counter is kept instead of the request history.
+    """
+
+    history = None
+    window = None
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.now = self.timer()
+        self.storage = get_throttle_storage()
+
+        if settings.API_THROTTLE_ALGORITHM == "sliding_window":
+            self.window_key = f"{self.key}:window"
+            allowed, self.window = self.storage.count(
+                self.window_key, self.now, self.duration, self.num_requests
+            )
+        else:
+            allowed, self.history = self.storage.hit(
+                self.key, self.now, self.duration, self.num_requests
+            )
+
+        if not allowed:
+            return self.throttle_failure()
+
+        return True
+
+    def wait(self):
+        """
+        Returns the recommended next request time in seconds.
+
+        For the sliding window counter the counts are lowered to the
+        current rate limit first, if the rate limit has been adjusted
+        downward while the client was already being tracked.
+        """
+
+        if self.window is None:
+            return super().wait()
+
+        if window_estimate(self.window, self.now) >= self.num_requests + 1:
+            self.window = window_clamp(self.window, self.now, self.num_requests)
+            self.storage.set_window(self.window_key, self.window, self.duration)
+
+        return window_wait(self.window, self.now, self.num_requests)
+
+
+class IXFImportThrottle(StorageRateThrottle, throttling.UserRateThrottle):
     scope = "ixf_import_request"
 
     def get_cache_key(self, request, view):
@@ -22,7 +86,7 @@ class IXFImportThrottle(throttling.UserRateThrottle):
         return f"{key}.{ix.id}"
 
 
-class TargetedRateThrottle(throttling.SimpleRateThrottle):
+class TargetedRateThrottle(StorageRateThrottle):
 
     """
     Base class for targeted rate throttling depending
@@ -64,6 +128,10 @@ class TargetedRateThrottle(throttling.SimpleRateThrottle):
         also handle dynamic downward adjustments of rate limits (through
         changing EnvironmentSetting variables for example)
         """
+
+        if self.window is not None:
+            return super().wait()
+
         if self.history:
             remaining_duration = self.duration - (self.now - self.history[-1])
         else:
@@ -84,7 +152,7 @@ class TargetedRateThrottle(throttling.SimpleRateThrottle):
                     remaining_duration = self.duration - diff
 
             self.history = new_history
-            self.cache.set(self.key, self.history, self.duration)
+            self.storage.set(self.key, self.history, self.duration)
             available_requests = self.num_requests - len(self.history) + 1
 
         if available_requests < 1:
@@ -258,7 +326,7 @@ class TargetedRateThrottle(throttling.SimpleRateThrottle):
         return cache_key
 
 
-class FilterThrottle(throttling.SimpleRateThrottle):
+class FilterThrottle(StorageRateThrottle):
 
     """
     Base class for API throttling targeted at specific query filters.
@@ -422,7 +490,8 @@ class ResponseSizeThrottle(TargetedRateThrottle):
     @classmethod
     def cache_response_size(cls, request, size):
         """
-        Caches the response size for the request
+        Caches the response size for the request in the throttle
+        storage backend
 
         The api renderer (renderers.py) calls this automatically
         when it renders the response
@@ -431,11 +500,11 @@ class ResponseSizeThrottle(TargetedRateThrottle):
         # This will be called for EVERY api request.
         #
         # Only write the response size cache if it does not exist yet
-        # or is expired otherwise it introduces and unnecessary database
-        # write operation at the back of each request.
+        # or is expired otherwise it introduces and unnecessary throttle
+        # storage write operation at the back of each request.
 
         if cls.expected_response_size(request) is None:
-            cache.set(
+            get_throttle_storage().set_value(
                 cls.size_cache_key(request),
                 size,
                 settings.API_THROTTLE_REPEATED_REQUEST_CACHE_EXPIRY,
@@ -462,7 +531,7 @@ class ResponseSizeThrottle(TargetedRateThrottle):
         # if cache does not exist, its the first time this path is
         # requested and it can be allowed through.
 
-        size = cache.get(cls.size_cache_key(request))
+        size = get_throttle_storage().get_value(cls.size_cache_key(request))
         request._expected_response_size = size
 
         return size
@@ -1599,58 +1599,14 @@ class FacilitySerializer(SpatialSearchMixin, GeocodeSerializerMixin, ModelSerial
 
         if "org_present" in kwargs:
             org_list = kwargs.get("org_present")[0].split(",")
-            fac_ids = []
-
-            # relation through netfac
-            fac_ids.extend(
-                [
-                    netfac.facility_id
-                    for netfac in NetworkFacility.objects.filter(
-                        network__org_id__in=org_list
-                    )
-                ]
-            )
-
-            # relation through ixfac
-            fac_ids.extend(
-                [
-                    ixfac.facility_id
-                    for ixfac in InternetExchangeFacility.objects.filter(
-                        ix__org_id__in=org_list
-                    )
-                ]
-            )
-
-            qset = qset.filter(id__in=set(fac_ids))
+            qset = qset.filter(cls.Meta.model.org_presence(org_list))
 
             filters.update({"org_present": kwargs.get("org_present")[0]})
 
         if "org_not_present" in kwargs:
 
             org_list = kwargs.get("org_not_present")[0].split(",")
-            fac_ids = []
-
-            # relation through netfac
-            fac_ids.extend(
-                [
-                    netfac.facility_id
-                    for netfac in NetworkFacility.objects.filter(
-                        network__org_id__in=org_list
-                    )
-                ]
-            )
-
-            # relation through ixfac
-            fac_ids.extend(
-                [
-                    ixfac.facility_id
-                    for ixfac in InternetExchangeFacility.objects.filter(
-                        ix__org_id__in=org_list
-                    )
-                ]
-            )
-
-            qset = qset.exclude(id__in=set(fac_ids))
+            qset = qset.exclude(cls.Meta.model.org_presence(org_list))
 
             filters.update({"org_not_present": kwargs.get("org_not_present")[0]})
 
@@ -2979,58 +2935,14 @@ class InternetExchangeSerializer(ModelSerializer):
 
         if "org_present" in kwargs:
             org_list = kwargs.get("org_present")[0].split(",")
-            ix_ids = []
-
-            # relation through netixlan
-            ix_ids.extend(
-                [
-                    netixlan.ixlan_id
-                    for netixlan in NetworkIXLan.objects.filter(
-                        network__org_id__in=org_list
-                    )
-                ]
-            )
-
-            # relation through ixfac
-            ix_ids.extend(
-                [
-                    ixfac.ix_id
-                    for ixfac in InternetExchangeFacility.objects.filter(
-                        facility__org_id__in=org_list
-                    )
-                ]
-            )
-
-            qset = qset.filter(id__in=set(ix_ids))
+            qset = qset.filter(cls.Meta.model.org_presence(org_list))
 
             filters.update({"org_present": kwargs.get("org_present")[0]})
 
         if "org_not_present" in kwargs:
 
             org_list = kwargs.get("org_not_present")[0].split(",")
-            ix_ids = []
-
-            # relation through netixlan
-            ix_ids.extend(
-                [
-                    netixlan.ixlan_id
-                    for netixlan in NetworkIXLan.objects.filter(
-                        network__org_id__in=org_list
-                    )
-                ]
-            )
-
-            # relation through ixfac
-            ix_ids.extend(
-                [
-                    ixfac.ix_id
-                    for ixfac in InternetExchangeFacility.objects.filter(
-                        facility__org_id__in=org_list
-                    )
-                ]
-            )
-
-            qset = qset.exclude(id__in=set(ix_ids))
+            qset = qset.exclude(cls.Meta.model.org_presence(org_list))
 
             filters.update({"org_not_present": kwargs.get("org_not_present")[0]})
 
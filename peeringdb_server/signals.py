@@ -9,6 +9,7 @@ Django signal handlers
 - user to org affiliation handling when targeted org has no users
   - notify admin-com
 - CORS enabling for GET api requests
+- cache invalidation for environment settings and permission sets
 
 """
 
@@ -19,13 +20,19 @@ from corsheaders.signals import check_request_enabled
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Count
-from django.db.models.signals import post_save, pre_delete, pre_save
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
 from django.dispatch import receiver
 from django.template import loader
 from django.utils import timezone
 from django.utils.translation import override
 from django.utils.translation import ugettext_lazy as _
-from django_grainy.models import Group, GroupPermission
+from django_grainy.models import Group, GroupPermission, UserPermission
 from django_peeringdb.const import REGION_MAPPING
 from django_peeringdb.models.abstract import AddressModel
 from grainy.const import PERM_CRUD, PERM_READ
@@ -42,13 +49,18 @@ from peeringdb_server.models import (
     QUEUE_ENABLED,
     QUEUE_NOTIFY,
     EmailAddressData,
+    EnvironmentSetting,
     Facility,
+    IXLanPrefix,
     Network,
     NetworkIXLan,
     Organization,
+    OrganizationAPIPermission,
+    User,
     UserOrgAffiliationRequest,
     VerificationQueueItem,
 )
+from peeringdb_server.permissions import invalidate_permission_sets
 from peeringdb_server.util import disable_auto_now_and_save
 
 
@@ -559,3 +571,31 @@ def auto_fill_region_continent(sender, instance, **kwargs):
 
 
 pre_save.connect(auto_fill_region_continent, sender=Facility)
+
+
+def invalidate_environment_settings(sender, **kwargs):
+    EnvironmentSetting.invalidate()
+
+
+post_save.connect(invalidate_environment_settings, sender=EnvironmentSetting)
+post_delete.connect(invalidate_environment_settings, sender=EnvironmentSetting)
+
+
+def invalidate_prefix_index(sender, **kwargs):
+    IXLanPrefix.invalidate_index()
+
+
+post_save.connect(invalidate_prefix_index, sender=IXLanPrefix)
+post_delete.connect(invalidate_prefix_index, sender=IXLanPrefix)
+
+
+def invalidate_permissions(sender, **kwargs):
+    if kwargs.get("action", "post_").startswith("post_"):
+        invalidate_permission_sets()
+
+
+for model in [Group, UserPermission, GroupPermission, OrganizationAPIPermission]:
+    post_save.connect(invalidate_permissions, sender=model)
+    post_delete.connect(invalidate_permissions, sender=model)
+
+m2m_changed.connect(invalidate_permissions, sender=User.groups.through)
@@ -0,0 +1,431 @@
+"""
+Storage backends for REST API rate limiting state.
+
+Throttles keep either a sliding log of request timestamps or a
+sliding window counter for each scope and ident, depending on the
+`API_THROTTLE_ALGORITHM` setting:
+
+- `sliding_log`: exact, stores one timestamp per request in the window
+- `sliding_window`: approximate, stores the request counts of the
+  current and previous fixed window and weighs the previous count
+  by how much of it still overlaps the sliding window
+
+The state is stored through one of the backends below, selected by
+the `API_THROTTLE_STORAGE` setting:
+
+- `cache`: the django cache (database cache by default)
+- `local`: in-process memory, not shared between workers
+- `redis`: a redis (protocol compatible) server at `API_THROTTLE_REDIS_URL`,
+  falls back to `cache` (with a warning) if the redis module is not
+  installed or no url is configured
+
+Other throttle state, such as the expected response size of a request,
+is kept through the same backend as plain values.
+
+Each backend provides:
+
+- `hit(key, now, duration, limit)`: drops timestamps older than
+  `duration` seconds from the history stored at `key` and records `now`
+  if fewer than `limit` timestamps remain, returns `(allowed, history)`
+- `set(key, history, duration)`: replaces the history stored at `key`
+- `count(key, now, duration, limit)`: rolls the window counter stored
+  at `key` forward to `now` and counts the request if the estimated
+  number of requests in the sliding window is below `limit`, returns
+  `(allowed, state)`
+- `set_window(key, state, duration)`: replaces the window counter
+  stored at `key`
+- `get_value(key)`: returns the int value stored at `key`, None if there
+  is none or it has expired
+- `set_value(key, value, timeout)`: stores the int `value` at `key` for
+  `timeout` seconds
+
+Request history is handled as a list of timestamps, newest first, the
+same format rest_framework's `SimpleRateThrottle` uses. Window counters
+are handled as `(duration, start, previous, current)` tuples.
+"""
+import logging
+import math
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+# drop expired windows from the local storage every n hits
+
+LOCAL_SWEEP_INTERVAL = 1000
+
+
+# prune the window, then record the request if the limit has not been
+# reached yet - runs atomically on the redis server
+#
+# KEYS[1] - window key
+# ARGV[1] - current time
+# ARGV[2] - duration of the window in seconds
+# ARGV[3] - number of requests allowed in the window
+# ARGV[4] - unique member name for the request
+
+REDIS_HIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local duration = tonumber(ARGV[2])
+local allowed = 0
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - duration)
+if redis.call("ZCARD", KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call("ZADD", KEYS[1], now, ARGV[4])
+    allowed = 1
+end
+redis.call("EXPIRE", KEYS[1], math.ceil(duration))
+return {allowed, redis.call("ZREVRANGE", KEYS[1], 0, -1, "WITHSCORES")}
+"""
+
+# sliding window counter version of the above, see `roll_window` and
+# `window_estimate` for the python equivalent
+#
+# KEYS[1] - window key
+# ARGV[1] - current time
+# ARGV[2] - duration of the window in seconds
+# ARGV[3] - number of requests allowed in the window
+
+REDIS_COUNT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local duration = tonumber(ARGV[2])
+local allowed = 0
+
+local function roll(duration, start, previous, current)
+    local rolled = math.floor(now / duration) * duration
+    if start == rolled then
+        return rolled, previous, current
+    elseif start == rolled - duration then
+        return rolled, current, 0
+    end
+    return rolled, 0, 0
+end
+
+local state = redis.call("HMGET", KEYS[1], "duration", "start", "previous", "current")
+local start, previous, current = roll(duration, 0, 0, 0)
+
+if state[1] then
+    local stored = tonumber(state[1])
+    start, previous, current = roll(
+        stored, tonumber(state[2]), tonumber(state[3]), tonumber(state[4])
+    )
+    if stored ~= duration then
+        current = previous * (1 - (now - start) / stored) + current
+        start, previous = roll(duration, 0, 0, 0), 0
+    end
+end
+
+if previous * (1 - (now - start) / duration) + current < tonumber(ARGV[3]) then
+    current = current + 1
+    allowed = 1
+end
+
+redis.call(
+    "HSET", KEYS[1],
+    "duration", duration, "start", start, "previous", previous, "current", current
+)
+redis.call("EXPIRE", KEYS[1], math.ceil(duration * 2))
+return {allowed, tostring(start), tostring(previous), tostring(current)}
+"""
+
+
+def roll_window(state, now, duration):
+    """
+    Returns the `(duration, start, previous, current)` counter state
+    for the fixed window `now` falls into, carrying over the count of
+    the window before it.
+
+    If the window duration has changed, the estimated count of the
+    old window is carried over instead.
+    """
+
+    start = math.floor(now / duration) * duration
+
+    if not state:
+        return (duration, start, 0, 0)
+
+    if state[0] != duration:
+        carried = window_estimate(roll_window(state, now, state[0]), now)
+        return (duration, start, 0, carried)
+
+    _, stored, previous, current = state
+
+    if stored == start:
+        return state
+    if stored == start - duration:
+        return (duration, start, current, 0)
+
+    return (duration, start, 0, 0)
+
+
+def window_estimate(state, now):
+    """
+    Returns the estimated number of requests in the sliding window
+    ending at `now`
+    """
+    duration, start, previous, current = state
+    return previous * (1 - (now - start) / duration) + current
+
+
+def window_clamp(state, now, limit):
+    """
+    Lowers the counts of `state` so the estimate does not exceed
+    `limit`, for when a rate limit is lowered while a client is
+    already being tracked
+    """
+
+    duration, start, previous, current = state
+
+    if current >= limit:
+        return (duration, start, 0, limit)
+
+    weight = 1 - (now - start) / duration
+    return (duration, start, min(previous, (limit - current) / weight), current)
+
+
+def window_wait(state, now, limit):
+    """
+    Returns the number of seconds until the estimate drops
+    below `limit`
+    """
+
+    duration, start, previous, current = state
+
+    if current >= limit:
+
+        # wait for the next window, and for the carried over
+        # count to decay below the limit
+
+        return start + duration * (2 - limit / current) - now
+
+    if not previous:
+        return 0
+
+    return max(0, start + duration * (1 - (limit - current) / previous) - now)
+
+
+# redis hash fields of a window counter
+
+WINDOW_FIELDS = ("duration", "start", "previous", "current")
+
+
+class CacheThrottleStorage:
+
+    """
+    Stores request history in the django cache
+    """
+
+    def hit(self, key, now, duration, limit):
+        history = cache.get(key, [])
+
+        while history and history[-1] <= now - duration:
+            history.pop()
+
+        if len(history) >= limit:
+            return False, history
+
+        history.insert(0, now)
+        cache.set(key, history, duration)
+        return True, history
+
+    def set(self, key, history, duration):
+        cache.set(key, history, duration)
+
+    def count(self, key, now, duration, limit):
+        state = roll_window(cache.get(key), now, duration)
+
+        if window_estimate(state, now) >= limit:
+            return False, state
+
+        state = state[:3] + (state[3] + 1,)
+        cache.set(key, state, duration * 2)
+        return True, state
+
+    def set_window(self, key, state, duration):
+        cache.set(key, state, duration * 2)
+
+    def get_value(self, key):
+        return cache.get(key)
+
+    def set_value(self, key, value, timeout):
+        cache.set(key, value, timeout)
+
+
+class LocalThrottleStorage:
+
+    """
+    Stores request history in process memory
+
+    Limits are enforced per process, meant for single process
+    deployments and tests.
+    """
+
+    def __init__(self):
+        self.windows = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def hit(self, key, now, duration, limit):
+        with self.lock:
+            self.hits += 1
+            if self.hits % LOCAL_SWEEP_INTERVAL == 0:
+                self.sweep(now)
+
+            _, history = self.windows.get(key, (None, []))
+
+            while history and history[-1] <= now - duration:
+                history.pop()
+
+            if len(history) >= limit:
+                return False, list(history)
+
+            history.insert(0, now)
+            self.windows[key] = (now + duration, history)
+            return True, list(history)
+
+    def set(self, key, history, duration):
+        with self.lock:
+            if history:
+                self.windows[key] = (history[0] + duration, list(history))
+            else:
+                self.windows.pop(key, None)
+
+    def count(self, key, now, duration, limit):
+        with self.lock:
+            self.hits += 1
+            if self.hits % LOCAL_SWEEP_INTERVAL == 0:
+                self.sweep(now)
+
+            _, state = self.windows.get(key, (None, None))
+            state = roll_window(state, now, duration)
+
+            if window_estimate(state, now) >= limit:
+                return False, state
+
+            state = state[:3] + (state[3] + 1,)
+            self.windows[key] = (state[1] + duration * 2, state)
+            return True, state
+
+    def set_window(self, key, state, duration):
+        with self.lock:
+            self.windows[key] = (state[1] + duration * 2, state)
+
+    def get_value(self, key):
+        expires, value = self.windows.get(key, (None, None))
+        if expires is None or expires <= time.time():
+            return None
+        return value
+
+    def set_value(self, key, value, timeout):
+        with self.lock:
+            self.windows[key] = (time.time() + timeout, value)
+
+    def sweep(self, now):
+        """
+        Drops all windows that have expired
+        """
+        self.windows = {
+            key: window for key, window in self.windows.items() if window[0] > now
+        }
+
+    def clear(self):
+        with self.lock:
+            self.windows = {}
+
+
+class RedisThrottleStorage:
+
+    """
+    Stores request history as sorted sets on a redis server
+
+    Each window is pruned and checked in a single server side script,
+    so concurrent requests from several workers are counted correctly.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.hit_script = client.register_script(REDIS_HIT_SCRIPT)
+        self.count_script = client.register_script(REDIS_COUNT_SCRIPT)
+
+    def hit(self, key, now, duration, limit):
+        allowed, history = self.hit_script(
+            keys=[key], args=[now, duration, limit, f"{now}:{uuid.uuid4().hex}"]
+        )
+        return bool(allowed), [float(score) for score in history[1::2]]
+
+    def set(self, key, history, duration):
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        if history:
+            pipe.zadd(key, {f"{ts}:{i}": ts for i, ts in enumerate(history)})
+            pipe.expire(key, math.ceil(duration))
+        pipe.execute()
+
+    def count(self, key, now, duration, limit):
+        allowed, *state = self.count_script(keys=[key], args=[now, duration, limit])
+        return bool(allowed), (duration,) + tuple(float(value) for value in state)
+
+    def set_window(self, key, state, duration):
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping=dict(zip(WINDOW_FIELDS, state)))
+        pipe.expire(key, math.ceil(duration * 2))
+        pipe.execute()
+
+    def get_value(self, key):
+        value = self.client.get(key)
+        if value is None:
+            return None
+        return int(value)
+
+    def set_value(self, key, value, timeout):
+        self.client.set(key, value, ex=math.ceil(timeout))
+
+
+# storage instances per process, keyed by backend name and location
+
+STORAGES = {}
+
+
+def get_throttle_storage():
+    """
+    Returns the throttle storage backend configured through the
+    `API_THROTTLE_STORAGE` setting
+    """
+
+    name = settings.API_THROTTLE_STORAGE
+    url = settings.API_THROTTLE_REDIS_URL if name == "redis" else None
+
+    storage = STORAGES.get((name, url))
+
+    if storage is None:
+        if name == "redis" and (not redis or not url):
+            if redis:
+                reason = "API_THROTTLE_REDIS_URL is not set"
+            else:
+                reason = "the redis module is not installed"
+            logger.warning(
+                "API_THROTTLE_STORAGE is redis, but %s, "
+                "falling back to the django cache",
+                reason,
+            )
+            storage = CacheThrottleStorage()
+        elif name == "redis":
+            storage = RedisThrottleStorage(redis.Redis.from_url(url))
+        elif name == "local":
+            storage = LocalThrottleStorage()
+        elif name == "cache":
+            storage = CacheThrottleStorage()
+        else:
+            raise ValueError(f"Unknown throttle storage: {name}")
+        STORAGES[(name, url)] = storage
+
+    return storage
@@ -15,6 +15,25 @@ def pytest_generate_tests(metafunc):
             metafunc.parametrize(fixture, list(data.values()), ids=list(data.keys()))
 
 
+@pytest.fixture(autouse=True)
+def clear_process_caches():
+    """
+    Environment setting overrides, permission sets and the prefix index are
+    kept in memory, make sure they do not outlive the transaction of the test
+    that wrote them
+    """
+    from peeringdb_server.models import ENV_SETTINGS, IXPFX_INDEX
+    from peeringdb_server.permissions import PERMISSION_SETS
+
+    ENV_SETTINGS.clear()
+    PERMISSION_SETS.clear()
+    IXPFX_INDEX.clear()
+    yield
+    ENV_SETTINGS.clear()
+    PERMISSION_SETS.clear()
+    IXPFX_INDEX.clear()
+
+
 @pytest.fixture
 def rdap():
     return RdapLookup()
@@ -1,10 +1,14 @@
+import datetime
 import json
 import os
 
 import pytest
 from django.conf import settings
 from django.contrib.auth.models import Group
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django_countries.fields import Country
 from django_grainy.models import GroupPermission, UserPermission
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
@@ -13,6 +17,15 @@ from twentyc.rpc.client import RestClient
 import peeringdb_server.inet as pdbinet
 import peeringdb_server.management.commands.pdb_api_test as api_test
 import peeringdb_server.models as models
+import peeringdb_server.rest as rest
+from peeringdb_server.renderers import dumps
+from peeringdb_server.rest import NetworkIXLanViewSet, compile_filter_plan
+from peeringdb_server.serializers import (
+    FacilitySerializer,
+    InternetExchangeSerializer,
+    NetworkSerializer,
+    OrganizationSerializer,
+)
 
 from .util import reset_group_ids
 
@@ -113,7 +126,7 @@ class DummyRestClient(RestClient):
 
         assert res.charset == "utf-8"
 
-        return DummyResponse(res.status_code, res.content)
+        return DummyResponse(res.status_code, res.getvalue())
 
 
 class APITests(TestCase, api_test.TestJSON, api_test.Command):
@@ -187,3 +200,370 @@ class APITests(TestCase, api_test.TestJSON, api_test.Command):
 
         # prepare api test data
         cls.prepare()
+
+
+def test_compile_filter_plan():
+    """
+    Test the translation of list query parameters into orm filters
+    """
+
+    params = ("net_id", "ixlan_id__in", "speed__gt", "notes__contains", "limit", "q")
+    plan = compile_filter_plan(NetworkIXLanViewSet, params)
+
+    assert plan == (
+        ("net_id", "network_id", None, "network", "ForeignKey"),
+        ("ixlan_id__in", "ixlan__in", "in", "ixlan_id", "ForeignKey"),
+        ("speed__gt", "speed__gt", "gt", "speed", "PositiveIntegerField"),
+        ("notes__contains", "notes__icontains", "contains", "notes", "CharField"),
+    )
+
+    # memoized per viewset and parameter names
+
+    assert compile_filter_plan(NetworkIXLanViewSet, params) is plan
+
+
+@pytest.mark.django_db
+def test_depth_row_limit(settings, mocker):
+    """
+    Test that depth queries are truncated to API_DEPTH_ROW_LIMIT
+    without counting the result set
+    """
+
+    settings.API_DEPTH_ROW_LIMIT = 2
+    settings.API_CACHE_ENABLED = False
+
+    superuser = models.User.objects.create_user(
+        "su", "su@localhost", "su", is_superuser=True
+    )
+    for i in range(3):
+        models.Organization.objects.create(name=f"Org {i}", status="ok")
+
+    client = APIClient()
+    client.force_authenticate(superuser)
+
+    to_representation = mocker.spy(OrganizationSerializer, "to_representation")
+
+    with CaptureQueriesContext(connection) as captured:
+        data = client.get("/api/org?depth=1").json()
+    assert len(data["data"]) == 2
+    assert "truncated" in data["meta"]
+
+    # the extra row is dropped before serializing
+
+    assert to_representation.call_count == 2
+    assert not [
+        q
+        for q in captured.captured_queries
+        if "peeringdb_organization" in q["sql"] and "COUNT(" in q["sql"].upper()
+    ]
+
+    data = client.get("/api/org?depth=1&limit=2").json()
+    assert len(data["data"]) == 2
+    assert "truncated" not in data["meta"]
+
+    data = client.get("/api/org?depth=1&skip=1").json()
+    assert len(data["data"]) == 2
+    assert "truncated" not in data["meta"]
+
+    data = client.get("/api/org").json()
+    assert len(data["data"]) == 3
+    assert "truncated" not in data["meta"]
+
+
+@pytest.mark.django_db
+def test_conditional_get(settings):
+    """
+    Test ETag based conditional GET on list and detail endpoints
+    """
+
+    settings.API_CACHE_ENABLED = False
+
+    superuser = models.User.objects.create_user(
+        "su", "su@localhost", "su", is_superuser=True
+    )
+    org = models.Organization.objects.create(name="Org", status="ok")
+
+    client = APIClient()
+    client.force_authenticate(superuser)
+
+    for url in ["/api/org", f"/api/org/{org.id}"]:
+        response = client.get(url)
+        assert response.status_code == 200
+        etag = response["ETag"]
+
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert not response.content
+
+    org.name = "Org changed"
+    org.save()
+
+    response = client.get("/api/org", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()["data"][0]["name"] == "Org changed"
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_json_backends(backend, settings):
+    """
+    Test that the json backends produce equivalent output
+    """
+
+    settings.API_JSON_BACKEND = backend
+
+    data = {
+        "data": [
+            {
+                "id": 1,
+                "name": "Ünïcode",
+                "country": Country("US"),
+                "created": datetime.datetime(2022, 1, 1, 12, 30),
+                "updated": datetime.datetime(
+                    2022, 1, 1, 12, 30, tzinfo=datetime.timezone.utc
+                ),
+            }
+        ],
+        "meta": {},
+    }
+
+    assert json.loads(dumps(data)) == {
+        "data": [
+            {
+                "id": 1,
+                "name": "Ünïcode",
+                "country": "US",
+                "created": "2022-01-01T12:30:00",
+                "updated": "2022-01-01T12:30:00+00:00",
+            }
+        ],
+        "meta": {},
+    }
+
+    assert json.loads(dumps(data, indent=2)) == json.loads(dumps(data))
+
+
+@pytest.mark.django_db
+def test_sync_cursor(settings):
+    """
+    Test paging through changed objects with the incremental sync cursor
+    """
+
+    settings.API_CACHE_ENABLED = False
+
+    superuser = models.User.objects.create_user(
+        "su", "su@localhost", "su", is_superuser=True
+    )
+    orgs = [
+        models.Organization.objects.create(name=f"Org {i}", status="ok")
+        for i in range(5)
+    ]
+
+    # objects sharing the same updated timestamp are ordered by id
+
+    models.Organization.objects.filter(id__in=[orgs[0].id, orgs[1].id]).update(
+        updated=orgs[4].updated
+    )
+
+    client = APIClient()
+    client.force_authenticate(superuser)
+
+    def sync(cursor):
+        data = client.get("/api/org", {"cursor": cursor, "limit": 2}).json()
+        return [row["id"] for row in data["data"]], data["meta"]["cursor"]
+
+    ids, cursor = sync("")
+    assert ids == [orgs[2].id, orgs[3].id]
+    ids, cursor = sync(cursor)
+    assert ids == [orgs[0].id, orgs[1].id]
+    ids, cursor = sync(cursor)
+    assert ids == [orgs[4].id]
+
+    ids, next_cursor = sync(cursor)
+    assert ids == []
+    assert next_cursor == cursor
+
+    # deleted objects are included
+
+    orgs[0].delete()
+    ids, cursor = sync(cursor)
+    assert ids == [orgs[0].id]
+
+    response = client.get("/api/org", {"cursor": "invalid"})
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_advanced_search_filters(settings, django_assert_num_queries):
+    """
+    Test that the ix and fac advanced search filters are resolved
+    in a single query, regardless of the number of asns and related
+    objects
+    """
+
+    settings.API_CACHE_ENABLED = False
+
+    superuser = models.User.objects.create_user(
+        "su", "su@localhost", "su", is_superuser=True
+    )
+    client = APIClient()
+    client.force_authenticate(superuser)
+
+    orgs = [
+        models.Organization.objects.create(name=f"Org {i}", status="ok")
+        for i in range(3)
+    ]
+    exchanges = [
+        models.InternetExchange.objects.create(
+            name=f"IX {i}", org=orgs[0], status="ok"
+        )
+        for i in range(3)
+    ]
+    facilities = [
+        models.Facility.objects.create(name=f"Fac {i}", org=orgs[1], status="ok")
+        for i in range(3)
+    ]
+    models.IXLanPrefix.objects.create(
+        ixlan=exchanges[1].ixlan,
+        prefix="195.69.144.0/22",
+        protocol="IPv4",
+        status="ok",
+    )
+    models.InternetExchangeFacility.objects.create(
+        ix=exchanges[2], facility=facilities[2], status="ok"
+    )
+
+    def add_networks(count):
+        for i in range(count):
+            asn = 63311 + models.Network.objects.count()
+            net = models.Network.objects.create(
+                name=f"AS{asn}", asn=asn, org=orgs[2], status="ok"
+            )
+            for ix in exchanges[:2]:
+                models.NetworkIXLan.objects.create(
+                    network=net, ixlan=ix.ixlan, asn=asn, speed=1000, status="ok"
+                )
+            models.NetworkFacility.objects.create(
+                network=net, facility=facilities[0], status="ok"
+            )
+        asns = models.Network.objects.values_list("asn", flat=True)
+        return ",".join(str(asn) for asn in asns)
+
+    def search(tag, **params):
+        response = client.get(f"/api/{tag}", params)
+        assert response.status_code == 200
+        return sorted(row["id"] for row in response.json()["data"])
+
+    def prepared(serializer, **params):
+        with django_assert_num_queries(1):
+            qset, _ = serializer.prepare_query(
+                serializer.Meta.model.handleref.undeleted(),
+                **{key: [value] for key, value in params.items()},
+            )
+            return sorted(obj.id for obj in qset)
+
+    def org_ids(*orgs):
+        return ",".join(str(org.id) for org in orgs)
+
+    asns = add_networks(2)
+
+    assert search("ix", asn_overlap=asns) == [exchanges[0].id, exchanges[1].id]
+    assert search("fac", asn_overlap=asns) == [facilities[0].id]
+    assert search("ix", org_present=org_ids(orgs[1])) == [exchanges[2].id]
+    assert search("ix", org_not_present=org_ids(orgs[1])) == [
+        exchanges[0].id,
+        exchanges[1].id,
+    ]
+    assert search("fac", org_present=org_ids(orgs[0])) == [facilities[2].id]
+    assert search("fac", org_not_present=org_ids(orgs[0], orgs[2])) == [
+        facilities[1].id
+    ]
+    assert search("ix", ipblock="195.69.144") == [exchanges[1].id]
+
+    asns = add_networks(8)
+
+    ix = InternetExchangeSerializer
+    fac = FacilitySerializer
+
+    assert prepared(ix, asn_overlap=asns) == [exchanges[0].id, exchanges[1].id]
+    assert prepared(fac, asn_overlap=asns) == [facilities[0].id]
+    assert prepared(ix, org_present=org_ids(orgs[1], orgs[2])) == [
+        exchange.id for exchange in exchanges
+    ]
+    assert prepared(ix, org_not_present=org_ids(orgs[2])) == [exchanges[2].id]
+    assert prepared(fac, org_present=org_ids(orgs[2])) == [facilities[0].id]
+    assert prepared(fac, org_not_present=org_ids(orgs[2])) == [
+        facilities[1].id,
+        facilities[2].id,
+    ]
+    assert prepared(ix, ipblock="195.69.144") == [exchanges[1].id]
+
+
+@pytest.mark.django_db
+def test_conditional_get_before_serializing(settings, mocker):
+    """
+    Test that depth 0 list requests are answered with a 304 before
+    the queryset is serialized
+    """
+
+    settings.API_CACHE_ENABLED = False
+
+    superuser = models.User.objects.create_user(
+        "su", "su@localhost", "su", is_superuser=True
+    )
+    org = models.Organization.objects.create(name="Org", status="ok")
+    net = models.Network.objects.create(name="Net", asn=63311, org=org, status="ok")
+
+    client = APIClient()
+    client.force_authenticate(superuser)
+
+    # requests without If-None-Match do not run the aggregate query and
+    # get an ETag from the content
+
+    queryset_validator = mocker.spy(rest, "queryset_validator")
+
+    response = client.get("/api/net")
+    assert response.status_code == 200
+    assert "Last-Modified" not in response
+    assert not queryset_validator.called
+    etag = response["ETag"]
+
+    # the content ETag is still honored and swapped for the
+    # queryset validator
+
+    response = client.get("/api/net", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response["ETag"] != etag
+    etag = response["ETag"]
+
+    to_representation = mocker.spy(NetworkSerializer, "to_representation")
+
+    response = client.get("/api/net", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response["ETag"] == etag
+    assert not to_representation.called
+
+    # object counts change without touching `updated`
+
+    models.Network.objects.filter(id=net.id).update(ix_count=1)
+
+    response = client.get("/api/net", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()["data"][0]["ix_count"] == 1
+    etag = response["ETag"]
+
+    # related objects change
+
+    org.name = "Org changed"
+    org.save()
+
+    response = client.get("/api/net", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    etag = response["ETag"]
+
+    # rows leave the result set
+
+    models.Network.objects.filter(id=net.id).update(status="deleted")
+
+    response = client.get("/api/net", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()["data"] == []
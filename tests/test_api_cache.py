@@ -1,4 +1,5 @@
 import datetime
+import gzip
 import json
 import os
 import re
@@ -6,13 +7,26 @@ import tempfile
 
 import pytest
 from django.conf import settings
-from django.contrib.auth.models import Group
+from django.contrib.auth.models import AnonymousUser, Group
 from django.core.management import call_command
 from django.test import TestCase
 from django_grainy.models import GroupPermission, UserPermission
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 
+import peeringdb_server.management.commands.pdb_api_cache as api_cache
 import peeringdb_server.management.commands.pdb_api_test as api_test
 import peeringdb_server.models as models
+from peeringdb_server.api_cache import (
+    APICacheIndex,
+    APICacheLoader,
+    render_rows,
+    write_cache_file,
+    write_compressed_variants,
+)
+from peeringdb_server.permissions import APIPermissionsApplicator
+from peeringdb_server.renderers import dumps
+from peeringdb_server.rest import OrganizationViewSet
 
 from . import test_api as api_tests
 from .util import reset_group_ids
@@ -161,10 +175,403 @@ def test_no_api_throttle():
 
     for (dirpath, dirnames, filenames) in os.walk(settings.API_CACHE_ROOT):
         for f in filenames:
-            if f in ["log.log"]:
+            if not f.endswith(".json"):
                 continue
             path = os.path.join(settings.API_CACHE_ROOT, f)
             with open(path) as fh:
                 data_raw = fh.read()
                 data = json.loads(data_raw)
                 assert not data.get("message")
+
+
+def _cache_loader(path, filters=None, **params):
+    request = Request(APIRequestFactory().get("/api/org", params))
+    viewset = OrganizationViewSet(request=request, kwargs={})
+    loader = APICacheLoader(viewset, None, filters or {})
+    loader.path = path
+    return loader
+
+
+def test_api_cache_rows(tmp_path):
+    """
+    Test that rows are read from the row-per-line cache file
+    with skip, limit and fields applied
+    """
+
+    path = str(tmp_path / "org-0.json")
+    rows = [{"id": i, "name": f"Org {i}", "_grainy": "org"} for i in range(10)]
+
+    with open(path, "wb") as fh:
+        write_cache_file(fh, rows)
+
+    # still a valid json document
+    with open(path) as fh:
+        assert json.load(fh) == {"data": rows, "meta": {}}
+
+    assert list(_cache_loader(path).rows()) == rows
+    assert list(_cache_loader(path, skip=8).rows()) == rows[8:]
+    assert list(_cache_loader(path, limit=2).rows()) == rows[:2]
+    assert list(_cache_loader(path, skip=2, limit=3, fields="id").rows()) == [
+        {"id": 2, "_grainy": "org"},
+        {"id": 3, "_grainy": "org"},
+        {"id": 4, "_grainy": "org"},
+    ]
+
+    # empty cache file
+
+    with open(path, "wb") as fh:
+        write_cache_file(fh, [])
+
+    with open(path) as fh:
+        assert json.load(fh) == {"data": [], "meta": {}}
+
+    assert list(_cache_loader(path).rows()) == []
+
+    # empty cache file written before the format was fixed
+
+    with open(path, "wb") as fh:
+        fh.write(b'{"data": [\n\n], "meta": {}}')
+
+    assert list(_cache_loader(path).rows()) == []
+
+
+def test_api_cache_rows_legacy_format(tmp_path):
+    """
+    Test that cache files written as a single json document
+    can still be read
+    """
+
+    path = str(tmp_path / "org-0.json")
+    rows = [{"id": i, "name": f"Org {i}"} for i in range(10)]
+
+    with open(path, "w") as fh:
+        json.dump({"data": rows, "meta": {}}, fh)
+
+    assert list(_cache_loader(path).rows()) == rows
+    assert list(_cache_loader(path, skip=2, limit=3).rows()) == rows[2:5]
+
+
+def test_api_cache_index(tmp_path):
+    """
+    Test that the row offset index lets the loader seek
+    to the requested page
+    """
+
+    path = str(tmp_path / "org-0.json")
+    rows = [{"id": i * 2 + 1, "name": f"Org {i}"} for i in range(10)]
+
+    with open(path, "wb") as fh:
+        index = write_cache_file(fh, rows)
+    with open(APICacheIndex.index_path(path), "wb") as fh:
+        index.write(fh)
+
+    index = APICacheIndex.load(path)
+    assert index.count == 10
+
+    with open(path, "rb") as fh:
+        fh.seek(index.row_offset(3))
+        assert json.loads(fh.readline().rstrip(b",\n")) == rows[3]
+
+    assert index.row_offset(10) is None
+
+    assert list(_cache_loader(path, skip=4, limit=2).rows()) == rows[4:6]
+    assert list(_cache_loader(path, skip=20).rows()) == []
+
+    # stale index is ignored
+
+    with open(path, "ab") as fh:
+        fh.write(b"\n")
+
+    assert APICacheIndex.load(path) is None
+    assert list(_cache_loader(path, skip=4, limit=2).rows()) == rows[4:6]
+
+
+def test_api_cache_filters(tmp_path):
+    """
+    Test that simple filters are answered from the api-cache snapshot
+    and that unsupported filters fall back to the database
+    """
+
+    path = str(tmp_path / "org-0.json")
+    rows = [
+        {"id": i + 1, "name": f"Örg {i}", "city": "Chicago" if i % 2 else "Paris"}
+        for i in range(10)
+    ]
+
+    with open(path, "wb") as fh:
+        write_cache_file(fh, rows)
+
+    def match(**filters):
+        loader = _cache_loader(path, filters)
+        loader.matches = loader.match_filters()
+        if loader.matches is None:
+            return None
+        return list(loader.rows())
+
+    assert match(name__iexact="org 3") == [rows[3]]
+    assert match(id__in=["2", "4", "40"]) == [rows[1], rows[3]]
+    assert match(id__gt="8") == rows[8:]
+    assert match(name__icontains="RG 1") == [rows[1]]
+    assert match(city__istartswith="chi", id__lte="4") == [rows[1], rows[3]]
+    assert match(name__iexact="nothing") == []
+
+    # unsupported filters
+
+    assert match(created__startswith="2020-01-01") is None
+    assert match(net_set__asn="63311") is None
+    assert match(id__in=["abc"]) is None
+
+    # snapshot is rebuilt when the cache file changes
+
+    with open(path, "wb") as fh:
+        write_cache_file(fh, rows[:5])
+
+    assert match(id__gt="3") == rows[3:5]
+
+
+@pytest.mark.django_db
+def test_api_cache_conditional_get(settings, tmp_path):
+    """
+    Test that cached responses carry ETag and Last-Modified headers
+    derived from the cache file and honor conditional requests
+    """
+
+    settings.API_CACHE_ENABLED = True
+    settings.API_CACHE_ROOT = str(tmp_path)
+
+    superuser = models.User.objects.create_user(
+        "su", "su@localhost", "su", is_superuser=True
+    )
+    client = APIClient()
+    client.force_authenticate(superuser)
+
+    path = tmp_path / "org-0.json"
+    rows = [{"id": 1, "name": "Org", "_grainy": "organization.1"}]
+
+    with open(path, "wb") as fh:
+        write_cache_file(fh, rows)
+
+    response = client.get("/api/org")
+    assert response.status_code == 200
+    assert response.streaming
+    etag = response["ETag"]
+    last_modified = response["Last-Modified"]
+
+    response = client.get("/api/org", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+
+    response = client.get("/api/org", HTTP_IF_MODIFIED_SINCE=last_modified)
+    assert response.status_code == 304
+
+    # different query, different etag
+
+    response = client.get("/api/org?fields=id", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+
+    # regenerated cache file, different etag
+
+    with open(path, "wb") as fh:
+        write_cache_file(fh, rows + [{"id": 2, "name": "Org 2"}])
+    os.utime(path, (os.path.getatime(path), os.path.getmtime(path) + 60))
+
+    response = client.get("/api/org", HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_api_cache_compressed_variants(settings, tmp_path):
+    """
+    Test that pre-compressed cache file variants are served to anonymous
+    requests that accept them and match the uncompressed response
+    """
+
+    settings.API_CACHE_ENABLED = True
+    settings.API_CACHE_ROOT = str(tmp_path)
+
+    guest_group = Group.objects.create(name=settings.GRAINY_ANONYMOUS_GROUP)
+    GroupPermission.objects.create(
+        group=guest_group, namespace="peeringdb.organization.1", permission=0x01
+    )
+
+    path = str(tmp_path / "org-0.json")
+    rows = [
+        {"id": 1, "name": "Org", "_grainy": "peeringdb.organization.1"},
+        {"id": 2, "name": "Hidden", "_grainy": "peeringdb.organization.2"},
+    ]
+
+    with open(path, "wb") as fh:
+        write_cache_file(fh, rows)
+
+    applicator = APIPermissionsApplicator(AnonymousUser())
+    meta = {"generated": os.path.getmtime(path)}
+    variants = write_compressed_variants(path, path, applicator, meta)
+    assert path + ".gz" in variants
+
+    client = APIClient()
+
+    response = client.get("/api/org")
+    assert not response.has_header("Content-Encoding")
+    content = response.getvalue()
+    assert json.loads(content)["data"] == [{"id": 1, "name": "Org"}]
+
+    response = client.get("/api/org", HTTP_ACCEPT_ENCODING="gzip, deflate")
+    assert response["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response["Vary"]
+    assert gzip.decompress(response.getvalue()) == content
+
+    # not accepted
+
+    response = client.get("/api/org", HTTP_ACCEPT_ENCODING="gzip;q=0")
+    assert not response.has_header("Content-Encoding")
+
+    # field filtering and pagination are rendered per request
+
+    response = client.get("/api/org?fields=id", HTTP_ACCEPT_ENCODING="gzip")
+    assert not response.has_header("Content-Encoding")
+
+    # stale variant is not served
+
+    with open(path, "wb") as fh:
+        write_cache_file(fh, rows[:1])
+    os.utime(path, (os.path.getatime(path), os.path.getmtime(path) + 60))
+
+    response = client.get("/api/org", HTTP_ACCEPT_ENCODING="gzip")
+    assert not response.has_header("Content-Encoding")
+
+
+@pytest.mark.django_db
+def test_api_cache_incremental(tmp_path):
+    """
+    Test that incremental regeneration only renders the cache
+    files affected by changed objects
+    """
+
+    Group.objects.create(name="guest")
+    Group.objects.create(name="user")
+    reset_group_ids()
+
+    settings.API_CACHE_ROOT = str(tmp_path)
+    settings.API_CACHE_LOG = str(tmp_path / "log.log")
+
+    call_command("pdb_generate_test_data", limit=2, commit=True)
+    date = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%Y%m%d")
+    call_command("pdb_api_cache", date=date)
+    settings.GENERATING_API_CACHE = False
+
+    def mtimes():
+        return {
+            f: os.path.getmtime(tmp_path / f)
+            for f in os.listdir(tmp_path)
+            if f.endswith(".json") and f != "state.json"
+        }
+
+    before = mtimes()
+    assert len(before) == 40
+
+    # nothing changed, nothing is rendered
+
+    call_command("pdb_api_cache", date=date, incremental=True)
+    settings.GENERATING_API_CACHE = False
+    assert mtimes() == before
+
+    # a contact changed
+
+    poc = models.NetworkContact.objects.first()
+    poc.name = "Changed"
+    poc.save()
+
+    call_command("pdb_api_cache", date=date, incremental=True)
+    settings.GENERATING_API_CACHE = False
+    after = mtimes()
+
+    changed = {f for f in after if after[f] != before[f]}
+
+    assert changed == {
+        "poc-0.json",
+        "poc-1.json",
+        "poc-2.json",
+        "poc-3.json",
+        "net-0.json",
+        "net-1.json",
+    } | {f"{tag}-{depth}.json" for tag in api_cache.VIEWSETS for depth in [2, 3]}
+
+    with open(tmp_path / "poc-0.json") as fh:
+        assert "Changed" in [row["name"] for row in json.load(fh)["data"]]
+
+
+@pytest.mark.django_db
+def test_api_cache_incremental_cutoff(tmp_path, monkeypatch):
+    """
+    Test that objects updated after the cache cutoff are not recorded
+    in the state and get picked up by the next incremental run
+    """
+
+    Group.objects.create(name="guest")
+    Group.objects.create(name="user")
+    reset_group_ids()
+
+    settings.API_CACHE_ROOT = str(tmp_path)
+    settings.API_CACHE_LOG = str(tmp_path / "log.log")
+
+    call_command("pdb_generate_test_data", limit=2, commit=True)
+    date = (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%Y%m%d")
+    call_command("pdb_api_cache", date=date)
+    settings.GENERATING_API_CACHE = False
+
+    # a contact is changed after the cutoff has been taken, but before
+    # the state is collected
+
+    collect_state = api_cache.Command.collect_state
+
+    def change_and_collect_state(self, cutoff):
+        poc = models.NetworkContact.objects.first()
+        poc.name = "Changed"
+        poc.save()
+        return collect_state(self, cutoff)
+
+    monkeypatch.setattr(api_cache.Command, "collect_state", change_and_collect_state)
+    call_command("pdb_api_cache", incremental=True)
+    settings.GENERATING_API_CACHE = False
+    monkeypatch.undo()
+
+    call_command("pdb_api_cache", date=date, incremental=True)
+    settings.GENERATING_API_CACHE = False
+
+    with open(tmp_path / "poc-0.json") as fh:
+        assert "Changed" in [row["name"] for row in json.load(fh)["data"]]
+
+
+@pytest.mark.parametrize("backend", ["json", "orjson"])
+def test_render_rows_json_backend(settings, backend):
+    """
+    Test that cached rows are rendered by the configured json backend,
+    the same way responses from the database are rendered
+    """
+
+    if backend == "orjson":
+        pytest.importorskip("orjson")
+
+    settings.API_JSON_BACKEND = backend
+
+    class Applicator:
+        denied = None
+
+        def apply(self, row):
+            return row
+
+    rows = [{"id": 1, "name": "Örg"}, {"id": 2, "name": "Org\n2"}]
+    meta = {"generated": 1.5}
+
+    rendered = b"".join(render_rows(iter(rows), Applicator(), meta))
+    expected = dumps({"data": rows, "meta": meta})
+    if isinstance(expected, str):
+        expected = expected.encode("utf-8")
+
+    assert rendered == expected
+
+    rendered = b"".join(render_rows(iter([]), Applicator(), meta))
+    expected = dumps({"data": [], "meta": meta})
+    if isinstance(expected, str):
+        expected = expected.encode("utf-8")
+
+    assert rendered == expected
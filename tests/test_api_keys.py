@@ -120,7 +120,7 @@ class DummyRestClientWithKeyAuth(RestClient):
 
         assert res.charset == "utf-8"
 
-        return DummyResponse(res.status_code, res.content)
+        return DummyResponse(res.status_code, res.getvalue())
 
 
 URL = settings.API_URL
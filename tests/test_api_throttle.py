@@ -1,7 +1,10 @@
+import fakeredis
 import pytest
 from django.core.cache import cache
 from django.core.management import call_command
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework.response import Response
 from rest_framework.test import APIClient, APIRequestFactory
 
@@ -14,6 +17,16 @@ from peeringdb_server.rest_throttles import (
     ResponseSizeThrottle,
 )
 
+from peeringdb_server.throttle_storage import (
+    STORAGES,
+    CacheThrottleStorage,
+    LocalThrottleStorage,
+    RedisThrottleStorage,
+    get_throttle_storage,
+    window_clamp,
+    window_wait,
+)
+
 from .util import mock_csrf_session
 
 
@@ -108,6 +121,135 @@ class APIThrottleTests(TestCase):
             == "Rate limit exceeded (user)"
         )
 
+    def test_environment_setting_queries(self):
+        """
+        Test that environment settings are read from the in-process
+        snapshot and that changes are picked up
+        """
+
+        request = self.factory.get("/")
+        mock_csrf_session(request)
+        view = MockView.as_view({"get": "get"})
+
+        models.ENV_SETTINGS.clear()
+        with CaptureQueriesContext(connection) as cold:
+            view(request)
+
+        with CaptureQueriesContext(connection) as warm:
+            view(request)
+
+        # snapshot and version stamp are only loaded once
+
+        assert len(cold) - len(warm) == 2
+
+        with self.assertNumQueries(0):
+            assert (
+                models.EnvironmentSetting.get_setting_value("API_THROTTLE_RATE_ANON")
+                == "10/minute"
+            )
+
+        # saving a setting drops the snapshot of this process
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.rate_anon.value_str = "20/minute"
+            self.rate_anon.save()
+        assert (
+            models.EnvironmentSetting.get_setting_value("API_THROTTLE_RATE_ANON")
+            == "20/minute"
+        )
+
+        # changes by other processes are picked up once the version stamp
+        # is bumped and the snapshot is due to be checked
+
+        models.EnvironmentSetting.objects.filter(
+            setting="API_THROTTLE_RATE_ANON"
+        ).update(value_str="30/minute")
+        cache.set(models.EnvironmentSetting.version_cache_key, "other", timeout=None)
+
+        assert (
+            models.EnvironmentSetting.get_setting_value("API_THROTTLE_RATE_ANON")
+            == "20/minute"
+        )
+
+        with override_settings(ENV_SETTINGS_CACHE_TIMEOUT=0):
+            assert (
+                models.EnvironmentSetting.get_setting_value("API_THROTTLE_RATE_ANON")
+                == "30/minute"
+            )
+
+    def test_environment_setting_rollback(self):
+        """
+        Test that settings read after a write that is rolled back
+        are not kept in the snapshot
+        """
+
+        models.ENV_SETTINGS.clear()
+
+        assert (
+            models.EnvironmentSetting.get_setting_value("API_THROTTLE_RATE_ANON")
+            == "10/minute"
+        )
+
+        with pytest.raises(RuntimeError):
+            with transaction.atomic():
+                self.rate_anon.value_str = "20/minute"
+                self.rate_anon.save()
+                assert (
+                    models.EnvironmentSetting.get_setting_value(
+                        "API_THROTTLE_RATE_ANON"
+                    )
+                    == "20/minute"
+                )
+                raise RuntimeError()
+
+        assert (
+            models.EnvironmentSetting.get_setting_value("API_THROTTLE_RATE_ANON")
+            == "10/minute"
+        )
+
+    @override_settings(API_THROTTLE_STORAGE="local")
+    def test_local_throttle_storage(self):
+        """
+        Test that throttle state can be kept outside of the
+        database cache
+        """
+
+        request = self.factory.get("/")
+        mock_csrf_session(request)
+        view = MockView.as_view({"get": "get"})
+
+        get_throttle_storage().clear()
+
+        # warm up environment settings
+
+        response = view(request)
+        assert response.status_code == 200
+
+        with self.assertNumQueries(0):
+            for dummy in range(9):
+                response = view(request)
+                assert response.status_code == 200
+
+            response = view(request)
+            assert response.status_code == 429
+
+    @override_settings(API_THROTTLE_STORAGE="local")
+    def test_response_size_throttle_storage(self):
+        """
+        Test that expected response sizes are kept in the throttle
+        storage backend
+        """
+
+        get_throttle_storage().clear()
+
+        ResponseSizeThrottle.cache_response_size(self.factory.get("/"), 1024)
+
+        with self.assertNumQueries(0):
+            assert (
+                ResponseSizeThrottle.expected_response_size(self.factory.get("/"))
+                == 1024
+            )
+
     def test_anon_requests_below_throttle_rate(self):
         """
         Test if request rate is limited for anonymous users
@@ -810,3 +952,134 @@ class APIThrottleTests(TestCase):
         request.META.update(HTTP_AUTHORIZATION=f"Api-Key {key_b}")
         response = MelissaMockView.as_view({"get": "get"})(request)
         assert response.status_code == 200
+
+
+@override_settings(API_THROTTLE_ALGORITHM="sliding_window")
+class APIThrottleWindowTests(APIThrottleTests):
+    """
+    API tests using sliding window counters
+    """
+
+
+@pytest.fixture(params=["cache", "local", "redis"])
+def throttle_storage(request, db):
+    if request.param == "redis":
+        return RedisThrottleStorage(fakeredis.FakeRedis())
+    if request.param == "local":
+        return LocalThrottleStorage()
+    cache.clear()
+    return CacheThrottleStorage()
+
+
+def test_throttle_storage_hit(throttle_storage):
+    """
+    Test the sliding window of the throttle storage backends
+    """
+
+    for now in [100, 101, 102]:
+        allowed, history = throttle_storage.hit("key", now, 10, 3)
+        assert allowed
+        assert history[0] == now
+
+    allowed, history = throttle_storage.hit("key", 103, 10, 3)
+    assert not allowed
+    assert history == [102, 101, 100]
+
+    # other keys are counted separately
+
+    assert throttle_storage.hit("other", 103, 10, 3)[0]
+
+    # requests older than the window duration are dropped
+
+    allowed, history = throttle_storage.hit("key", 110.5, 10, 3)
+    assert allowed
+    assert history == [110.5, 102, 101]
+
+    # history can be replaced
+
+    throttle_storage.set("key", [110.5], 10)
+    allowed, history = throttle_storage.hit("key", 111, 10, 3)
+    assert allowed
+    assert history == [111, 110.5]
+
+
+@override_settings(API_THROTTLE_STORAGE="redis", API_THROTTLE_REDIS_URL="")
+def test_throttle_storage_fallback(caplog):
+    """
+    Test that the redis storage falls back to the django cache
+    if no redis server is configured
+    """
+    STORAGES.clear()
+    assert isinstance(get_throttle_storage(), CacheThrottleStorage)
+    assert "falling back to the django cache" in caplog.text
+
+
+def test_throttle_storage_value(throttle_storage):
+    """
+    Test the plain values of the throttle storage backends
+    """
+
+    assert throttle_storage.get_value("size") is None
+
+    throttle_storage.set_value("size", 1024, 10)
+    assert throttle_storage.get_value("size") == 1024
+    assert throttle_storage.get_value("other") is None
+
+
+def test_throttle_storage_count(throttle_storage):
+    """
+    Test the sliding window counters of the throttle storage backends
+    """
+
+    for now in [100, 101, 102]:
+        assert throttle_storage.count("key", now, 10, 3)[0]
+
+    allowed, state = throttle_storage.count("key", 103, 10, 3)
+    assert not allowed
+    assert state == (10, 100, 0, 3)
+
+    # previous window is weighed by its overlap with the sliding window
+
+    allowed, state = throttle_storage.count("key", 112, 10, 3)
+    assert allowed
+    assert state == (10, 110, 3, 1)
+
+    assert throttle_storage.count("key", 115, 10, 3)[0]
+    assert not throttle_storage.count("key", 116, 10, 3)[0]
+
+    # the estimated count is carried over when the duration changes
+
+    allowed, state = throttle_storage.count("key", 116, 60, 4)
+    assert allowed
+    assert state == pytest.approx((60, 60, 0, 4.2))
+
+    # counters can be replaced
+
+    throttle_storage.set_window("key", (10, 110, 0, 0), 10)
+    allowed, state = throttle_storage.count("key", 117, 10, 3)
+    assert allowed
+    assert state == (10, 110, 0, 1)
+
+
+def test_window_wait():
+    """
+    Test the wait time and clamping of sliding window counters
+    """
+
+    # current window is full, wait for the next one
+
+    assert window_wait((10, 100, 0, 3), 105, 3) == 5
+
+    # previous window needs to decay
+
+    assert window_wait((10, 100, 4, 1), 102, 3) == 3
+
+    # rate limit lowered to 1 request
+
+    state = window_clamp((10, 100, 4, 10), 105, 1)
+    assert state == (10, 100, 0, 1)
+    assert window_wait(state, 105, 1) == 5
+
+    state = window_clamp((10, 100, 4, 0), 105, 1)
+    assert state == (10, 100, 2, 0)
+    assert window_wait(state, 105, 1) == 0
@@ -1,6 +1,8 @@
+import concurrent.futures
 import datetime
 import io
 import json
+import pickle
 import time
 from pprint import pprint
 
@@ -13,6 +15,7 @@ from django.core.management import call_command
 from django.test import override_settings
 
 from peeringdb_server import ixf
+from peeringdb_server.management.commands import pdb_ixf_ixp_member_import
 from peeringdb_server.models import (
     DeskProTicket,
     InternetExchange,
@@ -98,6 +101,263 @@ def test_ignore_import_enabled(entities_base):
     )
 
 
+@pytest.mark.django_db
+def test_fetch_concurrently(entities_base, mocker):
+    """
+    Test that member lists are fetched into the IX-F cache before the
+    import and that fetch errors are passed on to the import
+    """
+
+    ixf_import_data = setup_test_data("ixf.member.0")
+
+    def get(url, timeout=None, headers=None, stream=False):
+        response = mocker.Mock()
+        if url == "http://www.localhost.com/0.json":
+            response.status_code = 200
+            response.encoding = None
+            response.headers = {}
+            response.iter_content.return_value = [json.dumps(ixf_import_data).encode()]
+        else:
+            response.status_code = 503
+        return response
+
+    requests_get = mocker.patch("peeringdb_server.ixf.requests.get", side_effect=get)
+
+    ixlans = entities_base["ixlan"]
+    for i, ixlan in enumerate(ixlans):
+        ixlan.ixf_ixp_import_enabled = True
+        ixlan.ixf_ixp_member_list_url = f"http://www.localhost.com/{i}.json"
+        ixlan.save()
+        ixlan.ix.request_ixf_import()
+
+    importer = ixf.Importer()
+    cache.delete(importer.cache_key(ixlans[0].ixf_ixp_member_list_url))
+
+    call_command(
+        "pdb_ixf_ixp_member_import", process_requested=0, commit=True, fetch_workers=2
+    )
+
+    assert requests_get.call_count == 2
+    assert importer.fetch_cached(ixlans[0].ixf_ixp_member_list_url)["member_list"]
+
+    for ixlan in ixlans:
+        ixlan.refresh_from_db()
+        ixlan.ix.refresh_from_db()
+
+    assert ixlans[0].ix.ixf_import_request_status == "finished"
+    assert ixlans[1].ix.ixf_import_request_status == "error"
+    assert "503" in ixlans[1].ixf_ixp_import_error
+
+
+@pytest.mark.django_db
+def test_skip_unchanged(entities_base, mocker):
+    """
+    Test that member lists are fetched conditionally and that the
+    import is skipped if nothing changed since the last import
+    """
+
+    content = json.dumps(setup_test_data("ixf.member.0")).encode()
+
+    def get(url, timeout=None, headers=None, stream=False):
+        response = mocker.Mock()
+        if headers.get("If-None-Match") == '"v1"':
+            response.status_code = 304
+        else:
+            response.status_code = 200
+            response.encoding = None
+            response.headers = {"ETag": '"v1"'}
+            response.iter_content.return_value = [content]
+        return response
+
+    requests_get = mocker.patch("peeringdb_server.ixf.requests.get", side_effect=get)
+    parse = mocker.spy(ixf.Importer, "parse")
+
+    ixlan = entities_base["ixlan"][0]
+    ixlan.ixf_ixp_import_enabled = True
+    ixlan.ixf_ixp_member_list_url = "http://www.localhost.com/unchanged.json"
+    ixlan.save()
+
+    # have the import record a proposal as ix-f member data
+
+    net = Network.objects.get(asn=2906)
+    net.allow_ixp_update = False
+    net.save()
+
+    cache.delete(ixf.Importer().cache_key(ixlan.ixf_ixp_member_list_url))
+
+    call_command("pdb_ixf_ixp_member_import", ixlan=[ixlan.id], commit=True)
+    assert parse.call_count == 1
+    assert requests_get.call_args[1]["headers"] == {}
+
+    ixlan.ix.refresh_from_db()
+    last_import = ixlan.ix.ixf_last_import
+    net_count = ixlan.ix.ixf_net_count
+    fetched = {
+        ixfmd.id: ixfmd.fetched for ixfmd in IXFMemberData.objects.filter(ixlan=ixlan)
+    }
+    assert fetched
+
+    call_command("pdb_ixf_ixp_member_import", ixlan=[ixlan.id], commit=True)
+    assert parse.call_count == 1
+    assert requests_get.call_args[1]["headers"] == {"If-None-Match": '"v1"'}
+
+    ixlan.ix.refresh_from_db()
+    assert ixlan.ix.ixf_last_import > last_import
+    assert ixlan.ix.ixf_net_count == net_count
+
+    # ix-f member data is still marked as fetched by the skipped import
+
+    for ixfmd in IXFMemberData.objects.filter(ixlan=ixlan):
+        assert ixfmd.fetched > fetched[ixfmd.id]
+
+    # changes to relevant database state cause a full import
+
+    net = Network.objects.filter(
+        asn__in=[m["asnum"] for m in json.loads(content)["member_list"]]
+    ).first()
+    net.allow_ixp_update = not net.allow_ixp_update
+    net.save()
+
+    call_command("pdb_ixf_ixp_member_import", ixlan=[ixlan.id], commit=True)
+    assert parse.call_count == 2
+
+
+class PicklingExecutor:
+    """
+    Runs process pool jobs in the current process (so they can use the
+    test database), pickling arguments and results as a process pool would
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        try:
+            result = fn(*pickle.loads(pickle.dumps(args)))
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(pickle.loads(pickle.dumps(result)))
+        return future
+
+
+@pytest.mark.django_db
+def test_import_workers(entities_base, mocker):
+    """
+    Test that imports run in worker processes and that their logs,
+    notifications and status updates are collected
+    """
+
+    ixf_import_data = setup_test_data("ixf.member.0")
+
+    # network needs to accept the proposal, so a notification is queued
+    entities_base["net"]["UPDATE_ENABLED"].allow_ixp_update = False
+    entities_base["net"]["UPDATE_ENABLED"].save()
+
+    importer = ixf.Importer()
+    cache.set(
+        importer.cache_key("http://www.localhost.com"), ixf_import_data, timeout=None
+    )
+    ixlans = entities_base["ixlan"]
+    for ixlan in ixlans:
+        ixlan.ixf_ixp_import_enabled = True
+        ixlan.ixf_ixp_member_list_url = "http://www.localhost.com"
+        ixlan.save()
+        ixlan.ix.request_ixf_import()
+
+    module = "peeringdb_server.management.commands.pdb_ixf_ixp_member_import"
+    mocker.patch(f"{module}.ProcessPoolExecutor", PicklingExecutor)
+    mocker.patch(f"{module}.connections.close_all")
+    notify_proposals = mocker.spy(ixf.Importer, "notify_proposals")
+
+    out = io.StringIO()
+    call_command(
+        "pdb_ixf_ixp_member_import",
+        process_requested=0,
+        commit=True,
+        cache=True,
+        workers=2,
+        stdout=out,
+    )
+
+    output = out.getvalue()
+    for ixlan in ixlans:
+        assert f"Processing {ixlan.ix.name} ({ixlan.id})" in output
+
+    assert (
+        InternetExchange.objects.filter(ixf_import_request_status="finished").count()
+        == 2
+    )
+
+    # consolidated notifications are sent once, for all ixlans
+
+    assert notify_proposals.call_count == 1
+    notifications = notify_proposals.call_args[0][0].notifications
+    assert [n["ixf_member_data"].asn for n in notifications] == [2906]
+
+
+@pytest.mark.django_db
+def test_import_workers_error(entities_base, mocker):
+    """
+    Test that a failing worker job is recorded as a runtime error of
+    its ixlan and does not stop the other imports
+    """
+
+    ixf_import_data = setup_test_data("ixf.member.0")
+
+    importer = ixf.Importer()
+    cache.set(
+        importer.cache_key("http://www.localhost.com"), ixf_import_data, timeout=None
+    )
+    ixlans = entities_base["ixlan"]
+    for ixlan in ixlans:
+        ixlan.ixf_ixp_import_enabled = True
+        ixlan.ixf_ixp_member_list_url = "http://www.localhost.com"
+        ixlan.save()
+        ixlan.ix.request_ixf_import()
+
+    module = "peeringdb_server.management.commands.pdb_ixf_ixp_member_import"
+    worker = pdb_ixf_ixp_member_import._import_ixlan_worker
+    failing = ixlans[0]
+
+    def import_ixlan_worker(options, ixlan_id, *args):
+        if ixlan_id == failing.id:
+            raise RuntimeError("worker failed")
+        return worker(options, ixlan_id, *args)
+
+    mocker.patch(f"{module}.ProcessPoolExecutor", PicklingExecutor)
+    mocker.patch(f"{module}.connections.close_all")
+    mocker.patch(f"{module}._import_ixlan_worker", import_ixlan_worker)
+
+    out = io.StringIO()
+    call_command(
+        "pdb_ixf_ixp_member_import",
+        process_requested=0,
+        commit=True,
+        cache=True,
+        workers=2,
+        stdout=out,
+    )
+
+    output = out.getvalue()
+    assert f"Ixlan {failing.ix.name} (id={failing.id})" in output
+    assert "ERROR: worker failed" in output
+
+    for ixlan in ixlans:
+        ixlan.ix.refresh_from_db()
+        if ixlan == failing:
+            assert ixlan.ix.ixf_import_request_status == "error"
+        else:
+            assert ixlan.ix.ixf_import_request_status == "finished"
+
+
 @pytest.mark.django_db
 def test_reset_hints(entities, data_cmd_ixf_hints):
     ixf_import_data = json.loads(data_cmd_ixf_hints.json)
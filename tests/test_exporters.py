@@ -10,13 +10,16 @@ import re
 import pytest
 import reversion
 from django.core.management import call_command
+from django.db import connection
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 
 from peeringdb_server.models import (
     Facility,
     InternetExchange,
     IXLan,
     Network,
+    NetworkContact,
     NetworkFacility,
     NetworkIXLan,
     Organization,
@@ -295,3 +298,113 @@ class AdvancedSearchExportTest(ClientCase):
         call_command("pdb_api_cache", date=datetime.datetime.now().strftime("%Y%m%d"))
 
         self.test_export_org_csv()
+
+
+def _ixf_export(client, ix, pretty=False):
+    url = f"/export/ix/{ix.id}/ixp-member-list"
+    response = client.get(f"{url}?pretty" if pretty else url)
+    assert response.status_code == 200
+    if response.streaming:
+        return b"".join(response.streaming_content).decode("utf-8"), True
+    return response.content.decode("utf-8"), False
+
+
+@pytest.mark.django_db
+def test_export_ixf_ix_members(settings, mocker):
+    """
+    Test the IX-F member list export, its query count and caching
+    """
+
+    settings.IXF_EXPORT_CACHE_TIMEOUT = 60
+
+    org = Organization.objects.create(name="Test Org", status="ok")
+    ix = InternetExchange.objects.create(name="Test IX", org=org, status="ok")
+    client = Client()
+
+    def add_network(asn, connections):
+        net = Network.objects.create(
+            name=f"AS{asn}",
+            asn=asn,
+            org=org,
+            status="ok",
+            irr_as_set=f"AS-{asn}",
+            policy_general="Selective",
+        )
+        NetworkContact.objects.create(
+            network=net,
+            role="Policy",
+            visible="Public",
+            email=f"{asn}@localhost",
+            phone="+12065550199",
+            status="ok",
+        )
+        NetworkContact.objects.create(
+            network=net, role="NOC", visible="Users", email="hidden@localhost"
+        )
+        for i in range(connections):
+            NetworkIXLan.objects.create(
+                network=net,
+                ixlan=ix.ixlan,
+                asn=asn,
+                speed=1000 * (i + 1),
+                ipaddr4=f"195.69.{asn % 256}.{i + 1}",
+                status="ok",
+            )
+        return net
+
+    add_network(63311, 2)
+    add_network(63312, 1)
+
+    with CaptureQueriesContext(connection) as captured:
+        content, streamed = _ixf_export(client, ix)
+    queries = len(captured.captured_queries)
+    assert streamed
+
+    data = json.loads(content)
+    assert data["ixp_list"] == [{"ixp_id": ix.id, "shortname": "Test IX"}]
+    members = {member["asnum"]: member for member in data["member_list"]}
+    assert sorted(members) == [63311, 63312]
+    assert members[63311]["contact_email"] == ["63311@localhost"]
+    assert members[63311]["peering_policy"] == "selective"
+    assert sorted(
+        cxn["if_list"][0]["if_speed"] for cxn in members[63311]["connection_list"]
+    ) == [1000, 2000]
+    assert members[63312]["connection_list"][0]["vlan_list"] == [
+        {
+            "ipv4": {
+                "address": "195.69.80.1",
+                "routeserver": False,
+                "max_prefix": None,
+                "as_macro": "AS-63312",
+            }
+        }
+    ]
+
+    # served from the cache until the data changes, stamped with the
+    # time it is served
+
+    mocker.patch(
+        "peeringdb_server.export_views.ixf_export_timestamp",
+        return_value="2030-01-01T00:00:00Z",
+    )
+    cached = content.replace(data["timestamp"], "2030-01-01T00:00:00Z", 1)
+    assert _ixf_export(client, ix) == (cached, False)
+
+    for asn in range(63313, 63323):
+        add_network(asn, 2)
+
+    with CaptureQueriesContext(connection) as captured:
+        content, streamed = _ixf_export(client, ix)
+    assert streamed
+    assert len(json.loads(content)["member_list"]) == 12
+    assert len(captured.captured_queries) == queries
+
+    # pretty output matches json.dumps
+
+    content, _ = _ixf_export(client, ix, pretty=True)
+    assert content == json.dumps(json.loads(content), indent=2)
+
+    settings.IXF_EXPORT_CACHE_TIMEOUT = 0
+    content, streamed = _ixf_export(client, ix)
+    assert streamed
+    assert len(json.loads(content)["member_list"]) == 12
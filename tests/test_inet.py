@@ -2,8 +2,17 @@ import ipaddress
 
 import pytest
 import pytest_filedata
+from django.core.cache import cache
+from django.db import transaction
+from django.test import override_settings
 
-from peeringdb_server.inet import RdapNotFoundError, renumber_ipaddress
+from peeringdb_server.inet import PrefixIndex, RdapNotFoundError, renumber_ipaddress
+from peeringdb_server.models import (
+    IXPFX_INDEX,
+    InternetExchange,
+    IXLanPrefix,
+    Organization,
+)
 
 
 def test_rdap_asn_lookup(rdap):
@@ -124,3 +133,125 @@ def test_ipaddress6_compression(input_str, compressed):
     """
     ipv6 = ipaddress.ip_address(input_str)
     assert str(ipv6) == compressed
+
+
+def test_prefix_index():
+    index = PrefixIndex(
+        [
+            ("10.0.0.0/8", "a"),
+            ("10.1.0.0/16", "b"),
+            ("10.1.2.0/24", "c"),
+            ("10.0.0.0/24", "d"),
+            ("10.2.0.0/16", "e"),
+            ("2001:db8::/32", "f"),
+            ("2001:db8:1::/48", "g"),
+        ]
+    )
+
+    assert index.lookup("10.1.2.3") == ["c", "b", "a"]
+    assert index.lookup("10.0.0.1") == ["d", "a"]
+    assert index.lookup("10.3.0.1") == ["a"]
+    assert index.lookup(ipaddress.ip_address("10.2.255.255")) == ["e", "a"]
+    assert index.lookup("11.0.0.1") == []
+    assert index.lookup("2001:db8:1::1") == ["g", "f"]
+    assert index.lookup("2001:db9::1") == []
+    assert index.lookup("invalid") == []
+    assert index.lookup(None) == []
+
+
+@pytest.mark.django_db
+def test_ixlan_prefix_index(django_assert_num_queries):
+    org = Organization.objects.create(name="Test Org", status="ok")
+    ix = InternetExchange.objects.create(name="Test IX", org=org, status="ok")
+    ixpfx = IXLanPrefix.objects.create(
+        ixlan=ix.ixlan, status="ok", prefix="195.69.144.0/22", protocol="IPv4"
+    )
+
+    # the writes above are treated as committed
+
+    IXPFX_INDEX.clear()
+
+    assert ix.ixlan.test_ipv4_address("195.69.145.1")
+    assert not ix.ixlan.test_ipv4_address("195.69.148.1")
+    assert list(IXLanPrefix.whereis_ip("195.69.145.1")) == [ixpfx]
+
+    index = IXLanPrefix.index()
+    with django_assert_num_queries(0):
+        assert IXLanPrefix.index() is index
+
+    # prefixes changed by other processes
+
+    cache.set(IXLanPrefix.index_version_cache_key, "other")
+    assert IXLanPrefix.index() is index
+
+    with override_settings(IXPFX_INDEX_CACHE_TIMEOUT=0):
+        assert IXLanPrefix.index() is not index
+        index = IXLanPrefix.index()
+        assert IXLanPrefix.index() is index
+
+    # the index is rebuilt when prefixes change
+
+    ixpfx.prefix = "195.69.148.0/22"
+    ixpfx.save()
+
+    assert IXLanPrefix.index() is not index
+    assert ix.ixlan.test_ipv4_address("195.69.148.1")
+    assert not ix.ixlan.test_ipv4_address("195.69.145.1")
+    assert not IXLanPrefix.whereis_ip("195.69.145.1").exists()
+
+    ixpfx.delete()
+
+    assert not ix.ixlan.test_ipv4_address("195.69.148.1")
+
+
+@pytest.mark.django_db
+def test_ixlan_prefix_index_rollback():
+    org = Organization.objects.create(name="Test Org", status="ok")
+    ix = InternetExchange.objects.create(name="Test IX", org=org, status="ok")
+
+    IXPFX_INDEX.clear()
+    assert not IXLanPrefix.whereis_ip("195.69.145.1").exists()
+
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            IXLanPrefix.objects.create(
+                ixlan=ix.ixlan, status="ok", prefix="195.69.144.0/22", protocol="IPv4"
+            )
+            assert IXLanPrefix.whereis_ip("195.69.145.1").exists()
+            raise RuntimeError()
+
+    assert IXLanPrefix.index().lookup("195.69.145.1") == []
+
+
+@pytest.mark.django_db
+def test_ixlan_test_ip_address_rechecks_index():
+    org = Organization.objects.create(name="Test Org", status="ok")
+    ix = InternetExchange.objects.create(name="Test IX", org=org, status="ok")
+
+    IXPFX_INDEX.clear()
+    index = IXLanPrefix.index()
+
+    # a prefix created by another process, the index of this
+    # process is not due to be checked yet
+
+    IXLanPrefix.objects.bulk_create(
+        [
+            IXLanPrefix(
+                ixlan=ix.ixlan, status="ok", prefix="195.69.144.0/22", protocol="IPv4"
+            )
+        ]
+    )
+    cache.set(IXLanPrefix.index_version_cache_key, "other")
+
+    assert IXLanPrefix.index() is index
+    assert ix.ixlan.test_ipv4_address("195.69.145.1")
+    assert IXLanPrefix.index() is not index
+
+    # the version stamp is culled from the cache
+
+    index = IXLanPrefix.index()
+    cache.delete(IXLanPrefix.index_version_cache_key)
+
+    assert IXLanPrefix.index(recheck=True) is not index
+    index = IXLanPrefix.index(recheck=True)
+    assert IXLanPrefix.index(recheck=True) is index
@@ -1,7 +1,26 @@
+import copy
 import json
+import weakref
 from pprint import pprint
 
+import pytest
+import reversion
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 from peeringdb_server import ixf
+from peeringdb_server.management.commands.pdb_benchmark import (
+    match_vlans_across_connections_reference,
+    synthetic_ixf_member_list,
+)
+from peeringdb_server.models import (
+    InternetExchange,
+    IXLanIXFMemberImportLogEntry,
+    IXLanPrefix,
+    Network,
+    Organization,
+    User,
+)
 
 
 def test_vlan_sanitize(data_ixf_vlan):
@@ -30,3 +49,260 @@ def test_match_vlans_across_connections(data_ixf_connections):
     )
     pprint(sanitized)
     assert sanitized == data_ixf_connections.expected["connection_list"]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_match_vlans_across_connections_reference(seed):
+    """
+    test that vlans are paired the same as by comparing every
+    connection against all remaining connections
+    """
+    importer = ixf.Importer()
+    member_list = synthetic_ixf_member_list(5, 40, seed=seed)
+    expected = copy.deepcopy(member_list)
+
+    for member, expected_member in zip(member_list, expected):
+        assert importer.match_vlans_across_connections(
+            member["connection_list"]
+        ) == match_vlans_across_connections_reference(
+            importer, expected_member["connection_list"]
+        )
+        assert member == expected_member
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 4096])
+def test_iter_json_object(chunk_size):
+    """
+    test that member list entries are read one at a time regardless
+    of how the data is split into chunks
+    """
+    data = {
+        "version": "1.0",
+        "ixp_list": [{"ixp_id": 1, "shortname": "Test \u00dcX"}],
+        "member_list": synthetic_ixf_member_list(3, 2),
+        "timestamp": "2020-07-13T09:23:47Z",
+    }
+    text = json.dumps(data, indent=1)
+    chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+    parsed = {}
+    members = []
+    for key, value in ixf.iter_json_object(chunks, "member_list"):
+        if key == "member_list":
+            members.append(value)
+        else:
+            parsed[key] = value
+    parsed["member_list"] = members
+
+    assert parsed == data
+
+
+@pytest.mark.parametrize(
+    "text", ['{"member_list": [{"asnum": 1},', '{"member_list": 1}', "[]", ""]
+)
+def test_iter_json_object_invalid(text):
+    with pytest.raises(ValueError):
+        list(ixf.iter_json_object([text], "member_list"))
+
+
+def test_sanitize_members_dedupe():
+    """
+    Test that identical member list entries are deduped
+    """
+
+    member = {"asnum": 63311, "name": "Net", "connection_list": []}
+    members = [
+        member,
+        copy.deepcopy(member),
+        dict(member, name="Other"),
+        dict(member, name="Flag", flag=1),
+        dict(member, name="Flag", flag=True),
+    ]
+
+    member_list, invalid = ixf.Importer().sanitize_members(members)
+
+    assert invalid is None
+    assert [m["name"] for m in member_list] == ["Net", "Other", "Flag", "Flag"]
+
+
+def test_freeze():
+    assert ixf.freeze({"a": [1, {"b": None}]}) == ixf.freeze({"a": [1, {"b": None}]})
+    assert ixf.freeze({"a": [1]}) != ixf.freeze({"a": [2]})
+    assert ixf.freeze({"a": 1}) != ixf.freeze([["a", 1]])
+    hash(ixf.freeze({"a": [1, {"b": None}]}))
+
+    # values that are equal in python but serialize differently
+
+    frozen = [ixf.freeze({"a": value}) for value in [True, 1, 1.0, 0.0, -0.0]]
+    assert len(set(frozen)) == 5
+    assert ixf.freeze([1.5, "1"]) == ixf.freeze([1.5, "1"])
+
+
+def test_fetch_all_releases_cached_data(mocker):
+    """
+    Test that fetched data is not held on to once it is cached
+    """
+
+    class Data(dict):
+        pass
+
+    cached = []
+
+    def fetch_remote(url, timeout=5, validators=None):
+        return Data(member_list=[])
+
+    def cache_result(url, data):
+        assert all(ref() is None for ref in cached)
+        cached.append(weakref.ref(data))
+        return True
+
+    importer = ixf.Importer()
+    mocker.patch.object(importer, "cached_validators", return_value=None)
+    mocker.patch.object(importer, "fetch_remote", fetch_remote)
+    mocker.patch.object(importer, "cache_result", cache_result)
+
+    urls = [f"https://ixf{i}.localhost/ixf.json" for i in range(5)]
+
+    assert importer.fetch_all(urls, workers=2) == {}
+    assert len(cached) == 5
+    assert all(ref() is None for ref in cached)
+
+
+def _ixf_member_list(count):
+    return [
+        {
+            "asnum": 63000 + i,
+            "connection_list": [
+                {
+                    "state": "active",
+                    "if_list": [{"if_speed": 10000}],
+                    "vlan_list": [
+                        {
+                            "vlan_id": 0,
+                            "ipv4": {"address": f"195.69.144.{i + 1}"},
+                            "ipv6": {"address": f"2001:7f8:1::a506:{3000 + i}:1"},
+                        }
+                    ],
+                }
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+def _parse_queries(ixlan, member_list):
+    importer = ixf.Importer()
+    importer.reset(ixlan=ixlan, save=True)
+    with CaptureQueriesContext(connection) as captured:
+        importer.parse({"member_list": member_list})
+    return importer, len(captured.captured_queries)
+
+
+@pytest.mark.django_db
+def test_parse_members_query_count():
+    """
+    Test that the number of queries needed to parse the member list
+    does not grow with the number of members
+    """
+
+    org = Organization.objects.create(name="Test Org", status="ok")
+    ix = InternetExchange.objects.create(name="Test IX", org=org, status="ok")
+    for prefix, protocol in [("195.69.144.0/22", "IPv4"), ("2001:7f8:1::/64", "IPv6")]:
+        IXLanPrefix.objects.create(
+            ixlan=ix.ixlan, status="ok", prefix=prefix, protocol=protocol
+        )
+
+    member_list = _ixf_member_list(100)
+    for member in member_list:
+        Network.objects.create(
+            asn=member["asnum"], name=f"AS{member['asnum']}", org=org, status="ok"
+        )
+
+    # build the in-process prefix index up front
+
+    IXLanPrefix.index()
+
+    importer, queries_small = _parse_queries(ix.ixlan, member_list[:5])
+    assert len(importer.pending_save) == 5
+
+    importer, queries_large = _parse_queries(ix.ixlan, member_list)
+    assert len(importer.pending_save) == 100
+
+    assert queries_small == queries_large
+
+    # existing ix-f member data is matched from the preloaded rows
+
+    importer.pending_save[0].save()
+    importer, _ = _parse_queries(ix.ixlan, member_list)
+    assert importer.pending_save[0].id
+    assert not any(ixf_member_data.id for ixf_member_data in importer.pending_save[1:])
+
+
+def _import_queries(ixlan, member_list):
+    importer = ixf.Importer()
+    with CaptureQueriesContext(connection) as captured:
+        importer.update(ixlan, data={"member_list": member_list})
+
+    log_entry_table = IXLanIXFMemberImportLogEntry._meta.db_table
+    version_lookups = 0
+    log_entry_inserts = 0
+    for query in captured.captured_queries:
+        sql = query["sql"]
+        if sql.startswith("SELECT") and "reversion_version" in sql:
+            version_lookups += 1
+        elif sql.startswith("INSERT") and log_entry_table in sql:
+            log_entry_inserts += 1
+    return version_lookups, log_entry_inserts
+
+
+@pytest.mark.django_db
+def test_import_writes_query_count():
+    """
+    Test that versions are looked up and import log entries are
+    written in bulk
+    """
+
+    User.objects.create_user("ixf_importer", "ixf_importer@localhost", "ixf_importer")
+    org = Organization.objects.create(name="Test Org", status="ok")
+    ix = InternetExchange.objects.create(name="Test IX", org=org, status="ok")
+    for prefix, protocol in [("195.69.144.0/22", "IPv4"), ("2001:7f8:1::/64", "IPv6")]:
+        IXLanPrefix.objects.create(
+            ixlan=ix.ixlan, status="ok", prefix=prefix, protocol=protocol
+        )
+
+    member_list = _ixf_member_list(30)
+    for member in member_list:
+        Network.objects.create(
+            asn=member["asnum"],
+            name=f"AS{member['asnum']}",
+            org=org,
+            status="ok",
+            allow_ixp_update=True,
+        )
+
+    _import_queries(ix.ixlan, member_list[:1])
+    queries_small = _import_queries(ix.ixlan, member_list[:5])
+    queries_large = _import_queries(ix.ixlan, member_list)
+    assert queries_small == queries_large
+
+    entries = IXLanIXFMemberImportLogEntry.objects.filter(log__ixlan=ix.ixlan)
+    assert entries.count() == 30
+    for entry in entries:
+        assert entry.action == "add"
+        assert entry.version_before is None
+        assert entry.version_after.object_id == str(entry.netixlan.id)
+
+    # modifications reference the version before and after the change
+
+    for member in member_list:
+        member["connection_list"][0]["state"] = "inactive"
+    _import_queries(ix.ixlan, member_list)
+
+    entries = IXLanIXFMemberImportLogEntry.objects.filter(
+        log__ixlan=ix.ixlan, action="modify"
+    )
+    assert entries.count() == 30
+    for entry in entries:
+        versions = reversion.models.Version.objects.get_for_object(entry.netixlan)
+        assert entry.version_after == versions[0]
+        assert entry.version_before == versions[1]
@@ -2,7 +2,9 @@ from lib2to3.pgen2 import token
 
 import pytest
 from django.conf import settings
-from django.test import Client, RequestFactory
+from django.core.cache import cache
+from django.db import transaction
+from django.test import Client, RequestFactory, override_settings
 from django.urls import reverse
 from django_grainy.models import UserPermission
 from grainy.const import PERM_CRUD, PERM_READ
@@ -18,7 +20,10 @@ from peeringdb_server.models import (
     UserAPIKey,
 )
 from peeringdb_server.permissions import (
+    PERMISSION_SETS,
+    PERMISSION_SETS_VERSION_KEY,
     check_permissions,
+    get_api_key_from_request,
     get_key_from_request,
     get_permission_holder_from_request,
 )
@@ -165,6 +170,99 @@ def test_check_perms(org, groups):
     assert check_permissions(api_key, namespace, "u") is False
 
 
+@pytest.mark.django_db
+def test_cached_perms(
+    user, django_assert_num_queries, django_capture_on_commit_callbacks
+):
+    namespace = "peeringdb.organization.1.network"
+    with django_capture_on_commit_callbacks(execute=True):
+        user.grainy_permissions.add_permission(namespace, PERM_READ)
+
+    assert check_permissions(User.objects.get(id=user.id), namespace, "r")
+
+    # compiled permission set is reused
+
+    holder = User.objects.get(id=user.id)
+    with django_assert_num_queries(0):
+        assert check_permissions(holder, namespace, "r")
+        assert check_permissions(holder, namespace, "u") is False
+
+    # permission changes
+
+    with django_capture_on_commit_callbacks(execute=True):
+        user.grainy_permissions.add_permission(namespace, PERM_CRUD)
+    assert check_permissions(User.objects.get(id=user.id), namespace, "u")
+
+    # group membership changes
+
+    other = "peeringdb.organization.2"
+    with django_capture_on_commit_callbacks(execute=True):
+        group = Group.objects.create(name="test group")
+        group.grainy_permissions.add_permission(other, PERM_READ)
+    assert check_permissions(User.objects.get(id=user.id), other, "r") is False
+
+    with django_capture_on_commit_callbacks(execute=True):
+        user.groups.add(group)
+    assert check_permissions(User.objects.get(id=user.id), other, "r")
+
+    # permission changes made by other processes
+
+    UserPermission.objects.filter(user=user).update(permission=PERM_READ)
+    cache.set(PERMISSION_SETS_VERSION_KEY, "other")
+    assert check_permissions(User.objects.get(id=user.id), namespace, "u")
+
+    with override_settings(PERMISSION_SETS_CACHE_TIMEOUT=0):
+        assert check_permissions(User.objects.get(id=user.id), namespace, "u") is False
+
+
+@pytest.mark.django_db
+def test_cached_perms_rollback(user):
+    namespace = "peeringdb.organization.1.network"
+    PERMISSION_SETS.clear()
+
+    assert check_permissions(User.objects.get(id=user.id), namespace, "r") is False
+
+    # a permission granted in a transaction that is rolled back
+
+    with pytest.raises(RuntimeError):
+        with transaction.atomic():
+            user.grainy_permissions.add_permission(namespace, PERM_READ)
+            assert check_permissions(User.objects.get(id=user.id), namespace, "r")
+            raise RuntimeError()
+
+    assert check_permissions(User.objects.get(id=user.id), namespace, "r") is False
+
+
+@pytest.mark.django_db
+def test_verified_key_cache(user, mocker):
+    api_key, key = UserAPIKey.objects.create_key(name="test key", user=user)
+    is_valid = mocker.spy(UserAPIKey, "is_valid")
+    factory = RequestFactory()
+
+    # key is verified once, then resolved from the verified key cache
+
+    for dummy in range(3):
+        request = factory.get("/api/net/1", HTTP_AUTHORIZATION=f"Api-Key {key}")
+        assert get_permission_holder_from_request(request) == api_key
+        assert get_api_key_from_request(request) == api_key
+
+    assert is_valid.call_count == 1
+
+    # other secret for the same prefix
+
+    prefix = key.partition(".")[0]
+    request = factory.get("/api/net/1", HTTP_AUTHORIZATION=f"Api-Key {prefix}.x")
+    assert get_api_key_from_request(request) is None
+    assert is_valid.call_count == 2
+
+    # revoked key
+
+    api_key.revoked = True
+    api_key.save()
+    request = factory.get("/api/net/1", HTTP_AUTHORIZATION=f"Api-Key {key}")
+    assert get_api_key_from_request(request) is None
+
+
 def test_get_key_from_request():
     key = "abcd"
     factory = RequestFactory()